@@ -0,0 +1,93 @@
+import os
+from dataclasses import dataclass
+from typing import List
+
+# name:WIDTHxHEIGHT:video_bitrate, comma separated, highest rendition first
+DEFAULT_LADDER = "1080p:1920x1080:5000k,720p:1280x720:2800k,360p:640x360:800k"
+
+
+@dataclass
+class Rendition:
+    name: str
+    width: int
+    height: int
+    bitrate: str
+
+    @property
+    def bitrate_kbps(self) -> int:
+        value = self.bitrate.lower()
+        if value.endswith("m"):
+            return int(float(value[:-1]) * 1000)
+        if value.endswith("k"):
+            return int(float(value[:-1]))
+        return int(value) // 1000
+
+
+def parse_ladder(spec: str) -> List[Rendition]:
+    renditions = []
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            name, size, bitrate = entry.split(":")
+            width, height = (int(v) for v in size.lower().split("x"))
+        except ValueError:
+            raise ValueError(f"Invalid ABR rendition '{entry}', expected name:WIDTHxHEIGHT:bitrate")
+        renditions.append(Rendition(name, width, height, bitrate))
+    if not renditions:
+        raise ValueError("ABR ladder is empty")
+    return renditions
+
+
+def get_ladder() -> List[Rendition]:
+    return parse_ladder(os.environ.get("HLS_ABR_LADDER", DEFAULT_LADDER))
+
+
+def filter_graph(renditions: List[Rendition], fps: int, source: str = "[0:v]") -> str:
+    """
+    Decode once, convert frame rate once, then split and scale per rendition.
+    `source` is the input pad, or a filter chain producing the video (e.g. with overlays burned in).
+    """
+    outputs = "".join(f"[s{i}]" for i in range(len(renditions)))
+    head = source if source.endswith("]") else f"{source},"
+    chains = [f"{head}fps={fps},format=yuv420p,split={len(renditions)}{outputs}"]
+    for i, r in enumerate(renditions):
+        chains.append(f"[s{i}]scale={r.width}:{r.height}[v{i}]")
+    return ";".join(chains)
+
+
+def encoder_args(renditions: List[Rendition], has_audio: bool) -> List[str]:
+    args: List[str] = []
+    for i in range(len(renditions)):
+        args += ["-map", f"[v{i}]"]
+    if has_audio:
+        for _ in renditions:
+            args += ["-map", "0:a:0"]
+    for i, r in enumerate(renditions):
+        kbps = r.bitrate_kbps
+        args += [
+            f"-b:v:{i}", f"{kbps}k",
+            f"-maxrate:v:{i}", f"{int(kbps * 1.07)}k",
+            f"-bufsize:v:{i}", f"{int(kbps * 1.5)}k",
+        ]
+    return args
+
+
+def var_stream_map(renditions: List[Rendition], has_audio: bool) -> str:
+    entries = []
+    for i, r in enumerate(renditions):
+        audio = f",a:{i}" if has_audio else ""
+        entries.append(f"v:{i}{audio},name:{r.name}")
+    return " ".join(entries)
+
+
+def cpu_weights(renditions: List[Rendition]) -> dict:
+    """
+    Share of the encoder's CPU attributed to each rendition. All renditions run inside one
+    FFmpeg process, so the split is estimated from encoded pixel rate, which x264's cost
+    scales with at a fixed preset.
+    """
+    pixels = {r.name: r.width * r.height for r in renditions}
+    total = sum(pixels.values())
+    return {name: value / total for name, value in pixels.items()}
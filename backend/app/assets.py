@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+from dataclasses import asdict, dataclass
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+ASSETS_DIR = os.path.abspath(os.environ.get(
+    "ASSETS_DIR", os.path.join(os.path.dirname(__file__), "..", "assets")
+))
+ASSET_MAX_BYTES = int(os.environ.get("ASSET_MAX_BYTES", str(10 * 1024 * 1024)))
+# Largest variant side, and largest source image, to bound decode/resize work
+ASSET_MAX_DIMENSION = int(os.environ.get("ASSET_MAX_DIMENSION", "4096"))
+ASSET_MAX_PIXELS = int(os.environ.get("ASSET_MAX_PIXELS", str(40_000_000)))
+# Variant boxes are rounded up to a multiple of this, so clients can't have one file made per pixel
+ASSET_VARIANT_STEP = int(os.environ.get("ASSET_VARIANT_STEP", "32"))
+# Variant files kept per asset; rendering one more deletes the least recently used
+ASSET_MAX_VARIANTS = int(os.environ.get("ASSET_MAX_VARIANTS", "16"))
+
+FORMATS = {"PNG": "png", "JPEG": "jpg", "GIF": "gif", "WEBP": "webp"}
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "gif": "image/gif", "webp": "image/webp"}
+VARIANT_FORMATS = ("png", "webp")
+WEBP_QUALITY = 85
+
+_ASSET_ID = re.compile(r"^[0-9a-f]{32}$")
+_VARIANT_NAME = re.compile(r"^w\d+h\d+\.(png|webp)$")
+
+
+class AssetError(ValueError):
+    pass
+
+
+@dataclass
+class AssetInfo:
+    id: str
+    format: str  # png|jpg|gif|webp
+    width: int
+    height: int
+    bytes: int
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES[self.format]
+
+
+# Keyed by (asset_id, width, height, format); concurrent requests share one render
+_renders: SingleFlight[str] = SingleFlight()
+
+
+def asset_id_for(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def _asset_dir(asset_id: str) -> str:
+    if not _ASSET_ID.match(asset_id):
+        raise AssetError(f"Invalid asset id '{asset_id}'")
+    return os.path.join(ASSETS_DIR, asset_id[:2], asset_id)
+
+
+def _original_path(info: AssetInfo) -> str:
+    return os.path.join(_asset_dir(info.id), f"original.{info.format}")
+
+
+def variant_path(info: AssetInfo, width: Optional[int], height: Optional[int], fmt: str) -> str:
+    return os.path.join(_asset_dir(info.id), f"w{width or 0}h{height or 0}.{fmt}")
+
+
+def variant_size(width: Optional[int], height: Optional[int]) -> Tuple[Optional[int], Optional[int]]:
+    """The box a variant is actually rendered for: each side rounded up to ASSET_VARIANT_STEP."""
+    def up(side: Optional[int]) -> Optional[int]:
+        if not side:
+            return None
+        return min(-(-side // ASSET_VARIANT_STEP) * ASSET_VARIANT_STEP, ASSET_MAX_DIMENSION)
+    return up(width), up(height)
+
+
+def _write_atomic(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _store(data: bytes) -> Tuple[AssetInfo, bool]:
+    """Validate and store an image. Returns its info and whether it was new."""
+    asset_id = asset_id_for(data)
+    existing = _load_info(asset_id)
+    if existing:
+        return existing, False
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            fmt = FORMATS.get(image.format)
+            width, height = image.size
+            if fmt is None:
+                raise AssetError(f"Unsupported image format {image.format}")
+            if width * height > ASSET_MAX_PIXELS:
+                raise AssetError(f"Image is too large ({width}x{height})")
+            image.verify()
+    except (UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise AssetError(f"Not a valid image: {e}")
+    info = AssetInfo(asset_id, fmt, width, height, len(data))
+    directory = _asset_dir(asset_id)
+    os.makedirs(directory, exist_ok=True)
+    _write_atomic(_original_path(info), data)
+    # The metadata file is written last: an asset exists once it is present
+    _write_atomic(os.path.join(directory, "meta.json"), json.dumps(asdict(info)).encode())
+    return info, True
+
+
+def _load_info(asset_id: str) -> Optional[AssetInfo]:
+    try:
+        with open(os.path.join(_asset_dir(asset_id), "meta.json"), "rb") as f:
+            return AssetInfo(**json.load(f))
+    except AssetError:
+        return None
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def _render(info: AssetInfo, width: Optional[int], height: Optional[int], fmt: str) -> str:
+    """Resize the original to fit within width x height (keeping its aspect ratio) and save it."""
+    path = variant_path(info, width, height, fmt)
+    try:
+        # The modification time records the last use, for _evict_variants
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    with Image.open(_original_path(info)) as image:
+        image = ImageOps.exif_transpose(image)
+        box = (width or info.width * height // info.height, height or info.height * width // info.width)
+        image = ImageOps.contain(image, (max(1, box[0]), max(1, box[1])), Image.Resampling.LANCZOS)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        out = io.BytesIO()
+        if fmt == "webp":
+            image.save(out, "WEBP", quality=WEBP_QUALITY, method=4)
+        else:
+            image.save(out, "PNG", optimize=True)
+    _write_atomic(path, out.getvalue())
+    _evict_variants(info, path)
+    return path
+
+
+def _evict_variants(info: AssetInfo, keep: str):
+    """Delete the least recently used variants of an asset beyond ASSET_MAX_VARIANTS."""
+    variants = []
+    with os.scandir(_asset_dir(info.id)) as entries:
+        for entry in entries:
+            if _VARIANT_NAME.match(entry.name) and entry.path != keep:
+                try:
+                    variants.append((entry.stat().st_mtime_ns, entry.path))
+                except OSError:
+                    continue
+    variants.sort()
+    for _, path in variants[:max(0, len(variants) + 1 - ASSET_MAX_VARIANTS)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+async def store_asset(data: bytes) -> Tuple[AssetInfo, bool]:
+    """Store image bytes once, keyed by content hash. Raises AssetError for invalid images."""
+    if len(data) > ASSET_MAX_BYTES:
+        raise AssetError(f"Image exceeds {ASSET_MAX_BYTES} bytes")
+    info, created = await asyncio.to_thread(_store, data)
+    if created:
+        logger.info(f"Stored asset {info.id} ({info.format} {info.width}x{info.height}, {info.bytes} bytes)")
+    return info, created
+
+
+async def get_asset(asset_id: str) -> Optional[AssetInfo]:
+    return await asyncio.to_thread(_load_info, asset_id)
+
+
+async def asset_file(
+    info: AssetInfo, width: Optional[int] = None, height: Optional[int] = None, fmt: Optional[str] = None
+) -> Tuple[str, str]:
+    """
+    Path and content type of the original or of a resized/WebP variant, rendering the variant
+    on first use. Sizes are rounded up to ASSET_VARIANT_STEP and at most ASSET_MAX_VARIANTS
+    variants are kept per asset, so requests can't make unbounded work or files.
+    Raises AssetError for unsupported sizes or formats.
+    """
+    if fmt is not None and fmt not in VARIANT_FORMATS:
+        raise AssetError(f"Unsupported variant format '{fmt}'")
+    if not width and not height and fmt in (None, info.format):
+        return _original_path(info), info.content_type
+    if (width or 0) > ASSET_MAX_DIMENSION or (height or 0) > ASSET_MAX_DIMENSION:
+        raise AssetError(f"Variants are limited to {ASSET_MAX_DIMENSION}px")
+    fmt = fmt or ("webp" if info.format == "webp" else "png")
+    width, height = variant_size(width, height)
+    key = (info.id, width, height, fmt)
+    path = await _renders.do(key, lambda: asyncio.to_thread(_render, info, width, height, fmt))
+    return path, CONTENT_TYPES[fmt]
+
+
+def load_image(asset_id: str) -> Optional[Image.Image]:
+    """Decode an asset's original image (blocking; call from a worker thread)."""
+    info = _load_info(asset_id)
+    if info is None:
+        return None
+    try:
+        with Image.open(_original_path(info)) as image:
+            image = ImageOps.exif_transpose(image)
+            image.load()
+            return image
+    except OSError as e:
+        logger.warning(f"Could not read asset {asset_id}: {e}")
+        return None
+
+
+async def prepare_variants(asset_id: str, width: Optional[int], height: Optional[int]):
+    """Pre-render the variants an overlay of this size will request, so its first viewers don't wait."""
+    if not width and not height:
+        return
+    info = await get_asset(asset_id)
+    if info is None:
+        return
+    for fmt in VARIANT_FORMATS:
+        try:
+            await asset_file(info, width, height, fmt)
+        except (AssetError, OSError) as e:
+            logger.warning(f"Could not pre-size asset {asset_id} to {width}x{height} {fmt}: {e}")
+            return
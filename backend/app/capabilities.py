@@ -0,0 +1,184 @@
+"""
+What the installed FFmpeg can do: resolved binary, version, encoders, muxers, filters and
+hwaccels. Detected once, asynchronously after startup (see ffmpeg_finder for the search),
+and reused by every stream start instead of shelling out each time.
+"""
+import asyncio
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Set, Tuple
+
+from .ffmpeg_finder import find_ffmpeg_installations
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+DETECT_TIMEOUT = float(os.environ.get("FFMPEG_DETECT_TIMEOUT", "10"))
+
+# " V....D libx264   ...", " DE hls   ...", " TSC overlay   VV->V ..."; legend lines have "=" as name
+_LISTING_LINE = re.compile(r"^\s*[A-Z.|]+\s+(\S+)")
+_VERSION = re.compile(r"^ffmpeg version (\S+)")
+
+
+@dataclass
+class FFmpegCapabilities:
+    path: Optional[str]  # None when no working FFmpeg was found
+    version: Optional[str] = None
+    encoders: Set[str] = field(default_factory=set)
+    muxers: Set[str] = field(default_factory=set)
+    filters: Set[str] = field(default_factory=set)
+    hwaccels: List[str] = field(default_factory=list)
+
+    @property
+    def available(self) -> bool:
+        return self.path is not None
+
+    def has_encoder(self, name: str) -> bool:
+        return name in self.encoders
+
+    def to_dict(self) -> dict:
+        return {
+            "path": self.path,
+            "version": self.version,
+            "encoders": sorted(self.encoders),
+            "muxers": sorted(self.muxers),
+            "filters": sorted(self.filters),
+            "hwaccels": self.hwaccels,
+        }
+
+
+_capabilities: Optional[FFmpegCapabilities] = None
+_detection: SingleFlight[FFmpegCapabilities] = SingleFlight()
+_detector: Optional[asyncio.Task] = None
+
+
+def parse_version(text: str) -> Optional[str]:
+    match = _VERSION.match(text)
+    return match.group(1) if match else None
+
+
+def parse_listing(text: str) -> Set[str]:
+    """Names from the output of `ffmpeg -encoders`, `-muxers` or `-filters`."""
+    names = set()
+    for line in text.splitlines():
+        match = _LISTING_LINE.match(line)
+        if match and match.group(1) != "=":
+            names.update(n for n in match.group(1).split(",") if n)
+    return names
+
+
+def parse_hwaccels(text: str) -> List[str]:
+    lines = [line.strip() for line in text.splitlines()]
+    return [line for line in lines[1:] if line]  # after "Hardware acceleration methods:"
+
+
+async def _ffmpeg(path: str, *args: str) -> Optional[str]:
+    """stdout of `path args`, or None if it cannot be run or fails."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            path, "-hide_banner", *args,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except OSError:
+        return None
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=DETECT_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.warning(f"'{path} {' '.join(args)}' timed out after {DETECT_TIMEOUT:.0f}s")
+        return None
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    return stdout.decode(errors="replace") if process.returncode == 0 else None
+
+
+async def _resolve() -> Optional[Tuple[str, str]]:
+    """
+    FFMPEG_PATH if it works, else the first working installation ffmpeg_finder knows of,
+    with its `-version` output (the check that it works).
+    """
+    version = await _ffmpeg(FFMPEG_PATH, "-version")
+    if version is not None:
+        return FFMPEG_PATH, version
+    logger.warning(f"FFmpeg not working at configured path: {FFMPEG_PATH}")
+    installations = await asyncio.to_thread(find_ffmpeg_installations)
+    for path in installations:
+        version = await _ffmpeg(path, "-version")
+        if version is not None:
+            logger.info(f"Found working FFmpeg at: {path}; using it (set FFMPEG_PATH to make this explicit)")
+            return path, version
+    if installations:
+        logger.warning(f"Found FFmpeg installations but none are working: {installations}")
+    else:
+        logger.warning("No FFmpeg installations found. Streaming functionality will not work!")
+    return None
+
+
+async def _detect() -> FFmpegCapabilities:
+    resolved = await _resolve()
+    if resolved is None:
+        return FFmpegCapabilities(path=None)
+    path, version = resolved
+    encoders, muxers, filters, hwaccels = await asyncio.gather(
+        _ffmpeg(path, "-encoders"),
+        _ffmpeg(path, "-muxers"),
+        _ffmpeg(path, "-filters"),
+        _ffmpeg(path, "-hwaccels"),
+    )
+    capabilities = FFmpegCapabilities(
+        path=path,
+        version=parse_version(version),
+        encoders=parse_listing(encoders or ""),
+        muxers=parse_listing(muxers or ""),
+        filters=parse_listing(filters or ""),
+        hwaccels=parse_hwaccels(hwaccels or ""),
+    )
+    logger.info(
+        f"FFmpeg {capabilities.version} at {path}: {len(capabilities.encoders)} encoders, "
+        f"{len(capabilities.filters)} filters, hwaccels: {', '.join(capabilities.hwaccels) or 'none'}"
+    )
+    return capabilities
+
+
+async def get_capabilities() -> FFmpegCapabilities:
+    """
+    The detected capabilities; the first caller runs the detection, concurrent callers share it.
+    A failed detection (no working FFmpeg) is not kept, so the next caller tries again.
+    """
+    if _capabilities is not None:
+        return _capabilities
+    return await _detection.do(None, _detect_once)
+
+
+async def _detect_once() -> FFmpegCapabilities:
+    global _capabilities
+    detected = await _detect()
+    if detected.available:
+        _capabilities = detected
+    return detected
+
+
+def ffmpeg_path() -> str:
+    """The resolved FFmpeg binary once detected, FFMPEG_PATH until then."""
+    if _capabilities is not None and _capabilities.path:
+        return _capabilities.path
+    return FFMPEG_PATH
+
+
+def start_detection():
+    """Detect in the background so startup doesn't wait for FFmpeg."""
+    global _detector
+    if _capabilities is None and (_detector is None or _detector.done()):
+        _detector = asyncio.create_task(get_capabilities())
+
+
+def invalidate():
+    """Forget the detected capabilities, e.g. after FFmpeg was upgraded in place."""
+    global _capabilities
+    _capabilities = None
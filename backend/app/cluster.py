@@ -0,0 +1,264 @@
+"""
+Stream ownership across workers and nodes, on top of the shared registry (see registry).
+
+A node claims a stream before starting its FFmpeg, so two workers cannot ingest the same
+camera, and renews the lease while it runs, publishing the stream's status with it. Requests
+for a stream another node owns are answered from that status or proxied to the owner
+(NODE_URL); stops are queued on the record and carried out by the owner at its next renewal.
+A node that stops renewing loses its streams to the others, which take them over from the
+start options stored in the record.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+from typing import Dict, Optional, Set
+
+import httpx
+from fastapi import HTTPException, Request, Response
+
+from . import stream_manager
+from .registry import StreamRecord, create_registry
+
+logger = logging.getLogger(__name__)
+
+NODE_ID = os.environ.get("NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Base URL other nodes can reach this worker at directly (e.g. http://10.0.0.5:8001); unset
+# for workers sharing one port, whose requests are then served from the published status
+NODE_URL = os.environ.get("NODE_URL") or None
+LEASE_SECONDS = float(os.environ.get("STREAM_LEASE_SECONDS", "15"))
+RENEW_INTERVAL = LEASE_SECONDS / 3
+# Streams of dead nodes a node takes over per renewal, so survivors share them out
+TAKEOVERS_PER_TICK = 1
+LOCATION_TTL = RENEW_INTERVAL
+PROXY_TIMEOUT = 70.0  # longer than the longest long-poll
+FORWARDED_HEADER = "X-Forwarded-By-Node"
+NODE_HEADER = "X-Stream-Node"
+PROXY_REQUEST_HEADERS = ("accept", "if-none-match", "range")
+PROXY_RESPONSE_HEADERS = ("content-type", "cache-control", "etag", "content-range", "accept-ranges", "last-modified")
+
+registry = create_registry()
+_locations: Dict[str, tuple] = {}  # stream_id -> (expires, record or None)
+_client: Optional[httpx.AsyncClient] = None
+_renewer: Optional[asyncio.Task] = None
+
+
+class OwnedElsewhere(Exception):
+    def __init__(self, record: StreamRecord):
+        super().__init__(f"Stream '{record.stream_id}' is running on node '{record.owner}'")
+        self.record = record
+
+
+async def _start_local(stream_id: str, spec: dict) -> Optional[str]:
+    options = dict(spec)
+    rtsp_url = options.pop("rtsp_url")
+    idle_timeout = options.pop("idle_timeout", None)
+    if options.pop("on_demand", False):
+        return stream_manager.register_stream(stream_id, rtsp_url, idle_timeout=idle_timeout, **options)
+    return await stream_manager.start_stream(stream_id, rtsp_url, **options)
+
+
+async def start_stream(stream_id: str, spec: dict) -> Optional[str]:
+    """
+    Claim `stream_id` for this node and start it from `spec` (rtsp_url, on_demand, idle_timeout
+    and the stream_manager start options). Returns the HLS URL, or None if it already runs here.
+    Raises OwnedElsewhere if another live node owns it, ValueError for invalid options.
+    """
+    now = time.time()
+    record = StreamRecord(stream_id, NODE_ID, now + LEASE_SECONDS, spec, owner_url=NODE_URL)
+    claimed = await registry.claim(record, now)
+    if not claimed:
+        current = await registry.get(stream_id)
+        if current is None:  # released meanwhile
+            claimed = await registry.claim(record, now)
+            current = None if claimed else await registry.get(stream_id)
+        # Already ours otherwise: stream_manager decides whether it is running
+        if current is not None and current.owner != NODE_ID:
+            raise OwnedElsewhere(current)
+    try:
+        hls_url = await _start_local(stream_id, spec)
+    except BaseException:
+        if claimed:
+            await registry.release(stream_id, NODE_ID)
+        raise
+    _locations.pop(stream_id, None)
+    return hls_url
+
+
+async def stop_stream(stream_id: str) -> Optional[str]:
+    """
+    Stop a stream wherever it runs. Returns 'stopped', 'stopping' when its owner will stop it
+    at its next renewal, or None if the stream is unknown.
+    """
+    if stream_manager.has_stream(stream_id):
+        await stream_manager.stop_stream(stream_id)
+        await registry.release(stream_id, NODE_ID)
+        return "stopped"
+    record = await registry.get(stream_id)
+    if record is None:
+        return None
+    _locations.pop(stream_id, None)
+    if not record.alive(time.time()) or record.owner == NODE_ID:
+        await registry.release(stream_id, record.owner)
+        return "stopped"
+    await registry.request_stop(stream_id)
+    return "stopping"
+
+
+async def locate(stream_id: str) -> Optional[StreamRecord]:
+    """The live record of a stream another node owns, cached for LOCATION_TTL seconds."""
+    now = time.time()
+    cached = _locations.get(stream_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    record = await registry.get(stream_id)
+    if record is not None and (record.owner == NODE_ID or not record.alive(now)):
+        record = None
+    _locations[stream_id] = (now + LOCATION_TTL, record)
+    return record
+
+
+def _http() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(timeout=PROXY_TIMEOUT)
+    return _client
+
+
+async def proxy(request: Request, record: StreamRecord) -> Response:
+    """Repeat a GET against the owner node and relay its response."""
+    headers = {name: request.headers[name] for name in PROXY_REQUEST_HEADERS if name in request.headers}
+    headers[FORWARDED_HEADER] = NODE_ID
+    url = record.owner_url.rstrip("/") + request.url.path
+    try:
+        r = await _http().get(url, params=request.query_params, headers=headers)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Node '{record.owner}' is unreachable: {type(e).__name__}")
+    relayed = {name: r.headers[name] for name in PROXY_RESPONSE_HEADERS if name in r.headers}
+    relayed[NODE_HEADER] = record.owner
+    return Response(r.content, status_code=r.status_code, headers=relayed)
+
+
+async def forward(request: Request, stream_id: str) -> Optional[Response]:
+    """Proxy the request to the stream's owner if another node runs it and is reachable."""
+    if stream_manager.has_stream(stream_id) or FORWARDED_HEADER in request.headers:
+        return None
+    record = await locate(stream_id)
+    if record is None or not record.owner_url:
+        return None
+    return await proxy(request, record)
+
+
+def _remote_status(record: StreamRecord) -> dict:
+    return {**(record.status or {"state": "starting"}), "node": record.owner}
+
+
+async def stream_status(stream_id: str, wait: float = 0) -> Optional[dict]:
+    """Status of a local stream (long-polled), or the last status its owner published."""
+    status = await stream_manager.wait_for_stream(stream_id, timeout=wait)
+    if status is not None:
+        return {**status, "node": NODE_ID}
+    record = await locate(stream_id)
+    return _remote_status(record) if record else None
+
+
+async def active_streams() -> Dict[str, dict]:
+    streams = {stream_id: {**info, "node": NODE_ID} for stream_id, info in stream_manager.get_active_streams().items()}
+    now = time.time()
+    for record in await registry.list():
+        if record.stream_id not in streams and record.owner != NODE_ID and record.alive(now):
+            streams[record.stream_id] = _remote_status(record)
+    return streams
+
+
+async def ingest_keys() -> Set[str]:
+    """
+    Ingests running on any node: this node's, plus those published by live records. Workers
+    sharing HLS_OUTPUT_DIR must not sweep each other's directories as orphans.
+    """
+    keys = stream_manager.ingest_keys()
+    now = time.time()
+    for record in await registry.list():
+        if record.owner != NODE_ID and record.alive(now) and record.status and record.status.get("ingest"):
+            keys.add(record.status["ingest"])
+    return keys
+
+
+async def _renew():
+    """Extend this node's leases; stop streams whose stop was requested or whose lease was lost."""
+    local = stream_manager.get_active_streams()
+    owned = await registry.renew(NODE_ID, local, time.time() + LEASE_SECONDS)
+    for stream_id in local:
+        if stream_id not in owned:
+            logger.warning(f"Lost the lease of stream '{stream_id}', stopping it")
+            await stream_manager.stop_stream(stream_id)
+        elif owned[stream_id]:
+            logger.info(f"Stopping stream '{stream_id}' on request of another node")
+            await stream_manager.stop_stream(stream_id)
+            await registry.release(stream_id, NODE_ID)
+
+
+async def _take_over(record: StreamRecord) -> bool:
+    now = time.time()
+    claimed = StreamRecord(record.stream_id, NODE_ID, now + LEASE_SECONDS, record.spec, owner_url=NODE_URL)
+    if not await registry.claim(claimed, now):
+        return False  # another node was faster
+    logger.info(f"Taking over stream '{record.stream_id}' from node '{record.owner}'")
+    _locations.pop(record.stream_id, None)
+    try:
+        await _start_local(record.stream_id, record.spec)
+    except Exception as e:
+        logger.error(f"Could not take over stream '{record.stream_id}': {type(e).__name__}: {e}")
+        await registry.release(record.stream_id, NODE_ID)
+        return False
+    return True
+
+
+async def _rebalance():
+    """Adopt the streams of nodes whose leases expired, while this node has free capacity."""
+    now = time.time()
+    expired = [r for r in await registry.list() if r.owner != NODE_ID and not r.alive(now)]
+    for record in expired:
+        if record.stop_requested:  # stopped while its owner was down
+            await registry.release(record.stream_id, record.owner)
+    candidates = [r for r in expired if not r.stop_requested]
+    random.shuffle(candidates)  # so nodes that tick together go for different streams
+    taken = 0
+    for record in candidates:
+        if taken >= TAKEOVERS_PER_TICK or stream_manager.get_capacity()["free_cores"] <= 0:
+            break
+        taken += await _take_over(record)
+
+
+async def _renew_forever():
+    while True:
+        try:
+            await _renew()
+            await _rebalance()
+        except Exception as e:
+            logger.error(f"Stream lease renewal failed: {type(e).__name__}: {e}")
+        await asyncio.sleep(RENEW_INTERVAL * random.uniform(0.8, 1.0))
+
+
+def start_renewer():
+    global _renewer
+    if _renewer is None or _renewer.done():
+        logger.info(f"Node '{NODE_ID}' renewing stream leases every {RENEW_INTERVAL:.1f}s")
+        _renewer = asyncio.create_task(_renew_forever())
+
+
+async def stop_renewer():
+    """Stop renewing and hand this node's streams to the others right away."""
+    global _renewer, _client
+    if _renewer is not None:
+        _renewer.cancel()
+        _renewer = None
+    try:
+        await registry.expire(NODE_ID)
+    except Exception as e:
+        logger.warning(f"Could not release stream leases: {type(e).__name__}: {e}")
+    if _client is not None:
+        await _client.aclose()
+        _client = None
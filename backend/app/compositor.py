@@ -0,0 +1,166 @@
+import asyncio
+import base64
+import binascii
+import io
+import logging
+import os
+from typing import List, Optional, Set, Tuple
+
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
+
+from . import assets, crud
+from .models import OverlayDB
+from .overlay_feed import OverlayChange, feed
+
+logger = logging.getLogger(__name__)
+
+# Overlay coordinates are in the editor's player space; they are scaled to the video size
+OVERLAY_CANVAS_SIZE = os.environ.get("OVERLAY_CANVAS_SIZE", "640x360")
+OVERLAY_FONT = os.environ.get("OVERLAY_FONT")  # path to a TrueType font; Pillow's default otherwise
+# FFmpeg re-reads the layer this many times per second, which bounds how quickly changes show up
+LAYER_FRAMERATE = 2
+LAYER_FILE = "overlay_layer.png"
+# Re-render periodically too, for writes from other workers when no change stream is available
+LAYER_REFRESH_SECONDS = 30.0
+
+# Matches the editor's styling of text overlays
+TEXT_SIZE = 16
+TEXT_PADDING = 4
+TEXT_BACKGROUND = (255, 255, 255, 128)
+TEXT_COLOR = (0, 0, 0, 255)
+
+
+def canvas_size() -> Tuple[int, int]:
+    width, _, height = OVERLAY_CANVAS_SIZE.lower().partition("x")
+    return int(width), int(height)
+
+
+def input_args(layer_path: str) -> List[str]:
+    """
+    The layer as a second FFmpeg input. The image2 demuxer opens the file again for every
+    frame, so replacing it (atomically) changes the burned-in overlays without a restart.
+    -re paces those reads with the live source instead of reading ahead.
+    """
+    return [
+        "-re",
+        "-f", "image2",
+        "-loop", "1",
+        "-framerate", str(LAYER_FRAMERATE),
+        "-i", layer_path.replace("\\", "/"),
+    ]
+
+
+def overlay_filter(video: str, layer: str) -> str:
+    # eof_action=repeat keeps the last layer frame if the image input ever stalls
+    return f"[{video}][{layer}]overlay=0:0:format=auto:eof_action=repeat"
+
+
+def _font(size: int):
+    try:
+        if OVERLAY_FONT:
+            return ImageFont.truetype(OVERLAY_FONT, size)
+        return ImageFont.load_default(size=size)
+    except (OSError, TypeError):  # missing font file / Pillow without FreeType
+        return ImageFont.load_default()
+
+
+def _with_opacity(image: Image.Image, opacity: float) -> Image.Image:
+    if opacity >= 1.0:
+        return image
+    alpha = image.getchannel("A").point(lambda a: int(a * opacity))
+    image.putalpha(alpha)
+    return image
+
+
+def _overlay_image(overlay: OverlayDB) -> Optional[Image.Image]:
+    if overlay.asset_id:
+        return assets.load_image(overlay.asset_id)
+    prefix, _, data = overlay.content.partition(";base64,")
+    if not prefix.startswith("data:image/") or not data:
+        # Remote image URLs are not fetched by the encoder
+        return None
+    try:
+        image = Image.open(io.BytesIO(base64.b64decode(data)))
+        image.load()
+        return image
+    except (binascii.Error, UnidentifiedImageError, OSError):
+        return None
+
+
+def render_layer(overlays: List[OverlayDB], size: Tuple[int, int]) -> bytes:
+    """Rasterize overlays onto a transparent PNG of the video's size, later ones on top."""
+    width, height = size
+    canvas_width, canvas_height = canvas_size()
+    sx, sy = width / canvas_width, height / canvas_height
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    for overlay in overlays:
+        x, y = round(overlay.x * sx), round(overlay.y * sy)
+        if overlay.kind == "image":
+            image = _overlay_image(overlay)
+            if image is None:
+                continue
+            box_w = round(overlay.width * sx) if overlay.width else round(image.width * sx)
+            box_h = round(overlay.height * sy) if overlay.height else round(image.height * sy)
+            image = image.convert("RGBA").resize((max(1, box_w), max(1, box_h)), Image.Resampling.LANCZOS)
+        else:
+            font = _font(max(1, round(TEXT_SIZE * sy)))
+            pad = round(TEXT_PADDING * sy)
+            measure = ImageDraw.Draw(layer).textbbox((0, 0), overlay.content, font=font)
+            image = Image.new("RGBA", (measure[2] + 2 * pad, measure[3] + 2 * pad), TEXT_BACKGROUND)
+            ImageDraw.Draw(image).text((pad, pad), overlay.content, font=font, fill=TEXT_COLOR)
+        image = _with_opacity(image, overlay.opacity)
+        layer.alpha_composite(image, (min(x, width - 1), min(y, height - 1)))
+    out = io.BytesIO()
+    layer.save(out, "PNG", compress_level=1)
+    return out.getvalue()
+
+
+def write_layer(path: str, data: bytes):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+async def render_to(path: str, size: Tuple[int, int], stream_id: str) -> List[OverlayDB]:
+    """Render the stream's overlays into its layer file; returns the overlays drawn."""
+    overlays = await crud.list_stream_overlays(stream_id)
+    data = await asyncio.to_thread(render_layer, overlays, size)
+    await asyncio.to_thread(write_layer, path, data)
+    return overlays
+
+
+def _affects(change: OverlayChange, stream_id: str, drawn: Set[str]) -> bool:
+    # Overlays moved to another stream or deleted are only known by id
+    return change.id in drawn or (change.overlay is not None and change.overlay.get("stream_id") == stream_id)
+
+
+async def _wait_for_change(version: int, stream_id: str, drawn: Set[str]):
+    """
+    Wait until a change after `version` concerns the stream, the feed lost track of changes,
+    or LAYER_REFRESH_SECONDS have passed.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LAYER_REFRESH_SECONDS
+    while await feed.wait(version, timeout=max(0.0, deadline - loop.time())):
+        changes = feed.since(version)
+        if changes is None or any(_affects(c, stream_id, drawn) for c in changes):
+            return
+        version = changes[-1].version
+
+
+async def follow(path: str, size: Tuple[int, int], stream_id: str):
+    """
+    Re-render the stream's layer whenever its overlays change, for as long as the stream runs.
+    Changes to other streams' overlays are skipped.
+    """
+    crud.ensure_change_feed()
+    drawn: Set[str] = set()
+    while True:
+        version = feed.version
+        try:
+            drawn = {overlay.id for overlay in await render_to(path, size, stream_id)}
+        except Exception as e:
+            logger.warning(f"Could not render overlay layer {path}: {type(e).__name__}: {e}")
+        # Changes made while rendering are picked up right away by the next pass
+        await _wait_for_change(version, stream_id, drawn)
@@ -1,54 +1,278 @@
-from typing import List, Optional
-from .models import OverlayCreate, OverlayUpdate, OverlayDB
+from typing import AsyncIterator, List, Optional
+import bisect
+from .models import OverlayBatch, OverlayBatchResult, OverlayCreate, OverlayPatch, OverlayUpdate, OverlayDB
 from uuid import uuid4
+import asyncio
+import logging
 import os
+from . import metrics
 from .db import get_overlays_collection
+from .overlay_cache import CachedRead, cache
+from .overlay_feed import feed
 from bson import ObjectId
+from pymongo import ASCENDING, DeleteOne, InsertOne, ReturnDocument, UpdateOne
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
 
 # In-memory fallback store
 _STORE: dict[str, OverlayDB] = {}
+# Secondary index of the in-memory store: stream_id -> overlay ids, in insertion order
+_BY_STREAM: dict[str, dict[str, None]] = {}
+# overlay id -> creation counter, the in-memory tie-breaker matching Mongo's _id order
+_CREATED: dict[str, int] = {}
+_created_count = 0
 
 USE_DB = os.getenv("USE_MONGO", "0") == "1"
 
+store_op_duration = metrics.Histogram(
+    "overlay_store_operation_seconds", "Overlay store reads (cache misses) and writes.", ("op", "backend")
+)
+
+
+def _timed(op: str):
+    return metrics.timed(store_op_duration, lambda: (op, "mongo" if USE_DB else "memory"))
+
+
+# Change stream operation -> feed operation
+_CHANGE_OPS = {"insert": "create", "update": "update", "replace": "update", "delete": "delete"}
+CHANGE_STREAM_RETRY_MAX = 30.0
+# "The $changeStream stage is only supported on replica sets": a standalone mongod
+_NO_CHANGE_STREAMS = 40573
+_change_watcher: Optional[asyncio.Task] = None
+# Set once the server turned out to have no change streams; local writes are then published directly
+_change_streams_unsupported = False
 
-async def _to_db_model(doc) -> OverlayDB:
+
+def _object_id(overlay_id: str) -> Optional[ObjectId]:
+    try:
+        return ObjectId(overlay_id)
+    except Exception:
+        return None
+
+
+def _to_db_model(doc) -> OverlayDB:
     return OverlayDB(
         id=str(doc.get("_id")) if doc.get("_id") else doc.get("id"),
         kind=doc["kind"],
-        content=doc["content"],
+        content=doc.get("content", ""),
         x=doc.get("x", 0),
         y=doc.get("y", 0),
         width=doc.get("width"),
         height=doc.get("height"),
         opacity=doc.get("opacity", 1.0),
+        asset_id=doc.get("asset_id"),
+        stream_id=doc.get("stream_id"),
+        z_order=doc.get("z_order", 0),
+    )
+
+
+def _put(overlay: OverlayDB):
+    """Store an overlay in memory, keeping the stream index in step."""
+    global _created_count
+    previous = _STORE.get(overlay.id)
+    if previous is None:
+        _created_count += 1
+        _CREATED[overlay.id] = _created_count
+    if previous is not None and previous.stream_id != overlay.stream_id:
+        _unindex(previous)
+    _STORE[overlay.id] = overlay
+    if overlay.stream_id is not None:
+        _BY_STREAM.setdefault(overlay.stream_id, {})[overlay.id] = None
+
+
+def _pop(overlay_id: str) -> Optional[OverlayDB]:
+    overlay = _STORE.pop(overlay_id, None)
+    if overlay is not None:
+        _unindex(overlay)
+        _CREATED.pop(overlay_id, None)
+    return overlay
+
+
+def _unindex(overlay: OverlayDB):
+    ids = _BY_STREAM.get(overlay.stream_id)
+    if ids is not None:
+        ids.pop(overlay.id, None)
+        if not ids:
+            del _BY_STREAM[overlay.stream_id]
+
+
+async def ensure_indexes():
+    """Create the indexes overlay queries rely on. Idempotent; called at startup."""
+    if not USE_DB:
+        return
+    col = await get_overlays_collection()
+    # Serves list_stream_overlays: equality on stream_id, already sorted by z_order, then creation
+    await col.create_index(
+        [("stream_id", ASCENDING), ("z_order", ASCENDING), ("_id", ASCENDING)], name="stream_id_z_order_id"
     )
+    try:
+        # Superseded by the index above, which also covers ties in z_order
+        await col.drop_index("stream_id_z_order")
+    except OperationFailure:
+        pass
 
 
+def _written(overlay_id: str, overlay: Optional[OverlayDB]) -> Optional[OverlayDB]:
+    """Write-through: cache what a database write returned (or forget the id if it is gone)."""
+    cache.invalidate(overlay_id, overlay)
+    if overlay is not None:
+        _publish_write("update", overlay_id, overlay)
+    return overlay
+
+
+def _publish_write(op: str, overlay_id: str, overlay: Optional[OverlayDB] = None):
+    """
+    Feed a write this worker made on Mongo. The change stream normally delivers it, along with
+    other workers' writes; without change streams this worker's own writes are all there is.
+    """
+    if _change_streams_unsupported:
+        feed.publish(op, overlay_id, overlay.model_dump() if overlay else None)
+
+
+@_timed("create")
 async def create_overlay(data: OverlayCreate) -> OverlayDB:
     if USE_DB:
         col = await get_overlays_collection()
         doc = data.model_dump()
         res = await col.insert_one(doc)
         doc["_id"] = res.inserted_id
-        return await _to_db_model(doc)
+        overlay = _to_db_model(doc)
+        cache.invalidate(overlay.id, overlay)
+        _publish_write("create", overlay.id, overlay)
+        return overlay
     oid = str(uuid4())
     overlay = OverlayDB(id=oid, **data.model_dump())
-    _STORE[oid] = overlay
+    _put(overlay)
+    cache.invalidate(oid, overlay)
+    feed.publish("create", oid, overlay.model_dump())
     return overlay
 
 
+async def read_overlays() -> CachedRead:
+    """All overlays, from the read-through cache when fresh."""
+    entry = cache.get_list()
+    if entry is None:
+        generation = cache.generation
+        entry = cache.put_list(await _load_overlays(), generation)
+    return entry
+
+
 async def list_overlays() -> List[OverlayDB]:
+    return (await read_overlays()).value
+
+
+@_timed("load_all")
+async def _load_overlays() -> List[OverlayDB]:
     if USE_DB:
         col = await get_overlays_collection()
         docs = col.find({})
         result: List[OverlayDB] = []
         async for d in docs:
-            result.append(await _to_db_model(d))
+            result.append(_to_db_model(d))
         return result
     return list(_STORE.values())
 
 
+async def read_stream_overlays(stream_id: str) -> CachedRead:
+    """A stream's overlays in drawing order (z_order, then creation), from the cache when fresh."""
+    entry = cache.get_stream_list(stream_id)
+    if entry is None:
+        generation = cache.generation
+        entry = cache.put_stream_list(stream_id, await _load_stream_overlays(stream_id), generation)
+    return entry
+
+
+async def list_stream_overlays(stream_id: str) -> List[OverlayDB]:
+    return (await read_stream_overlays(stream_id)).value
+
+
+@_timed("load_stream")
+async def _load_stream_overlays(stream_id: str) -> List[OverlayDB]:
+    if USE_DB:
+        col = await get_overlays_collection()
+        # One scan of the (stream_id, z_order, _id) index; no in-memory sort. ObjectIds grow with
+        # creation time, so equal z_orders are drawn in creation order as in memory.
+        cursor = col.find({"stream_id": stream_id}).sort([("z_order", ASCENDING), ("_id", ASCENDING)])
+        return [_to_db_model(d) async for d in cursor]
+    overlays = [_STORE[i] for i in _BY_STREAM.get(stream_id, ())]
+    # The stream index is in the order overlays joined the stream, which differs for moved ones
+    return sorted(overlays, key=lambda o: (o.z_order, _CREATED[o.id]))
+
+
+# Fields a listing can be projected to; `id` is always included
+OVERLAY_FIELDS = tuple(name for name in OverlayDB.model_fields if name != "id")
+_FIELD_DEFAULTS = {name: None if f.is_required() else f.default for name, f in OverlayDB.model_fields.items()}
+
+
+def _project(overlay: OverlayDB, fields: Optional[List[str]]) -> dict:
+    if fields is None:
+        return overlay.model_dump()
+    return {"id": overlay.id, **{name: getattr(overlay, name) for name in fields}}
+
+
+async def iter_overlays(
+    after: Optional[str] = None,
+    limit: Optional[int] = None,
+    fields: Optional[List[str]] = None,
+) -> AsyncIterator[dict]:
+    """
+    Yield overlays in id order, starting after id `after`, as the database returns them.
+    `fields` limits each overlay to those fields (plus id); on Mongo the projection is
+    applied by the query, so skipped fields (e.g. image `content`) are never transferred.
+    Raises ValueError for an unknown field or a malformed `after`.
+    """
+    unknown = set(fields or ()) - set(OVERLAY_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown overlay field(s): {', '.join(sorted(unknown))}")
+    if limit == 0:
+        return
+    if USE_DB:
+        query = {}
+        if after is not None:
+            oid = _object_id(after)
+            if oid is None:
+                raise ValueError(f"Invalid cursor '{after}'")
+            query["_id"] = {"$gt": oid}
+        projection = {name: 1 for name in fields} if fields is not None else None
+        col = await get_overlays_collection()
+        cursor = col.find(query, projection).sort("_id", 1)
+        if limit is not None:
+            cursor = cursor.limit(limit).batch_size(min(limit, 100))
+        async for doc in cursor:
+            if fields is None:
+                yield _to_db_model(doc).model_dump()
+            else:
+                yield {"id": str(doc["_id"]), **{name: doc.get(name, _FIELD_DEFAULTS[name]) for name in fields}}
+        return
+    ids = sorted(_STORE)
+    start = bisect.bisect_right(ids, after) if after is not None else 0
+    end = start + limit if limit is not None else len(ids)
+    for overlay_id in ids[start:end]:
+        overlay = _STORE.get(overlay_id)
+        if overlay is not None:
+            yield _project(overlay, fields)
+
+
+async def read_overlay(overlay_id: str) -> Optional[CachedRead]:
+    """One overlay, from the read-through cache when fresh; None if it does not exist."""
+    entry = cache.get_item(overlay_id)
+    if entry is None:
+        generation = cache.generation
+        overlay = await _load_overlay(overlay_id)
+        if overlay is None:
+            return None
+        entry = cache.put_item(overlay, generation)
+    return entry
+
+
 async def get_overlay(overlay_id: str) -> Optional[OverlayDB]:
+    entry = await read_overlay(overlay_id)
+    return entry.value if entry else None
+
+
+@_timed("load_one")
+async def _load_overlay(overlay_id: str) -> Optional[OverlayDB]:
     if USE_DB:
         col = await get_overlays_collection()
         try:
@@ -58,10 +282,11 @@ async def get_overlay(overlay_id: str) -> Optional[OverlayDB]:
         doc = await col.find_one({"_id": oid})
         if not doc:
             return None
-        return await _to_db_model(doc)
+        return _to_db_model(doc)
     return _STORE.get(overlay_id)
 
 
+@_timed("update")
 async def update_overlay(overlay_id: str, data: OverlayUpdate) -> Optional[OverlayDB]:
     if USE_DB:
         col = await get_overlays_collection()
@@ -69,19 +294,45 @@ async def update_overlay(overlay_id: str, data: OverlayUpdate) -> Optional[Overl
             oid = ObjectId(overlay_id)
         except Exception:
             return None
-        updated_fields = data.model_dump()
-        res = await col.update_one({"_id": oid}, {"$set": updated_fields})
-        if res.matched_count == 0:
-            return None
-        doc = await col.find_one({"_id": oid})
-        return await _to_db_model(doc)
+        doc = await col.find_one_and_update(
+            {"_id": oid}, {"$set": data.model_dump()}, return_document=ReturnDocument.AFTER
+        )
+        return _written(overlay_id, _to_db_model(doc) if doc else None)
     if overlay_id not in _STORE:
         return None
     updated = OverlayDB(id=overlay_id, **data.model_dump())
-    _STORE[overlay_id] = updated
+    _put(updated)
+    cache.invalidate(overlay_id, updated)
+    feed.publish("update", overlay_id, updated.model_dump())
     return updated
 
 
+@_timed("patch")
+async def patch_overlay(overlay_id: str, data: OverlayPatch) -> Optional[OverlayDB]:
+    """Change only the fields set in `data`, in a single round-trip on Mongo."""
+    changes = data.changes()
+    if not changes:
+        return await get_overlay(overlay_id)
+    if USE_DB:
+        col = await get_overlays_collection()
+        oid = _object_id(overlay_id)
+        if oid is None:
+            return None
+        doc = await col.find_one_and_update(
+            {"_id": oid}, {"$set": changes}, return_document=ReturnDocument.AFTER
+        )
+        return _written(overlay_id, _to_db_model(doc) if doc else None)
+    current = _STORE.get(overlay_id)
+    if current is None:
+        return None
+    updated = current.model_copy(update=changes)
+    _put(updated)
+    cache.invalidate(overlay_id, updated)
+    feed.publish("update", overlay_id, updated.model_dump())
+    return updated
+
+
+@_timed("delete")
 async def delete_overlay(overlay_id: str) -> bool:
     if USE_DB:
         col = await get_overlays_collection()
@@ -90,5 +341,186 @@ async def delete_overlay(overlay_id: str) -> bool:
         except Exception:
             return False
         res = await col.delete_one({"_id": oid})
+        cache.invalidate(overlay_id)
+        if res.deleted_count == 1:
+            _publish_write("delete", overlay_id)
         return res.deleted_count == 1
-    return _STORE.pop(overlay_id, None) is not None
+    if _pop(overlay_id) is None:
+        return False
+    cache.invalidate(overlay_id)
+    feed.publish("delete", overlay_id)
+    return True
+
+
+@_timed("batch")
+async def apply_batch(batch: OverlayBatch) -> OverlayBatchResult:
+    """
+    Create, partially update and delete many overlays in one call, in that order.
+    Ids that don't exist are reported in `missing`; everything else is applied.
+    """
+    result = await _apply_batch_db(batch) if USE_DB else _apply_batch_in_memory(batch)
+    for overlay in result.created + result.updated:
+        cache.invalidate(overlay.id, overlay)
+    for overlay_id in result.deleted:
+        cache.invalidate(overlay_id)
+    if USE_DB:
+        for overlay in result.created:
+            _publish_write("create", overlay.id, overlay)
+        for overlay in result.updated:
+            _publish_write("update", overlay.id, overlay)
+        for overlay_id in result.deleted:
+            _publish_write("delete", overlay_id)
+    return result
+
+
+def _apply_batch_in_memory(batch: OverlayBatch) -> OverlayBatchResult:
+    result = OverlayBatchResult()
+    staged: dict[str, OverlayDB] = {}
+    for data in batch.create:
+        overlay = OverlayDB(id=str(uuid4()), **data.model_dump())
+        staged[overlay.id] = overlay
+        result.created.append(overlay)
+    for patch in batch.update:
+        current = staged.get(patch.id) or _STORE.get(patch.id)
+        if current is None:
+            result.missing.append(patch.id)
+            continue
+        staged[patch.id] = current.model_copy(update=patch.changes())
+    for overlay_id in dict.fromkeys(batch.delete):
+        if overlay_id in staged or overlay_id in _STORE:
+            result.deleted.append(overlay_id)
+        else:
+            result.missing.append(overlay_id)
+    # Apply everything without yielding to the event loop, so no reader sees half a batch
+    for overlay in staged.values():
+        _put(overlay)
+    for overlay_id in result.deleted:
+        staged.pop(overlay_id, None)
+        _pop(overlay_id)
+    created = {o.id for o in result.created}
+    result.created = [o for o in result.created if o.id in staged]
+    result.updated = [o for i, o in staged.items() if i not in created]
+    for overlay in result.created:
+        feed.publish("create", overlay.id, overlay.model_dump())
+    for overlay in result.updated:
+        feed.publish("update", overlay.id, overlay.model_dump())
+    for overlay_id in result.deleted:
+        feed.publish("delete", overlay_id)
+    return result
+
+
+async def _apply_batch_db(batch: OverlayBatch) -> OverlayBatchResult:
+    """One bulk_write for all changes, plus one query each to check ids and read back updates."""
+    col = await get_overlays_collection()
+    result = OverlayBatchResult()
+    targets = {i: _object_id(i) for i in [p.id for p in batch.update] + batch.delete}
+    known = [oid for oid in targets.values() if oid is not None]
+    existing = set()
+    if known:
+        async for doc in col.find({"_id": {"$in": known}}, {"_id": 1}):
+            existing.add(doc["_id"])
+
+    ops = []
+    created_docs = []
+    for data in batch.create:
+        doc = data.model_dump()
+        doc["_id"] = ObjectId()
+        created_docs.append(doc)
+        ops.append(InsertOne(doc))
+    updated_ids = []
+    for patch in batch.update:
+        oid = targets[patch.id]
+        if oid not in existing:
+            result.missing.append(patch.id)
+            continue
+        changes = patch.changes()
+        if changes:
+            ops.append(UpdateOne({"_id": oid}, {"$set": changes}))
+        updated_ids.append(oid)
+    deleted_ids = set()
+    for overlay_id in dict.fromkeys(batch.delete):
+        oid = targets[overlay_id]
+        if oid not in existing:
+            result.missing.append(overlay_id)
+            continue
+        ops.append(DeleteOne({"_id": oid}))
+        deleted_ids.add(oid)
+        result.deleted.append(overlay_id)
+    if ops:
+        await col.bulk_write(ops, ordered=True)
+
+    result.created = [_to_db_model(doc) for doc in created_docs]
+    read_back = [oid for oid in updated_ids if oid not in deleted_ids]
+    if read_back:
+        async for doc in col.find({"_id": {"$in": read_back}}):
+            result.updated.append(_to_db_model(doc))
+    return result
+
+
+def ensure_change_feed():
+    """
+    Make sure the overlay feed is being fed. The in-memory store publishes its own changes;
+    on Mongo, changes from every writer arrive through the collection's change stream
+    (if the server has none, only this worker's own writes are published).
+    """
+    global _change_watcher
+    if not USE_DB or _change_streams_unsupported:
+        return
+    if _change_watcher is None or _change_watcher.done():
+        _change_watcher = asyncio.create_task(_follow_change_stream())
+
+
+def _publish_change(change: dict):
+    op = _CHANGE_OPS.get(change.get("operationType"))
+    if op is None:
+        return
+    overlay_id = str(change["documentKey"]["_id"])
+    doc = change.get("fullDocument")
+    if op != "delete" and doc is None:
+        # Updated and then deleted before the lookup; the delete event follows
+        return
+    overlay = _to_db_model(doc) if doc is not None else None
+    # Writes from other workers arrive here too, keeping the read cache fresh ahead of its TTL
+    cache.invalidate(overlay_id, overlay)
+    feed.publish(op, overlay_id, overlay.model_dump() if overlay else None)
+
+
+async def _follow_change_stream():
+    """
+    Publish the overlays collection's change stream into the feed, resuming after errors.
+    Gives up for good on servers without change streams (standalone mongod).
+    """
+    global _change_streams_unsupported
+    resume_token = None
+    delay = 1.0
+    # Changes may have been missed since subscribers last synced
+    missed = False
+    while True:
+        try:
+            col = await get_overlays_collection()
+            async with col.watch(full_document="updateLookup", resume_after=resume_token) as changes:
+                delay = 1.0
+                if missed:
+                    # Once per outage, when the stream is back, so subscribers resync to what is current
+                    missed = False
+                    cache.clear()
+                    feed.reset()
+                async for change in changes:
+                    _publish_change(change)
+                    resume_token = changes.resume_token
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, OperationFailure) and e.code == _NO_CHANGE_STREAMS:
+                logger.warning(
+                    f"MongoDB has no change streams ({e}); publishing this worker's overlay writes only. "
+                    f"Run MongoDB as a replica set to receive the changes of other workers."
+                )
+                _change_streams_unsupported = True
+                return
+            logger.warning(f"Overlay change stream failed: {type(e).__name__}: {e}; retrying in {delay:.0f}s")
+            # The resume token may have expired in the meantime
+            resume_token = None
+            missed = True
+            await asyncio.sleep(delay)
+            delay = min(CHANGE_STREAM_RETRY_MAX, delay * 2)
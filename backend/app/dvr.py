@@ -0,0 +1,419 @@
+"""
+DVR / time-shift archive.
+
+Completed live segments of streams started with `dvr` are copied into hour buckets under
+DVR_DIR/<stream_id>/<YYYYMMDD>/<HH>/, named by their start time. They are never hard-linked:
+a restarted FFmpeg numbers its segments from 0 again and truncates the old files in place. Start times come from the live playlist's EXT-X-PROGRAM-DATE-TIME tags.
+Byte ranges of fMP4 chunk files are copied out as files of their own, and every bucket gets
+a copy of the fMP4 init segment its segments need (EXT-X-MAP).
+Every bucket has an append-only index of its segments, and every open archive keeps the whole
+index in memory as sorted parallel lists, so the playlist for any [from, to] window is found
+with two binary searches instead of a directory scan.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import os
+import re
+import shutil
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DVR_DIR = os.path.abspath(os.environ.get(
+    "DVR_DIR", os.path.join(os.path.dirname(__file__), "..", "dvr")
+))
+# How far back streams can be rewound
+DVR_WINDOW_SECONDS = float(os.environ.get("DVR_WINDOW_SECONDS", "3600"))
+DVR_PRUNE_INTERVAL = 60.0
+INDEX_FILE = "index.tsv"
+# A gap between consecutive segments longer than this starts a discontinuity (e.g. an FFmpeg restart)
+GAP_TOLERANCE = 1.0
+
+_STREAM_ID = re.compile(r"^[A-Za-z0-9_.-]+$")
+_DAY = re.compile(r"^\d{8}$")
+_HOUR = re.compile(r"^\d{2}$")
+_SEGMENT_NAME = re.compile(r"^(\d+\.(ts|m4s)|init-\d+\.mp4)$")
+_BYTERANGE = re.compile(r"^(\d+)(?:@(\d+))?$")
+_MAP_URI = re.compile(r'URI="([^"]+)"')
+
+# stream_id -> archive, loaded on first use
+_archives: Dict[str, "Archive"] = {}
+_pruner: Optional[asyncio.Task] = None
+
+
+@dataclass
+class LiveSegment:
+    """A segment listed in FFmpeg's live playlist."""
+    sequence: int
+    uri: str
+    duration: float
+    start: Optional[float]  # epoch seconds
+    byterange: Optional[Tuple[int, int]] = None  # (offset, length) within `uri`
+    init: Optional[str] = None  # EXT-X-MAP of fMP4 segments
+
+
+@dataclass
+class ArchivedSegment:
+    sequence: int
+    start: float
+    duration: float
+    uri: str  # relative to the archive: YYYYMMDD/HH/<start ms>.ts
+    discontinuity: bool = False
+    init: Optional[str] = None  # fMP4 init segment, in the same bucket: YYYYMMDD/HH/init-<start ms>.mp4
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+
+def parse_time(value: str) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        return None
+
+
+def parse_live_playlist(text: str) -> List[LiveSegment]:
+    sequence = 0
+    duration = None
+    start = None
+    byterange = None
+    init = None
+    segments: List[LiveSegment] = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            start = parse_time(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            byterange = _BYTERANGE.match(line.split(":", 1)[1].strip())
+        elif line.startswith("#EXT-X-MAP:"):
+            match = _MAP_URI.search(line)
+            init = match.group(1) if match else None
+        elif line and not line.startswith("#") and duration is not None:
+            if start is None and segments and segments[-1].start is not None:
+                start = segments[-1].start + segments[-1].duration
+            segment = LiveSegment(sequence + len(segments), line, duration, start, init=init)
+            if byterange:
+                # Without an offset, the range follows the previous range of the same file
+                previous = segments[-1] if segments and segments[-1].uri == line else None
+                offset = previous.byterange[0] + previous.byterange[1] if previous and previous.byterange else 0
+                if byterange.group(2) is not None:
+                    offset = int(byterange.group(2))
+                segment.byterange = (offset, int(byterange.group(1)))
+            segments.append(segment)
+            duration = None
+            start = None
+            byterange = None
+    return segments
+
+
+def _read_live(path: str) -> List[LiveSegment]:
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            return parse_live_playlist(f.read())
+    except OSError:
+        return []
+
+
+def _bucket(start: float) -> str:
+    return time.strftime("%Y%m%d/%H", time.gmtime(start))
+
+
+def _bucket_end(day: str, hour: str) -> float:
+    start = datetime.strptime(f"{day}{hour}", "%Y%m%d%H").replace(tzinfo=timezone.utc).timestamp()
+    return start + 3600
+
+
+def _copy(source: str, target: str, byterange: Optional[Tuple[int, int]] = None):
+    """Copy a file, or one byte range of it, into place atomically."""
+    if byterange is None:
+        shutil.copyfile(source, f"{target}.tmp")
+    else:
+        offset, length = byterange
+        with open(source, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if len(data) != length:
+            raise OSError(f"{source} ends before byte {offset + length}")
+        with open(f"{target}.tmp", "wb") as f:
+            f.write(data)
+    os.replace(f"{target}.tmp", target)
+
+
+def archive_root(stream_id: str) -> str:
+    if not _STREAM_ID.match(stream_id) or stream_id in (".", ".."):
+        raise ValueError(f"Stream id '{stream_id}' cannot be archived")
+    return os.path.join(DVR_DIR, stream_id)
+
+
+class Archive:
+    """The rolling archive of one stream."""
+
+    def __init__(self, stream_id: str, window: Optional[float] = None):
+        self.stream_id = stream_id
+        self.root = archive_root(stream_id)
+        self.window = DVR_WINDOW_SECONDS if window is None else window
+        # Sorted by start; _starts mirrors _segments for bisect
+        self._starts: List[float] = []
+        self._segments: List[ArchivedSegment] = []
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    @property
+    def last(self) -> Optional[ArchivedSegment]:
+        return self._segments[-1] if self._segments else None
+
+    def load(self) -> "Archive":
+        """Read the bucket indexes from disk (blocking). Only done when an archive is opened."""
+        cutoff = time.time() - self.window
+        try:
+            days = sorted(d for d in os.listdir(self.root) if _DAY.match(d))
+        except FileNotFoundError:
+            return self
+        for day in days:
+            hours = sorted(h for h in os.listdir(os.path.join(self.root, day)) if _HOUR.match(h))
+            for hour in hours:
+                if _bucket_end(day, hour) < cutoff:
+                    continue
+                try:
+                    with open(os.path.join(self.root, day, hour, INDEX_FILE)) as f:
+                        lines = f.read().splitlines()
+                except OSError:
+                    continue
+                for line in lines:
+                    try:
+                        sequence, start, duration, discontinuity, name, *init = line.split("\t")
+                        segment = ArchivedSegment(
+                            int(sequence), float(start), float(duration), f"{day}/{hour}/{name}", discontinuity == "1",
+                            f"{day}/{hour}/{init[0]}" if init and init[0] else None,
+                        )
+                    except ValueError:  # torn last line after a crash
+                        continue
+                    if segment.end >= cutoff and (not self._starts or segment.start > self._starts[-1]):
+                        self._starts.append(segment.start)
+                        self._segments.append(segment)
+        return self
+
+    def _store(
+        self,
+        segment: ArchivedSegment,
+        source: str,
+        byterange: Optional[Tuple[int, int]] = None,
+        init_source: Optional[str] = None,
+    ):
+        """Write the segment (and a new init segment), then its index line (blocking)."""
+        target = os.path.join(self.root, segment.uri)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if init_source and segment.init:
+            init_target = os.path.join(self.root, segment.init)
+            if not os.path.exists(init_target):
+                _copy(init_source, init_target)
+        _copy(source, target, byterange)
+        fields = [
+            str(segment.sequence), f"{segment.start:.3f}", f"{segment.duration:.3f}",
+            str(int(segment.discontinuity)), os.path.basename(target),
+        ]
+        if segment.init:
+            fields.append(os.path.basename(segment.init))
+        line = "\t".join(fields) + "\n"
+        with open(os.path.join(os.path.dirname(target), INDEX_FILE), "a") as f:
+            f.write(line)
+
+    async def add(
+        self, live: LiveSegment, source: str, discontinuity: bool = False, init_source: Optional[str] = None
+    ) -> Optional[ArchivedSegment]:
+        """
+        Archive a completed live segment. Segments not after the newest archived one are skipped.
+        `init_source` is the live fMP4 init segment the segment needs.
+        """
+        last = self.last
+        if live.start is None or (last is not None and live.start <= last.start):
+            return None
+        ext = os.path.splitext(live.uri)[1] or ".ts"
+        bucket = _bucket(live.start)
+        discontinuity = discontinuity or (last is not None and live.start - last.end > GAP_TOLERANCE)
+        init = None
+        if init_source:
+            # A new copy after every discontinuity (FFmpeg restarted) and in every bucket, so
+            # pruning a bucket never removes an init segment later buckets refer to
+            same = last is not None and last.init and not discontinuity and last.init.startswith(f"{bucket}/")
+            init = last.init if same else f"{bucket}/init-{int(live.start * 1000)}.mp4"
+        segment = ArchivedSegment(
+            sequence=last.sequence + 1 if last else 0,
+            start=live.start,
+            duration=live.duration,
+            uri=f"{bucket}/{int(live.start * 1000)}{ext}",
+            discontinuity=discontinuity,
+            init=init,
+        )
+        await asyncio.to_thread(self._store, segment, source, live.byterange, init_source)
+        # The index lists are only changed on the event loop, so readers always see them in step
+        self._starts.append(segment.start)
+        self._segments.append(segment)
+        return segment
+
+    def prune(self, now: Optional[float] = None):
+        """Forget segments that ended before the window."""
+        cutoff = (time.time() if now is None else now) - self.window
+        # Segments are contiguous, so everything starting a segment-duration before the cutoff has ended
+        count = bisect.bisect_left(self._starts, cutoff)
+        while count and self._segments[count - 1].end > cutoff:
+            count -= 1
+        if count:
+            del self._starts[:count]
+            del self._segments[:count]
+
+    def window_segments(self, start: Optional[float], end: Optional[float]) -> List[ArchivedSegment]:
+        """Segments overlapping [start, end), in O(log n) plus the size of the result."""
+        first = 0
+        if start is not None:
+            first = max(0, bisect.bisect_right(self._starts, start) - 1)
+            if first < len(self._segments) and self._segments[first].end <= start:
+                first += 1
+        last = bisect.bisect_left(self._starts, end) if end is not None else len(self._starts)
+        return self._segments[first:last]
+
+    def segment_path(self, day: str, hour: str, name: str) -> Optional[str]:
+        if not (_DAY.match(day) and _HOUR.match(hour) and _SEGMENT_NAME.match(name)):
+            return None
+        return os.path.join(self.root, day, hour, name)
+
+
+def render_playlist(segments: List[ArchivedSegment], ended: bool, prefix: str = "dvr/") -> str:
+    """A VOD playlist (`ended`) or an EVENT playlist that players keep reloading."""
+    target = max((math.ceil(s.duration) for s in segments), default=1)
+    fmp4 = any(s.init for s in segments)
+    lines = [
+        "#EXTM3U",
+        f"#EXT-X-VERSION:{7 if fmp4 else 3}",
+        f"#EXT-X-TARGETDURATION:{target}",
+        f"#EXT-X-MEDIA-SEQUENCE:{segments[0].sequence if segments else 0}",
+        f"#EXT-X-PLAYLIST-TYPE:{'VOD' if ended else 'EVENT'}",
+    ]
+    init = None
+    for i, segment in enumerate(segments):
+        if segment.discontinuity and i:
+            lines.append("#EXT-X-DISCONTINUITY")
+        if segment.init and segment.init != init:
+            lines.append(f'#EXT-X-MAP:URI="{prefix}{segment.init}"')
+            init = segment.init
+        pdt = datetime.fromtimestamp(segment.start, timezone.utc).isoformat(timespec="milliseconds")
+        lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{pdt}")
+        lines.append(f"#EXTINF:{segment.duration:.3f},")
+        lines.append(f"{prefix}{segment.uri}")
+    if ended:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+async def open_archive(stream_id: str, create: bool = False) -> Optional[Archive]:
+    """The archive of a stream, loading its index on first use. None if it has none (and not `create`)."""
+    archive = _archives.get(stream_id)
+    if archive is not None:
+        return archive
+    try:
+        root = archive_root(stream_id)
+    except ValueError:
+        if create:
+            raise
+        return None
+    if not create and not await asyncio.to_thread(os.path.isdir, root):
+        return None
+    archive = await asyncio.to_thread(Archive(stream_id).load)
+    # Another request may have loaded it meanwhile
+    return _archives.setdefault(stream_id, archive)
+
+
+async def follow(
+    playlist_path: str,
+    archives: Callable[[], List[Archive]],
+    segment_written: Callable[[float], Awaitable[bool]],
+    interval: float,
+):
+    """
+    Archive an ingest's segments as they complete, for as long as it runs.
+    `archives` returns the archives of the streams served by the ingest that have DVR enabled.
+    """
+    last_sequence: Optional[int] = None
+    while True:
+        await segment_written(interval)
+        targets = archives()
+        if not targets:
+            last_sequence = None
+            continue
+        live = await asyncio.to_thread(_read_live, playlist_path)
+        if not live:
+            continue
+        if last_sequence is None or live[-1].sequence < last_sequence:
+            # First pass or FFmpeg restarted: start at the live edge
+            new, discontinuity = live[-1:], True
+        else:
+            new, discontinuity = [s for s in live if s.sequence > last_sequence], False
+        for segment in new:
+            source = os.path.join(os.path.dirname(playlist_path), segment.uri)
+            init = os.path.join(os.path.dirname(playlist_path), segment.init) if segment.init else None
+            for archive in targets:
+                try:
+                    await archive.add(segment, source, discontinuity, init)
+                except OSError as e:  # deleted by FFmpeg already, disk full, ...
+                    logger.warning(f"Could not archive {source} for '{archive.stream_id}': {e}")
+            discontinuity = False
+        last_sequence = live[-1].sequence
+
+
+def _remove_expired_buckets(root: str, cutoff: float):
+    try:
+        days = [d for d in os.listdir(root) if _DAY.match(d)]
+    except FileNotFoundError:
+        return
+    for day in days:
+        day_dir = os.path.join(root, day)
+        for hour in [h for h in os.listdir(day_dir) if _HOUR.match(h)]:
+            if _bucket_end(day, hour) < cutoff:
+                shutil.rmtree(os.path.join(day_dir, hour), ignore_errors=True)
+        if not os.listdir(day_dir):
+            os.rmdir(day_dir)
+
+
+def sweep(window: Optional[float] = None):
+    """Delete hour buckets that ended before the window, in every archive on disk (blocking)."""
+    cutoff = time.time() - (DVR_WINDOW_SECONDS if window is None else window)
+    try:
+        roots = [e.path for e in os.scandir(DVR_DIR) if e.is_dir()]
+    except FileNotFoundError:
+        return
+    for root in roots:
+        _remove_expired_buckets(root, cutoff)
+
+
+def start_pruner():
+    """Prune open archives and expired buckets on disk every DVR_PRUNE_INTERVAL seconds."""
+    global _pruner
+    if _pruner is None or _pruner.done():
+        _pruner = asyncio.create_task(_prune_forever())
+
+
+def stop_pruner():
+    if _pruner:
+        _pruner.cancel()
+
+
+async def _prune_forever():
+    while True:
+        for archive in list(_archives.values()):
+            archive.prune()
+        try:
+            await asyncio.to_thread(sweep)
+        except OSError as e:
+            logger.warning(f"DVR sweep failed: {e}")
+        await asyncio.sleep(DVR_PRUNE_INTERVAL)
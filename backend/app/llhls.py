@@ -0,0 +1,149 @@
+"""
+Low-Latency HLS packaging.
+
+FFmpeg's HLS muxer cannot emit EXT-X-PART tags, so in low-latency mode it is asked to cut
+short CMAF (fMP4) fragments instead: every fragment becomes an LL-HLS partial segment and
+every `parts_per_segment` consecutive fragments (one GOP) form a parent segment. This module
+reads FFmpeg's fragment playlist and renders the LL-HLS media playlist served to players.
+"""
+import math
+import os
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+PART_SECONDS = float(os.environ.get("LLHLS_PART_TIME", "0.5"))
+PARTS_PLAYLIST = "parts.m3u8"
+INIT_SEGMENT = "init.mp4"
+# Parent segments that keep their EXT-X-PART tags, counted back from the live edge
+PART_SEGMENTS_KEPT = 3
+
+_PART_URI = re.compile(r"part_(\d+)\.m4s$")
+
+
+@dataclass
+class Part:
+    index: int
+    uri: str
+    duration: float
+    program_date_time: Optional[str] = None
+
+
+@dataclass
+class Segment:
+    msn: int
+    parts: List[Part]
+
+    @property
+    def duration(self) -> float:
+        return sum(p.duration for p in self.parts)
+
+
+def parts_per_segment(segment_seconds: float, part_seconds: float = PART_SECONDS) -> int:
+    return max(1, round(segment_seconds / part_seconds))
+
+
+def position(index: int, per_segment: int) -> Tuple[int, int]:
+    """Map a fragment index to its (media sequence number, part number)."""
+    return divmod(index, per_segment)
+
+
+def parse_parts(text: str) -> List[Part]:
+    parts: List[Part] = []
+    duration = None
+    pdt = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+        elif line.startswith("#EXT-X-PROGRAM-DATE-TIME:"):
+            pdt = line.split(":", 1)[1]
+        elif line and not line.startswith("#"):
+            match = _PART_URI.search(line)
+            if match and duration is not None:
+                parts.append(Part(int(match.group(1)), os.path.basename(line), duration, pdt))
+            duration = None
+            pdt = None
+    return parts
+
+
+# path -> ((mtime_ns, size), parts); lets many blocked reloads share one parse per playlist write
+_parse_cache: Dict[str, Tuple[Tuple[int, int], List[Part]]] = {}
+
+
+def read_parts(output_dir: str) -> List[Part]:
+    path = os.path.join(output_dir, PARTS_PLAYLIST)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return []
+    version = (st.st_mtime_ns, st.st_size)
+    cached = _parse_cache.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    try:
+        with open(path, "r") as f:
+            parts = parse_parts(f.read())
+    except OSError:
+        return []
+    _parse_cache[path] = (version, parts)
+    return parts
+
+
+def forget(output_dir: str):
+    _parse_cache.pop(os.path.join(output_dir, PARTS_PLAYLIST), None)
+
+
+def next_start_number(output_dir: str, per_segment: int) -> int:
+    """First fragment number for a restarted FFmpeg, aligned to a new parent segment."""
+    parts = read_parts(output_dir)
+    if not parts:
+        return 0
+    return (parts[-1].index // per_segment + 1) * per_segment
+
+
+def group_segments(parts: List[Part], per_segment: int) -> List[Segment]:
+    segments: List[Segment] = []
+    for part in parts:
+        msn, number = position(part.index, per_segment)
+        if segments and segments[-1].msn == msn:
+            segments[-1].parts.append(part)
+        elif number == 0:
+            segments.append(Segment(msn, [part]))
+        # else: the window starts mid-segment; skip the orphaned tail
+    return segments
+
+
+def segment_uri(msn: int) -> str:
+    return f"llseg_{msn}.m4s"
+
+
+def render_playlist(parts: List[Part], per_segment: int, part_seconds: float = PART_SECONDS) -> str:
+    segments = group_segments(parts, per_segment)
+    complete = [s for s in segments if len(s.parts) == per_segment]
+    target = max([math.ceil(s.duration) for s in complete] + [math.ceil(per_segment * part_seconds)])
+    first_msn = segments[0].msn if segments else 0
+
+    lines = [
+        "#EXTM3U",
+        "#EXT-X-VERSION:9",
+        f"#EXT-X-TARGETDURATION:{target}",
+        f"#EXT-X-PART-INF:PART-TARGET={part_seconds:.3f}",
+        f"#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={3 * part_seconds:.3f}",
+        f"#EXT-X-MEDIA-SEQUENCE:{first_msn}",
+        f'#EXT-X-MAP:URI="{INIT_SEGMENT}"',
+    ]
+    keep_parts_from = segments[-1].msn - PART_SEGMENTS_KEPT if segments else 0
+    for segment in segments:
+        if segment.parts[0].program_date_time:
+            lines.append(f"#EXT-X-PROGRAM-DATE-TIME:{segment.parts[0].program_date_time}")
+        if segment.msn > keep_parts_from:
+            for part in segment.parts:
+                independent = ",INDEPENDENT=YES" if part.index % per_segment == 0 else ""
+                lines.append(f'#EXT-X-PART:DURATION={part.duration:.5f},URI="{part.uri}"{independent}')
+        if len(segment.parts) == per_segment:
+            lines.append(f"#EXTINF:{segment.duration:.5f},")
+            lines.append(segment_uri(segment.msn))
+    if parts:
+        lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part_{parts[-1].index + 1}.m4s"')
+    return "\n".join(lines) + "\n"
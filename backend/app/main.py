@@ -1,9 +1,9 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from .routers import overlays, docs, stream
+from .routers import overlays, docs, stream, hls, assets
+from . import capabilities, cluster, crud, dvr, metrics, storage, stream_manager
 from .stream_manager import STREAMS_BASE_DIR
-from .ffmpeg_finder import find_ffmpeg_installations, is_ffmpeg_working
 import os
 import logging
 
@@ -13,25 +13,27 @@ logger = logging.getLogger(__name__)
 # Create streams directory if it doesn't exist
 os.makedirs(STREAMS_BASE_DIR, exist_ok=True)
 
-# Check FFmpeg availability at startup
-ffmpeg_path = os.getenv("FFMPEG_PATH", "ffmpeg")
-if not is_ffmpeg_working(ffmpeg_path):
-    logger.warning(f"FFmpeg not working at configured path: {ffmpeg_path}")
-    installations = find_ffmpeg_installations()
-    if installations:
-        working_paths = [p for p in installations if is_ffmpeg_working(p)]
-        if working_paths:
-            logger.info(f"Found working FFmpeg at: {working_paths[0]}")
-            logger.info(f"Set FFMPEG_PATH environment variable to use this installation")
-        else:
-            logger.warning(f"Found FFmpeg installations but none are working: {installations}")
-    else:
-        logger.warning("No FFmpeg installations found. Streaming functionality will not work!")
-
-app = FastAPI(title="Livestream Backend", version="0.1.0")
-
-# Mount the directory for serving HLS stream files
-app.mount("/streams", StaticFiles(directory=STREAMS_BASE_DIR), name="streams")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # FFmpeg is looked up in the background; starts that come first wait for it
+    capabilities.start_detection()
+    try:
+        await crud.ensure_indexes()
+    except Exception as e:
+        # Queries still work without the indexes, only slower; don't keep the API down for them
+        logger.warning(f"Could not create overlay indexes: {type(e).__name__}: {e}")
+    storage.start_sweeper(STREAMS_BASE_DIR, cluster.ingest_keys)
+    dvr.start_pruner()
+    cluster.start_renewer()
+    yield
+    await cluster.stop_renewer()
+    storage.stop_sweeper()
+    dvr.stop_pruner()
+
+app = FastAPI(title="Livestream Backend", version="0.1.0", lifespan=lifespan)
+
+# Serve HLS playlists and segments (memory-cached, see segment_cache)
+app.include_router(hls.router)
 
 # CORS (adjust origins in production)
 app.add_middleware(
@@ -42,10 +44,19 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request latency per route and bytes served from /streams; outermost, so it times everything
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.add_collector(stream_manager.collect_metrics)
+
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 app.include_router(overlays.router, prefix="/api")
 app.include_router(docs.router, prefix="/api")
 app.include_router(stream.router, prefix="/api")
+app.include_router(assets.router, prefix="/api")
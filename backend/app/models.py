@@ -1,14 +1,17 @@
-from pydantic import BaseModel, Field
-from typing import Optional
+from pydantic import BaseModel, Field, model_validator
+from typing import List, Optional
 
 class OverlayBase(BaseModel):
     kind: str = Field(..., description="Type of overlay: text|image")
-    content: str = Field(..., description="Text content or image URL/base64")
+    content: str = Field("", description="Text content or image URL/base64 (empty when asset_id is set)")
     x: int = Field(0, ge=0)
     y: int = Field(0, ge=0)
     width: Optional[int] = Field(None, ge=1)
     height: Optional[int] = Field(None, ge=1)
     opacity: float = Field(1.0, ge=0.0, le=1.0)
+    asset_id: Optional[str] = Field(None, description="Uploaded image asset (see /api/assets) shown by image overlays")
+    stream_id: Optional[str] = Field(None, description="Stream (scene) the overlay belongs to; null for unassigned overlays")
+    z_order: int = Field(0, description="Stacking order within the stream; higher values are drawn on top")
 
 class OverlayCreate(OverlayBase):
     pass
@@ -16,5 +19,46 @@ class OverlayCreate(OverlayBase):
 class OverlayUpdate(OverlayBase):
     pass
 
+class OverlayPatch(BaseModel):
+    """Partial update: only the fields present in the request are changed."""
+    kind: Optional[str] = None
+    content: Optional[str] = None
+    x: Optional[int] = Field(None, ge=0)
+    y: Optional[int] = Field(None, ge=0)
+    width: Optional[int] = Field(None, ge=1)
+    height: Optional[int] = Field(None, ge=1)
+    opacity: Optional[float] = Field(None, ge=0.0, le=1.0)
+    asset_id: Optional[str] = None
+    stream_id: Optional[str] = None
+    z_order: Optional[int] = None
+
+    @model_validator(mode="after")
+    def _required_fields_not_null(self):
+        # width/height/asset_id/stream_id may be cleared with null; the other fields always have a value
+        for name in ("kind", "content", "x", "y", "opacity", "z_order"):
+            if name in self.model_fields_set and getattr(self, name) is None:
+                raise ValueError(f"{name} cannot be null")
+        return self
+
+    def changes(self) -> dict:
+        return self.model_dump(exclude_unset=True)
+
 class OverlayDB(OverlayBase):
     id: str
+
+class OverlayBatchPatch(OverlayPatch):
+    id: str
+
+    def changes(self) -> dict:
+        return self.model_dump(exclude_unset=True, exclude={"id"})
+
+class OverlayBatch(BaseModel):
+    create: List[OverlayCreate] = Field(default_factory=list)
+    update: List[OverlayBatchPatch] = Field(default_factory=list, description="Partial updates, by id.")
+    delete: List[str] = Field(default_factory=list)
+
+class OverlayBatchResult(BaseModel):
+    created: List[OverlayDB] = Field(default_factory=list)
+    updated: List[OverlayDB] = Field(default_factory=list)
+    deleted: List[str] = Field(default_factory=list)
+    missing: List[str] = Field(default_factory=list, description="Ids to update or delete that do not exist.")
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Union
+
+from pydantic import TypeAdapter
+
+from .models import OverlayDB
+
+# Bounds how stale a read can be when other workers write to the same database
+OVERLAY_CACHE_TTL = float(os.environ.get("OVERLAY_CACHE_TTL", "5"))
+OVERLAY_CACHE_MAX_ITEMS = int(os.environ.get("OVERLAY_CACHE_MAX_ITEMS", "1024"))
+
+_LIST_ADAPTER = TypeAdapter(List[OverlayDB])
+
+
+class CachedRead:
+    """A cached overlay (or overlay list) with its JSON body and strong ETag, serialized on first use."""
+
+    def __init__(self, value: Union[OverlayDB, List[OverlayDB]]):
+        self.value = value
+        self.fetched_at = time.monotonic()
+        self._body: Optional[bytes] = None
+        self._etag: Optional[str] = None
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            if isinstance(self.value, list):
+                self._body = _LIST_ADAPTER.dump_json(self.value)
+            else:
+                self._body = self.value.model_dump_json().encode()
+        return self._body
+
+    @property
+    def etag(self) -> str:
+        if self._etag is None:
+            self._etag = f'"{hashlib.sha1(self.body).hexdigest()[:20]}"'
+        return self._etag
+
+
+class OverlayCache:
+    """
+    Process-local read-through cache of overlays and of the full overlay list.
+    Writes in this process update it immediately; the TTL covers writes made elsewhere.
+    """
+
+    def __init__(self, max_items: int = OVERLAY_CACHE_MAX_ITEMS, ttl: float = OVERLAY_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        # Bumped on every write, so reads that raced a write don't cache what they loaded
+        self.generation = 0
+        self._items: "OrderedDict[str, CachedRead]" = OrderedDict()
+        self._list: Optional[CachedRead] = None
+        # Per-stream overlay lists
+        self._streams: "OrderedDict[str, CachedRead]" = OrderedDict()
+
+    def _fresh(self, entry: Optional[CachedRead]) -> bool:
+        return entry is not None and time.monotonic() - entry.fetched_at < self.ttl
+
+    def get_item(self, overlay_id: str) -> Optional[CachedRead]:
+        entry = self._items.get(overlay_id)
+        if not self._fresh(entry):
+            self._items.pop(overlay_id, None)
+            return None
+        self._items.move_to_end(overlay_id)
+        return entry
+
+    def put_item(self, overlay: OverlayDB, generation: int) -> CachedRead:
+        entry = CachedRead(overlay)
+        if generation == self.generation:
+            self._store(overlay.id, entry)
+        return entry
+
+    def _store(self, overlay_id: str, entry: CachedRead):
+        self._items[overlay_id] = entry
+        self._items.move_to_end(overlay_id)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get_list(self) -> Optional[CachedRead]:
+        return self._list if self._fresh(self._list) else None
+
+    def put_list(self, overlays: List[OverlayDB], generation: int) -> CachedRead:
+        entry = CachedRead(overlays)
+        if generation == self.generation:
+            self._list = entry
+        return entry
+
+    def get_stream_list(self, stream_id: str) -> Optional[CachedRead]:
+        entry = self._streams.get(stream_id)
+        if not self._fresh(entry):
+            self._streams.pop(stream_id, None)
+            return None
+        self._streams.move_to_end(stream_id)
+        return entry
+
+    def put_stream_list(self, stream_id: str, overlays: List[OverlayDB], generation: int) -> CachedRead:
+        entry = CachedRead(overlays)
+        if generation == self.generation:
+            self._streams[stream_id] = entry
+            self._streams.move_to_end(stream_id)
+            while len(self._streams) > self.max_items:
+                self._streams.popitem(last=False)
+        return entry
+
+    def invalidate(self, overlay_id: str, overlay: Optional[OverlayDB] = None):
+        """Record a write: cache the new version of the overlay (None if deleted) and drop the lists."""
+        self.generation += 1
+        self._list = None
+        # The overlay may have moved between streams, so every stream list is suspect
+        self._streams.clear()
+        self._items.pop(overlay_id, None)
+        if overlay is not None:
+            self._store(overlay_id, CachedRead(overlay))
+
+    def clear(self):
+        self.generation += 1
+        self._list = None
+        self._streams.clear()
+        self._items.clear()
+
+
+cache = OverlayCache()
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import uuid
+from collections import deque
+from dataclasses import asdict, dataclass
+from typing import Deque, List, Optional
+
+# Deltas kept for reconnecting clients; older clients get a fresh snapshot instead
+OVERLAY_FEED_HISTORY = int(os.environ.get("OVERLAY_FEED_HISTORY", "1000"))
+
+
+@dataclass
+class OverlayChange:
+    version: int
+    op: str  # create|update|delete
+    id: str
+    overlay: Optional[dict] = None  # the overlay after the change; None for deletes
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class OverlayFeed:
+    """
+    Monotonically versioned log of overlay changes. Every change gets the next version;
+    subscribers ask for the changes after the last version they applied.
+    Versions are only meaningful within one process, so cursors handed to clients carry
+    the feed's epoch as well.
+    """
+
+    def __init__(self, history: int = OVERLAY_FEED_HISTORY):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self._changes: Deque[OverlayChange] = deque(maxlen=history)
+        self._changed = asyncio.Event()
+
+    def publish(self, op: str, overlay_id: str, overlay: Optional[dict] = None) -> OverlayChange:
+        self.version += 1
+        change = OverlayChange(self.version, op, overlay_id, overlay)
+        self._changes.append(change)
+        # Wake current waiters, then start a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+        return change
+
+    def reset(self):
+        """Forget the retained changes (e.g. after missing some), forcing subscribers to resync."""
+        self._changes.clear()
+        self.version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def cursor(self, version: int) -> str:
+        return f"{self.epoch}:{version}"
+
+    def parse_cursor(self, cursor: str) -> Optional[int]:
+        """The version of a cursor issued by this feed, or None for foreign or malformed cursors."""
+        epoch, _, version = cursor.partition(":")
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def since(self, version: int) -> Optional[List[OverlayChange]]:
+        """
+        Changes after `version`, oldest first. None if some of them are no longer retained,
+        in which case the client must resync from a snapshot.
+        """
+        if version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if not self._changes or self._changes[0].version > version + 1:
+            return None
+        return [c for c in self._changes if c.version > version]
+
+    async def wait(self, version: int, timeout: float) -> bool:
+        """Wait until there are changes after `version`. Returns False on timeout."""
+        if self.version > version:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+feed = OverlayFeed()
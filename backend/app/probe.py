@@ -0,0 +1,168 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from . import capabilities
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Unset: the ffprobe installed next to the FFmpeg that capabilities resolved
+FFPROBE_PATH = os.getenv("FFPROBE_PATH")
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", "15"))
+PROBE_SECONDS = float(os.environ.get("PROBE_SECONDS", "6"))
+PROBE_CACHE_TTL = float(os.environ.get("PROBE_CACHE_TTL", "3600"))
+# Longest source GOP accepted for remuxing, as a multiple of the HLS segment duration
+REMUX_MAX_GOP_FACTOR = float(os.environ.get("REMUX_MAX_GOP_FACTOR", "2"))
+
+HLS_H264_PROFILES = {"baseline", "constrained baseline", "main", "high"}
+
+
+@dataclass
+class SourceInfo:
+    video_codec: Optional[str]
+    profile: Optional[str]
+    width: Optional[int]
+    height: Optional[int]
+    fps: Optional[float]
+    pix_fmt: Optional[str]
+    gop_seconds: Optional[float]
+    audio_codec: Optional[str]
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio_codec is not None
+
+
+# rtsp_url -> (probed_at, info); failed probes are not cached
+_cache: Dict[str, Tuple[float, SourceInfo]] = {}
+_probes: SingleFlight[Optional[SourceInfo]] = SingleFlight()
+
+
+def _parse_rate(rate: Optional[str]) -> Optional[float]:
+    if not rate or rate == "0/0":
+        return None
+    num, _, den = rate.partition("/")
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def parse_probe(data: dict) -> SourceInfo:
+    streams = data.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    keyframes: List[float] = []
+    for packet in data.get("packets", []):
+        if packet.get("stream_index") == video.get("index") and "K" in packet.get("flags", ""):
+            try:
+                keyframes.append(float(packet["pts_time"]))
+            except (KeyError, ValueError):
+                continue
+    keyframes.sort()
+    intervals = [b - a for a, b in zip(keyframes, keyframes[1:])]
+
+    return SourceInfo(
+        video_codec=video.get("codec_name"),
+        profile=video.get("profile"),
+        width=video.get("width"),
+        height=video.get("height"),
+        fps=_parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate")),
+        pix_fmt=video.get("pix_fmt"),
+        # Worst case interval: a single long GOP produces an over-long segment
+        gop_seconds=max(intervals) if intervals else None,
+        audio_codec=audio.get("codec_name") if audio else None,
+    )
+
+
+def remux_blockers(info: SourceInfo, segment_seconds: float) -> List[str]:
+    """Reasons the source cannot be copied into HLS as-is (empty when remuxing is safe)."""
+    reasons = []
+    if info.video_codec != "h264":
+        reasons.append(f"codec {info.video_codec}")
+    if (info.profile or "").lower() not in HLS_H264_PROFILES:
+        reasons.append(f"profile {info.profile}")
+    if info.pix_fmt not in (None, "yuv420p", "yuvj420p"):
+        reasons.append(f"pixel format {info.pix_fmt}")
+    if info.gop_seconds is None:
+        reasons.append("keyframe interval unknown")
+    elif info.gop_seconds > segment_seconds * REMUX_MAX_GOP_FACTOR:
+        reasons.append(f"keyframe interval {info.gop_seconds:.1f}s")
+    return reasons
+
+
+def ffprobe_path() -> str:
+    """FFPROBE_PATH if set, else the ffprobe beside the resolved FFmpeg (e.g. /opt/ffmpeg/bin/ffprobe)."""
+    if FFPROBE_PATH:
+        return FFPROBE_PATH
+    directory, name = os.path.split(capabilities.ffmpeg_path())
+    if "ffmpeg" not in name:
+        return "ffprobe"
+    return os.path.join(directory, name.replace("ffmpeg", "ffprobe", 1))
+
+
+async def _run_ffprobe(url: str) -> Optional[SourceInfo]:
+    command = [ffprobe_path(), "-v", "error", "-of", "json"]
+    if url.startswith("rtsp"):
+        command += ["-rtsp_transport", "tcp"]
+    command += [
+        "-read_intervals", f"%+{PROBE_SECONDS:g}",
+        "-show_entries",
+        "stream=index,codec_type,codec_name,profile,width,height,avg_frame_rate,r_frame_rate,pix_fmt"
+        ":packet=stream_index,pts_time,flags",
+        url,
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        logger.warning(f"ffprobe could not be started: {e}")
+        return None
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.warning(f"ffprobe timed out after {PROBE_TIMEOUT:.0f}s for {url}")
+        return None
+    except asyncio.CancelledError:
+        # Nobody waits for the probe anymore; don't leave ffprobe connected to the source
+        process.kill()
+        raise
+    if process.returncode != 0:
+        logger.warning(f"ffprobe failed (rc={process.returncode}): {stderr.decode(errors='replace').strip()[:500]}")
+        return None
+    try:
+        return parse_probe(json.loads(stdout))
+    except ValueError as e:
+        logger.warning(f"Unreadable ffprobe output for {url}: {e}")
+        return None
+
+
+async def probe_source(url: str) -> Optional[SourceInfo]:
+    """Probe a source once per PROBE_CACHE_TTL; concurrent callers share one ffprobe run."""
+    cached = _cache.get(url)
+    if cached and time.monotonic() - cached[0] < PROBE_CACHE_TTL:
+        return cached[1]
+    return await _probes.do(url, lambda: _probe(url))
+
+
+async def _probe(url: str) -> Optional[SourceInfo]:
+    info = await _run_ffprobe(url)
+    if info is not None:
+        _cache[url] = (time.monotonic(), info)
+    return info
+
+
+def invalidate(url: str):
+    _cache.pop(url, None)
@@ -0,0 +1,42 @@
+import os
+from typing import Optional, Tuple
+
+try:
+    _CLK_TCK = os.sysconf("SC_CLK_TCK")
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError, OSError):  # non-POSIX platforms
+    _CLK_TCK, _PAGE_SIZE = 100, 4096
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """User + system CPU time of a process from /proc, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, so split after its closing parenthesis
+    fields = data[data.rindex(b")") + 2:].split()
+    return (int(fields[11]) + int(fields[12])) / _CLK_TCK
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/statm", "rb") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def cpu_percent(pid: int, previous: Optional[Tuple[float, float]], now: float) -> Tuple[Optional[float], Optional[Tuple[float, float]]]:
+    """
+    CPU usage since the previous (timestamp, cpu_seconds) sample, in percent of one core.
+    Returns the percentage (None on the first sample) and the new sample to keep.
+    """
+    used = cpu_seconds(pid)
+    if used is None:
+        return None, previous
+    sample = (now, used)
+    if previous is None or now <= previous[0]:
+        return None, sample
+    return 100.0 * (used - previous[1]) / (now - previous[0]), sample
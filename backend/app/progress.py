@@ -0,0 +1,95 @@
+import os
+import re
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterable, List, Optional
+
+# One sample per -stats_period; 120 covers the last two minutes
+PROGRESS_HISTORY = int(os.environ.get("FFMPEG_PROGRESS_HISTORY", "120"))
+
+_BITRATE = re.compile(r"([\d.]+)\s*kbits/s")
+
+
+@dataclass
+class ProgressSample:
+    """One `-progress` block: FFmpeg's counters at a point in time."""
+    time: float  # wall clock
+    frame: Optional[int] = None
+    fps: Optional[float] = None
+    bitrate_kbps: Optional[float] = None
+    total_size: Optional[int] = None
+    out_time: Optional[float] = None  # seconds of output produced
+    dup_frames: Optional[int] = None
+    drop_frames: Optional[int] = None
+    speed: Optional[float] = None
+
+
+def _int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):  # 'N/A' before the first packet
+        return None
+
+
+def parse_block(fields: Dict[str, str], now: Optional[float] = None) -> ProgressSample:
+    """Build a sample from the key=value pairs of one progress block."""
+    bitrate = _BITRATE.match(fields.get("bitrate", ""))
+    out_time_us = _int(fields.get("out_time_us"))
+    return ProgressSample(
+        time=time.time() if now is None else now,
+        frame=_int(fields.get("frame")),
+        fps=_float(fields.get("fps")),
+        bitrate_kbps=float(bitrate.group(1)) if bitrate else None,
+        total_size=_int(fields.get("total_size")),
+        out_time=out_time_us / 1e6 if out_time_us is not None and out_time_us >= 0 else None,
+        dup_frames=_int(fields.get("dup_frames")),
+        drop_frames=_int(fields.get("drop_frames")),
+        speed=_float(fields.get("speed", "").rstrip("x")),
+    )
+
+
+class ProgressParser:
+    """Accumulates `-progress` output lines; every `progress=continue|end` line closes a block."""
+
+    def __init__(self):
+        self._fields: Dict[str, str] = {}
+
+    def feed(self, line: str) -> Optional[ProgressSample]:
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            return None
+        if key != "progress":
+            self._fields[key] = value.strip()
+            return None
+        sample = parse_block(self._fields)
+        self._fields = {}
+        return sample
+
+
+def _values(samples: Iterable[ProgressSample], name: str) -> List[float]:
+    return [v for v in (getattr(s, name) for s in samples) if v is not None]
+
+
+def summarize(samples: List[ProgressSample]) -> dict:
+    """Averages and minimums over the buffered samples, and frames dropped/duplicated within them."""
+    summary = {"window_seconds": round(samples[-1].time - samples[0].time, 1) if samples else 0.0}
+    for name in ("fps", "speed", "bitrate_kbps"):
+        values = _values(samples, name)
+        summary[f"{name}_avg"] = round(sum(values) / len(values), 3) if values else None
+        summary[f"{name}_min"] = round(min(values), 3) if values else None
+    for name in ("drop_frames", "dup_frames"):
+        values = _values(samples, name)
+        # Counters restart with FFmpeg; a drop in the counter starts a new run
+        summary[name] = sum(b - a if b >= a else b for a, b in zip(values, values[1:]))
+    return summary
+
+
+def to_dict(sample: ProgressSample) -> dict:
+    return asdict(sample)
@@ -0,0 +1,306 @@
+"""
+Shared stream registry: which node (uvicorn worker or container) owns which stream.
+
+Ownership is a lease that the owner renews while its FFmpeg runs. A record whose lease expired
+belongs to a node that died, and may be claimed by any other node. Backends:
+
+- memory: a single process (the default; equivalent to having no registry)
+- sqlite: the workers of one host, through a shared database file
+- mongo: any number of hosts, in the application's database
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+STREAM_REGISTRY = os.environ.get("STREAM_REGISTRY", "memory")  # memory|sqlite|mongo
+REGISTRY_SQLITE_PATH = os.path.abspath(os.environ.get(
+    "REGISTRY_SQLITE_PATH", os.path.join(os.path.dirname(__file__), "..", "registry.sqlite3")
+))
+REGISTRY_COLLECTION = "stream_registry"
+
+
+@dataclass
+class StreamRecord:
+    stream_id: str
+    owner: str  # node id
+    lease_expires: float  # epoch seconds
+    spec: dict  # start options, so another node can take the stream over
+    owner_url: Optional[str] = None  # where other nodes can reach the owner, if configured
+    status: Optional[dict] = None  # the owner's last published stream status
+    stop_requested: bool = False
+
+    def alive(self, now: float) -> bool:
+        return self.lease_expires > now
+
+
+class Registry(ABC):
+    """
+    Interface of the backends. Every method is atomic with respect to other nodes.
+    `claim` succeeds if the stream has no record or its lease expired; `renew` and
+    `release` only touch records the given node owns.
+    """
+
+    @abstractmethod
+    async def claim(self, record: StreamRecord, now: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def get(self, stream_id: str) -> Optional[StreamRecord]:
+        ...
+
+    @abstractmethod
+    async def list(self) -> List[StreamRecord]:
+        ...
+
+    @abstractmethod
+    async def renew(self, owner: str, statuses: Dict[str, dict], lease_expires: float) -> Dict[str, bool]:
+        """Extend the leases of `owner`'s streams. Returns {stream_id: stop_requested} of those it still owns."""
+
+    @abstractmethod
+    async def release(self, stream_id: str, owner: str):
+        ...
+
+    @abstractmethod
+    async def request_stop(self, stream_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def expire(self, owner: str):
+        """End all of `owner`'s leases now, so other nodes take its streams over right away."""
+
+
+class MemoryRegistry(Registry):
+    def __init__(self):
+        self._records: Dict[str, StreamRecord] = {}
+
+    async def claim(self, record: StreamRecord, now: float) -> bool:
+        current = self._records.get(record.stream_id)
+        if current is not None and current.alive(now):
+            return False
+        self._records[record.stream_id] = replace(record)
+        return True
+
+    async def get(self, stream_id: str) -> Optional[StreamRecord]:
+        record = self._records.get(stream_id)
+        return replace(record) if record else None
+
+    async def list(self) -> List[StreamRecord]:
+        return [replace(r) for r in self._records.values()]
+
+    async def renew(self, owner: str, statuses: Dict[str, dict], lease_expires: float) -> Dict[str, bool]:
+        owned = {}
+        for stream_id, status in statuses.items():
+            record = self._records.get(stream_id)
+            if record is not None and record.owner == owner:
+                record.lease_expires = lease_expires
+                record.status = status
+                owned[stream_id] = record.stop_requested
+        return owned
+
+    async def release(self, stream_id: str, owner: str):
+        record = self._records.get(stream_id)
+        if record is not None and record.owner == owner:
+            del self._records[stream_id]
+
+    async def request_stop(self, stream_id: str) -> bool:
+        record = self._records.get(stream_id)
+        if record is None:
+            return False
+        record.stop_requested = True
+        return True
+
+    async def expire(self, owner: str):
+        for record in self._records.values():
+            if record.owner == owner:
+                record.lease_expires = 0.0
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS streams (
+    stream_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    owner_url TEXT,
+    lease_expires REAL NOT NULL,
+    spec TEXT NOT NULL,
+    status TEXT,
+    stop_requested INTEGER NOT NULL DEFAULT 0
+)
+"""
+_COLUMNS = "stream_id, owner, owner_url, lease_expires, spec, status, stop_requested"
+
+
+class SqliteRegistry(Registry):
+    """Registry in a SQLite file shared by the workers of one host. Calls run in worker threads."""
+
+    def __init__(self, path: str = REGISTRY_SQLITE_PATH):
+        self.path = path
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        if not self._initialized:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+            self._initialized = True
+        return conn
+
+    async def _run(self, fn, *args):
+        def call():
+            conn = self._connect()
+            try:
+                return fn(conn, *args)
+            finally:
+                conn.close()
+        return await asyncio.to_thread(call)
+
+    @staticmethod
+    def _record(row) -> StreamRecord:
+        stream_id, owner, owner_url, lease_expires, spec, status, stop_requested = row
+        return StreamRecord(
+            stream_id=stream_id,
+            owner=owner,
+            owner_url=owner_url,
+            lease_expires=lease_expires,
+            spec=json.loads(spec),
+            status=json.loads(status) if status else None,
+            stop_requested=bool(stop_requested),
+        )
+
+    async def claim(self, record: StreamRecord, now: float) -> bool:
+        def claim(conn: sqlite3.Connection) -> bool:
+            cursor = conn.execute(
+                f"INSERT INTO streams ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, NULL, 0) "
+                "ON CONFLICT(stream_id) DO UPDATE SET owner=excluded.owner, owner_url=excluded.owner_url, "
+                "lease_expires=excluded.lease_expires, spec=excluded.spec, status=NULL, stop_requested=0 "
+                "WHERE streams.lease_expires <= ?",
+                (record.stream_id, record.owner, record.owner_url, record.lease_expires, json.dumps(record.spec), now),
+            )
+            return cursor.rowcount == 1
+        return await self._run(claim)
+
+    async def get(self, stream_id: str) -> Optional[StreamRecord]:
+        def get(conn: sqlite3.Connection):
+            return conn.execute(f"SELECT {_COLUMNS} FROM streams WHERE stream_id = ?", (stream_id,)).fetchone()
+        row = await self._run(get)
+        return self._record(row) if row else None
+
+    async def list(self) -> List[StreamRecord]:
+        def rows(conn: sqlite3.Connection):
+            return conn.execute(f"SELECT {_COLUMNS} FROM streams").fetchall()
+        return [self._record(row) for row in await self._run(rows)]
+
+    async def renew(self, owner: str, statuses: Dict[str, dict], lease_expires: float) -> Dict[str, bool]:
+        def renew(conn: sqlite3.Connection) -> Dict[str, bool]:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "UPDATE streams SET lease_expires = ?, status = ? WHERE stream_id = ? AND owner = ?",
+                    [(lease_expires, json.dumps(s), stream_id, owner) for stream_id, s in statuses.items()],
+                )
+                rows = conn.execute("SELECT stream_id, stop_requested FROM streams WHERE owner = ?", (owner,)).fetchall()
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            return {stream_id: bool(stop) for stream_id, stop in rows if stream_id in statuses}
+        return await self._run(renew)
+
+    async def release(self, stream_id: str, owner: str):
+        await self._run(lambda conn: conn.execute(
+            "DELETE FROM streams WHERE stream_id = ? AND owner = ?", (stream_id, owner)
+        ))
+
+    async def request_stop(self, stream_id: str) -> bool:
+        def stop(conn: sqlite3.Connection) -> bool:
+            return conn.execute("UPDATE streams SET stop_requested = 1 WHERE stream_id = ?", (stream_id,)).rowcount == 1
+        return await self._run(stop)
+
+    async def expire(self, owner: str):
+        await self._run(lambda conn: conn.execute("UPDATE streams SET lease_expires = 0 WHERE owner = ?", (owner,)))
+
+
+class MongoRegistry(Registry):
+    """Registry in the application's MongoDB, shared by every node. Records are keyed by stream id."""
+
+    async def _collection(self):
+        from .db import get_db
+        return (await get_db()).get_collection(REGISTRY_COLLECTION)
+
+    @staticmethod
+    def _record(doc: dict) -> StreamRecord:
+        return StreamRecord(
+            stream_id=doc["_id"],
+            owner=doc["owner"],
+            owner_url=doc.get("owner_url"),
+            lease_expires=doc["lease_expires"],
+            spec=doc.get("spec", {}),
+            status=doc.get("status"),
+            stop_requested=doc.get("stop_requested", False),
+        )
+
+    async def claim(self, record: StreamRecord, now: float) -> bool:
+        from pymongo.errors import DuplicateKeyError
+        col = await self._collection()
+        fields = {
+            "owner": record.owner,
+            "owner_url": record.owner_url,
+            "lease_expires": record.lease_expires,
+            "spec": record.spec,
+            "status": None,
+            "stop_requested": False,
+        }
+        try:
+            # Matches only an expired record; with a live one the upsert collides on _id and fails
+            await col.update_one(
+                {"_id": record.stream_id, "lease_expires": {"$lte": now}}, {"$set": fields}, upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def get(self, stream_id: str) -> Optional[StreamRecord]:
+        doc = await (await self._collection()).find_one({"_id": stream_id})
+        return self._record(doc) if doc else None
+
+    async def list(self) -> List[StreamRecord]:
+        return [self._record(doc) async for doc in (await self._collection()).find({})]
+
+    async def renew(self, owner: str, statuses: Dict[str, dict], lease_expires: float) -> Dict[str, bool]:
+        from pymongo import UpdateOne
+        col = await self._collection()
+        if statuses:
+            await col.bulk_write([
+                UpdateOne({"_id": stream_id, "owner": owner}, {"$set": {"lease_expires": lease_expires, "status": s}})
+                for stream_id, s in statuses.items()
+            ], ordered=False)
+        owned = {}
+        async for doc in col.find({"owner": owner, "_id": {"$in": list(statuses)}}, {"stop_requested": 1}):
+            owned[doc["_id"]] = doc.get("stop_requested", False)
+        return owned
+
+    async def release(self, stream_id: str, owner: str):
+        await (await self._collection()).delete_one({"_id": stream_id, "owner": owner})
+
+    async def request_stop(self, stream_id: str) -> bool:
+        res = await (await self._collection()).update_one({"_id": stream_id}, {"$set": {"stop_requested": True}})
+        return res.matched_count == 1
+
+    async def expire(self, owner: str):
+        await (await self._collection()).update_many({"owner": owner}, {"$set": {"lease_expires": 0.0}})
+
+
+def create_registry(kind: str = STREAM_REGISTRY) -> Registry:
+    if kind == "memory":
+        return MemoryRegistry()
+    if kind == "sqlite":
+        return SqliteRegistry()
+    if kind == "mongo":
+        return MongoRegistry()
+    raise ValueError(f"Unknown STREAM_REGISTRY '{kind}' (expected memory, sqlite or mongo)")
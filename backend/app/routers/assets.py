@@ -0,0 +1,60 @@
+from fastapi import APIRouter, File, HTTPException, Query, Request, Response, UploadFile
+from fastapi.responses import FileResponse
+from typing import Literal, Optional
+import os
+
+from .. import assets
+from .conditional import not_modified
+
+router = APIRouter(prefix="/assets", tags=["assets"])
+
+# Asset URLs are content-addressed, so a given URL never changes
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def _describe(info: assets.AssetInfo) -> dict:
+    return {
+        "id": info.id,
+        "url": f"/api/assets/{info.id}",
+        "format": info.format,
+        "width": info.width,
+        "height": info.height,
+        "bytes": info.bytes,
+    }
+
+@router.post("", status_code=201)
+async def upload_asset(response: Response, file: UploadFile = File(...)):
+    """
+    Store an image once, keyed by its content hash. Uploading the same bytes again returns
+    the existing asset with status 200.
+    """
+    data = await file.read(assets.ASSET_MAX_BYTES + 1)
+    try:
+        info, created = await assets.store_asset(data)
+    except assets.AssetError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not created:
+        response.status_code = 200
+    return _describe(info)
+
+@router.get("/{asset_id}")
+async def get_asset(
+    request: Request,
+    asset_id: str,
+    w: Optional[int] = Query(None, ge=1, description="Fit within this width."),
+    h: Optional[int] = Query(None, ge=1, description="Fit within this height."),
+    format: Optional[Literal["png", "webp"]] = Query(None, description="Variant format; defaults to the original's."),
+):
+    """Serve an asset, or a resized/re-encoded variant of it (rendered once, then from disk)."""
+    info = await assets.get_asset(asset_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    try:
+        path, media_type = await assets.asset_file(info, w, h, format)
+    except assets.AssetError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Requests rounded to the same variant share its file, and so its ETag
+    etag = f'"{info.id}-{os.path.basename(path)}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL}
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
@@ -0,0 +1,34 @@
+"""
+Conditional GETs shared by the routers: responses carry an ETag, and a request whose
+If-None-Match names the current one gets 304 Not Modified instead of the body.
+"""
+from fastapi import Request, Response
+
+from ..overlay_cache import CachedRead
+
+
+def _opaque(tag: str) -> str:
+    # If-None-Match uses the weak comparison: W/"x" matches "x"
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """
+    Whether the client already has the version `etag` of the resource (RFC 9110 If-None-Match:
+    a list of entity tags, weak or strong, or `*` for any current version).
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return _opaque(etag) in {_opaque(tag) for tag in header.split(",")}
+
+
+def cached_json(request: Request, entry: CachedRead) -> Response:
+    """Send the cached JSON body, or 304 if the client already has this version."""
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if not_modified(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
@@ -10,6 +10,11 @@ async def list_basic():
             "create": "POST /api/overlays",
             "get": "GET /api/overlays/{id}",
             "update": "PUT /api/overlays/{id}",
-            "delete": "DELETE /api/overlays/{id}"
+            "patch": "PATCH /api/overlays/{id}",
+            "batch": "POST /api/overlays/batch",
+            "delete": "DELETE /api/overlays/{id}",
+            "changes": "GET /api/overlays/changes (SSE)",
+            "changes_ws": "WS /api/overlays/ws",
+            "by_stream": "GET /api/streams/{stream_id}/overlays"
         }
     }
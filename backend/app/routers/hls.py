@@ -0,0 +1,335 @@
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import FileResponse, RedirectResponse
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+import asyncio
+import math
+import time
+import mimetypes
+import os
+import re
+
+from .. import cluster, dvr, llhls, stream_manager
+from ..segment_cache import CachedFile, cache
+from .conditional import not_modified
+
+router = APIRouter(prefix="/streams", tags=["hls"])
+
+PLAYLIST_MEDIA_TYPE = "application/vnd.apple.mpegurl"
+SEGMENT_MEDIA_TYPE = "video/mp4"
+MEDIA_TYPES = {
+    ".m3u8": PLAYLIST_MEDIA_TYPE,
+    ".ts": "video/mp2t",
+    ".m4s": SEGMENT_MEDIA_TYPE,
+    ".mp4": SEGMENT_MEDIA_TYPE,
+}
+PLAYLIST_CACHE_CONTROL = "no-cache"
+# Segment names are reused when a stream is started again, so don't mark them immutable
+SEGMENT_CACHE_CONTROL = f"public, max-age={stream_manager.HLS_SEGMENT_SECONDS * 10}"
+
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def _media_type(name: str) -> str:
+    ext = os.path.splitext(name)[1]
+    return MEDIA_TYPES.get(ext) or mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+
+def _viewer(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+
+def _stream_file(stream_id: str, name: str, output_dir: Optional[str] = None) -> str:
+    """
+    Resolve `name` (optionally `rendition/file`) inside the stream's output directory:
+    the ingest's directory for running streams, `STREAMS_BASE_DIR/stream_id` otherwise.
+    """
+    components = [stream_id, *name.split("/")]
+    for part in components:
+        if part in ("", ".", "..") or "\\" in part:
+            raise HTTPException(status_code=404, detail="Not found.")
+    if output_dir is not None:
+        return os.path.join(output_dir, *components[1:])
+    return os.path.join(stream_manager.STREAMS_BASE_DIR, *components)
+
+
+async def _remote_output_dir(stream_id: str) -> Optional[str]:
+    """Output directory another worker of this host publishes for the stream (shared disk)."""
+    record = await cluster.locate(stream_id)
+    return record.status.get("output_dir") if record and record.status else None
+
+
+async def _is_listed(stream: stream_manager.StreamProcess, name: str) -> bool:
+    """Only segments FFmpeg has finished (i.e. listed in the playlist) may be cached."""
+    if name == llhls.INIT_SEGMENT:
+        return True
+    if stream.low_latency:
+        return any(p.uri == name for p in llhls.read_parts(stream.output_dir))
+    # Each ABR rendition lists its own segments in the index.m3u8 next to them
+    directory, _, filename = name.rpartition("/")
+    playlist_name = f"{directory}/index.m3u8" if directory else "index.m3u8"
+    playlist = cache.get(stream.key, playlist_name)
+    if playlist is None:
+        try:
+            playlist = await cache.load(
+                stream.key, playlist_name, os.path.join(stream.output_dir, playlist_name), is_playlist=True
+            )
+        except OSError:
+            return False
+    if playlist is None:
+        return False
+    media = [line for line in playlist.body.splitlines() if line and not line.startswith(b"#")]
+    if stream.byte_ranges and media and media[-1] == filename.encode():
+        # The newest chunk file is still being appended to, whichever of its segments is asked for
+        return False
+    return filename.encode() in media
+
+
+def _byte_range(request: Request, etag: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    The first and last byte of a single-range request, or None to send the whole body
+    (no Range, an outdated If-Range, or several ranges). 416 if the range lies past the end.
+    """
+    header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if not header or (if_range is not None and if_range != etag):
+        return None
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        if last and int(last) < int(first):
+            return None
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(0, size - int(last)), size - 1
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable.", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def _cached_response(request: Request, entry: CachedFile, media_type: str, cache_control: str) -> Response:
+    headers = {"ETag": entry.etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    if not_modified(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    byte_range = _byte_range(request, entry.etag, len(entry.body))
+    if byte_range is None:
+        return Response(entry.body, media_type=media_type, headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(entry.body)}"
+    return Response(entry.body[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+
+async def _serve(request: Request, stream_id: str, name: str) -> Response:
+    """
+    Serve a file from a stream's output directory, from memory when possible.
+    The cache is keyed by ingest, so streams sharing a source share cached segments.
+    Files that cannot be cached go through FileResponse, which uses the server's
+    zero-copy pathsend extension when available. Both answer Range requests, which is how
+    players read the segments of fMP4 chunk files (EXT-X-BYTERANGE).
+    Playlist requests start on-demand streams that are not running. Streams of other
+    nodes are proxied to their owner, or read from the output directory it published.
+    """
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    is_playlist = name.endswith(".m3u8")
+    stream = await stream_manager.open_stream(stream_id, _viewer(request), start=is_playlist)
+    output_dir = stream.output_dir if stream else await _remote_output_dir(stream_id)
+    path = _stream_file(stream_id, name, output_dir)
+    media_type = _media_type(name)
+    cache_control = PLAYLIST_CACHE_CONTROL if is_playlist else SEGMENT_CACHE_CONTROL
+
+    entry = None
+    if stream:
+        entry = cache.get_current(stream.key, name, path) if is_playlist else cache.get(stream.key, name)
+    if entry is None and stream and (is_playlist or await _is_listed(stream, name)):
+        try:
+            entry = await cache.load(stream.key, name, path, is_playlist=is_playlist)
+        except OSError:
+            raise HTTPException(status_code=404, detail="Not found.")
+    if entry is None:
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="Not found.")
+        if stream and stream.byte_ranges and not is_playlist:
+            # A chunk that is still growing: shared caches must not keep a truncated copy
+            cache_control = PLAYLIST_CACHE_CONTROL
+        return FileResponse(path, media_type=media_type, headers={"Cache-Control": cache_control})
+    return _cached_response(request, entry, media_type, cache_control)
+
+
+async def _low_latency_stream(request: Request, stream_id: str, start: bool = False) -> stream_manager.StreamProcess:
+    stream = await stream_manager.open_stream(stream_id, _viewer(request), start=start)
+    if not stream or not stream.low_latency:
+        raise HTTPException(status_code=404, detail=f"Low-latency stream '{stream_id}' not found.")
+    return stream
+
+
+async def _wait_for_part(stream: stream_manager.StreamProcess, index: int, timeout: float) -> List[llhls.Part]:
+    """Hold the request until fragment `index` is listed, or raise 503 after `timeout`."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    parts = llhls.read_parts(stream.output_dir)
+    while not parts or parts[-1].index < index:
+        remaining = deadline - loop.time()
+        if remaining <= 0 or not await stream_manager.wait_for_segment(stream, remaining):
+            raise HTTPException(status_code=503, detail="Requested part is not available yet.")
+        parts = llhls.read_parts(stream.output_dir)
+    return parts
+
+
+@router.get("/{stream_id}/llhls.m3u8")
+async def low_latency_playlist(
+    request: Request,
+    stream_id: str,
+    msn: Optional[int] = Query(None, alias="_HLS_msn", ge=0),
+    part: Optional[int] = Query(None, alias="_HLS_part", ge=0),
+):
+    """
+    LL-HLS media playlist with blocking reload: with `_HLS_msn` (and optionally `_HLS_part`)
+    the response is held until the playlist contains that segment or part.
+    """
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    stream = await _low_latency_stream(request, stream_id, start=True)
+    per_segment = stream_manager.parts_per_segment()
+    parts = llhls.read_parts(stream.output_dir)
+    if part is not None and msn is None:
+        raise HTTPException(status_code=400, detail="_HLS_part requires _HLS_msn.")
+    if msn is not None:
+        if part is not None and part >= per_segment:
+            raise HTTPException(status_code=400, detail="_HLS_part is out of range.")
+        if parts and msn > llhls.position(parts[-1].index, per_segment)[0] + 2:
+            raise HTTPException(status_code=400, detail="_HLS_msn is too far in the future.")
+        # Without _HLS_part the client wants the whole segment
+        wanted = msn * per_segment + (part if part is not None else per_segment - 1)
+        parts = await _wait_for_part(stream, wanted, 3 * stream_manager.HLS_SEGMENT_SECONDS)
+    if not parts:
+        raise HTTPException(status_code=404, detail="Playlist not available yet.")
+    return Response(
+        llhls.render_playlist(parts, per_segment),
+        media_type=PLAYLIST_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.get("/{stream_id}/part_{index}.m4s")
+async def low_latency_part(request: Request, stream_id: str, index: int):
+    """Serve a partial segment, holding requests for the preload-hinted part until it is complete."""
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    stream = await _low_latency_stream(request, stream_id)
+    parts = llhls.read_parts(stream.output_dir)
+    if parts and index == parts[-1].index + 1:
+        await _wait_for_part(stream, index, 3 * llhls.PART_SECONDS)
+    elif not parts or index > parts[-1].index:
+        raise HTTPException(status_code=404, detail="Part not found.")
+    return await _serve(request, stream_id, f"part_{index}.m4s")
+
+
+def _read_concatenated(paths: List[str]) -> bytes:
+    chunks = []
+    for path in paths:
+        with open(path, "rb") as f:
+            chunks.append(f.read())
+    return b"".join(chunks)
+
+
+@router.get("/{stream_id}/llseg_{msn}.m4s")
+async def low_latency_segment(request: Request, stream_id: str, msn: int):
+    """Serve a parent segment as the concatenation of its CMAF fragments."""
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    stream = await _low_latency_stream(request, stream_id)
+    name = llhls.segment_uri(msn)
+    entry = cache.get(stream.key, name)
+    if entry is None:
+        body = await _concatenate_segment(stream, msn)
+        entry = CachedFile(body, f'"llseg-{msn}-{len(body):x}"')
+        cache.put(stream.key, name, entry)
+    return _cached_response(request, entry, SEGMENT_MEDIA_TYPE, SEGMENT_CACHE_CONTROL)
+
+
+async def _concatenate_segment(stream: stream_manager.StreamProcess, msn: int) -> bytes:
+    per_segment = stream_manager.parts_per_segment()
+    parts = [p for p in llhls.read_parts(stream.output_dir) if p.index // per_segment == msn]
+    if len(parts) != per_segment:
+        raise HTTPException(status_code=404, detail="Segment not found.")
+    paths = [os.path.join(stream.output_dir, p.uri) for p in parts]
+    try:
+        return await asyncio.to_thread(_read_concatenated, paths)
+    except OSError:
+        raise HTTPException(status_code=404, detail="Segment not found.")
+
+
+def _epoch(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+@router.get("/{stream_id}/dvr.m3u8")
+async def dvr_playlist(
+    request: Request,
+    stream_id: str,
+    start: Optional[datetime] = Query(None, alias="from", description="Window start (ISO 8601 or epoch seconds; UTC if no offset)."),
+    end: Optional[datetime] = Query(None, alias="to", description="Window end; omit to follow the live edge."),
+    last: Optional[float] = Query(None, gt=0, description="Window start as seconds before now, instead of `from`."),
+):
+    """
+    Time-shift playlist of a stream's DVR archive. A window with an end in the past is a VOD
+    playlist; an open window is an EVENT playlist that grows as segments are archived.
+    `last` redirects to the same window with an absolute `from`: an EVENT playlist may only
+    grow, so its start must not move with every reload.
+    """
+    if last is not None and start is not None:
+        raise HTTPException(status_code=400, detail="Use either from or last.")
+    archive = await dvr.open_archive(stream_id)
+    if archive is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' has no DVR archive.")
+    now = time.time()
+    window_start = now - last if last is not None else _epoch(start)
+    window_end = _epoch(end)
+    if window_start is not None and window_end is not None and window_end <= window_start:
+        raise HTTPException(status_code=400, detail="to must be after from.")
+    if last is not None:
+        url = request.url.remove_query_params("last").include_query_params(**{"from": math.floor(window_start)})
+        return RedirectResponse(str(url), status_code=307, headers={"Cache-Control": "no-store"})
+    segments = archive.window_segments(window_start, window_end)
+    if not segments:
+        raise HTTPException(status_code=404, detail="No archived segments in that window.")
+    # Closed only once the archive has caught up with the end of the window
+    ended = window_end is not None and window_end <= archive.last.end
+    return Response(
+        dvr.render_playlist(segments, ended),
+        media_type=PLAYLIST_MEDIA_TYPE,
+        headers={"Cache-Control": "public, max-age=3600" if ended else PLAYLIST_CACHE_CONTROL},
+    )
+
+
+@router.get("/{stream_id}/dvr/{day}/{hour}/{name}")
+async def dvr_segment(stream_id: str, day: str, hour: str, name: str):
+    """Serve an archived segment; its name is its start time, so it never changes."""
+    archive = await dvr.open_archive(stream_id)
+    path = archive.segment_path(day, hour, name) if archive else None
+    if path is None or not await asyncio.to_thread(os.path.isfile, path):
+        raise HTTPException(status_code=404, detail="Not found.")
+    return FileResponse(path, media_type=_media_type(name), headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+@router.get("/{stream_id}/{name}")
+async def stream_file(request: Request, stream_id: str, name: str):
+    """Serve playlists and segments for every stream mode."""
+    return await _serve(request, stream_id, name)
+
+
+@router.get("/{stream_id}/{rendition}/{name}")
+async def rendition_file(request: Request, stream_id: str, rendition: str, name: str):
+    """Serve the playlists and segments of one ABR rendition."""
+    return await _serve(request, stream_id, f"{rendition}/{name}")
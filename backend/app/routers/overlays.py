@@ -1,30 +1,233 @@
-from fastapi import APIRouter, HTTPException
-from typing import List
-from ..models import OverlayCreate, OverlayUpdate, OverlayDB
-from .. import crud
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Header, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Iterable, Literal, Optional
+import json
+from ..models import OverlayBatch, OverlayBatchResult, OverlayCreate, OverlayPatch, OverlayUpdate, OverlayDB
+from ..overlay_feed import feed
+from .. import assets, crud
+from .conditional import cached_json
 
 router = APIRouter(prefix="/overlays", tags=["overlays"])
 
+# Idle subscribers get a keepalive this often, which also detects dead connections
+FEED_KEEPALIVE_SECONDS = 15.0
+
+async def _check_assets(asset_ids: Iterable[Optional[str]]):
+    for asset_id in set(asset_ids) - {None}:
+        if await assets.get_asset(asset_id) is None:
+            raise HTTPException(status_code=400, detail=f"Unknown asset '{asset_id}'")
+
+def _presize(background: BackgroundTasks, overlays: Iterable[Optional[OverlayDB]]):
+    """Render the asset variants matching each overlay's box once the response is sent."""
+    for overlay in overlays:
+        if overlay and overlay.asset_id and (overlay.width or overlay.height):
+            background.add_task(assets.prepare_variants, overlay.asset_id, overlay.width, overlay.height)
+
 @router.post("", response_model=OverlayDB)
-async def create_overlay(payload: OverlayCreate):
-    return await crud.create_overlay(payload)
+async def create_overlay(payload: OverlayCreate, background: BackgroundTasks):
+    await _check_assets([payload.asset_id])
+    created = await crud.create_overlay(payload)
+    _presize(background, [created])
+    return created
+
+MAX_PAGE_SIZE = 1000
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+async def _json_array(items: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    yield b"["
+    separator = b""
+    async for item in items:
+        yield separator + json.dumps(item).encode()
+        separator = b","
+    yield b"]"
+
+async def _json_page(items: AsyncIterator[dict], limit: int) -> AsyncIterator[bytes]:
+    """A page of at most `limit` items; one extra item fetched tells whether there is a next page."""
+    yield b'{"items":['
+    emitted = 0
+    last_id = None
+    has_more = False
+    async for item in items:
+        if emitted == limit:
+            has_more = True
+            break
+        yield (b"," if emitted else b"") + json.dumps(item).encode()
+        emitted += 1
+        last_id = item["id"]
+    yield f'],"next_after":{json.dumps(last_id if has_more else None)}}}'.encode()
+
+async def _ndjson(items: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    async for item in items:
+        yield json.dumps(item).encode() + b"\n"
+
+_OVERLAY_SCHEMA = {"$ref": "#/components/schemas/OverlayDB"}
+# The body is always streamed or pre-serialized, so the schemas are declared rather than inferred
+LIST_RESPONSES = {
+    200: {
+        "description": "All overlays, a page of them, or one overlay per line. Projected with `fields`.",
+        "content": {
+            "application/json": {
+                "schema": {
+                    "oneOf": [
+                        {"type": "array", "items": _OVERLAY_SCHEMA},
+                        {
+                            "type": "object",
+                            "properties": {
+                                "items": {"type": "array", "items": _OVERLAY_SCHEMA},
+                                "next_after": {"type": ["string", "null"]},
+                            },
+                            "required": ["items", "next_after"],
+                        },
+                    ]
+                }
+            },
+            NDJSON_MEDIA_TYPE: {"schema": _OVERLAY_SCHEMA},
+        },
+    }
+}
+
+@router.get("", response_class=Response, responses=LIST_RESPONSES)
+async def list_overlays(
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Page size; enables pagination."),
+    after: Optional[str] = Query(None, description="Return overlays after this id (the previous page's next_after)."),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. 'x,y,kind'. id is always included."),
+    format: Optional[Literal["json", "ndjson"]] = Query(None, description="ndjson streams one overlay per line."),
+):
+    """
+    List overlays. Without parameters the full list is served from the read cache with an ETag.
+    With `limit`, `after`, `fields` or NDJSON output, overlays are streamed in id order as the
+    database returns them; paginated JSON is wrapped as {"items": [...], "next_after": id|null}.
+    """
+    ndjson = format == "ndjson" or (format is None and NDJSON_MEDIA_TYPE in request.headers.get("accept", ""))
+    if limit is None and after is None and fields is None and not ndjson:
+        return cached_json(request, await crud.read_overlays())
+    projection = [f.strip() for f in fields.split(",") if f.strip() and f.strip() != "id"] if fields is not None else None
+    # With a limit, fetch one extra overlay to learn whether another page follows
+    items = crud.iter_overlays(after=after, limit=limit + 1 if limit else None, fields=projection)
+    try:
+        first = await items.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def replay() -> AsyncIterator[dict]:
+        # Errors are reported before the response starts; the rest is streamed
+        if first is None:
+            return
+        yield first
+        async for item in items:
+            yield item
 
-@router.get("", response_model=List[OverlayDB])
-async def list_overlays():
-    return await crud.list_overlays()
+    if ndjson:
+        body = _ndjson(_limited(replay(), limit))
+        return StreamingResponse(body, media_type=NDJSON_MEDIA_TYPE)
+    body = _json_page(replay(), limit) if limit else _json_array(replay())
+    return StreamingResponse(body, media_type="application/json")
+
+async def _limited(items: AsyncIterator[dict], limit: Optional[int]) -> AsyncIterator[dict]:
+    count = 0
+    async for item in items:
+        if limit is not None and count == limit:
+            return
+        count += 1
+        yield item
+
+@router.post("/batch", response_model=OverlayBatchResult)
+async def batch_overlays(payload: OverlayBatch, background: BackgroundTasks):
+    """
+    Create, partially update and delete many overlays in one request (applied in that order).
+    Ids that do not exist are listed in `missing` instead of failing the batch.
+    """
+    await _check_assets([o.asset_id for o in payload.create] + [p.asset_id for p in payload.update])
+    result = await crud.apply_batch(payload)
+    _presize(background, result.created + result.updated)
+    return result
+
+async def _feed_messages(since: Optional[str]) -> AsyncIterator[dict]:
+    """
+    Messages for one subscriber: a snapshot when it cannot catch up from cursor `since`,
+    then every change as it happens. Changes made while the snapshot is read are sent again
+    afterwards, so clients apply them as upserts/deletes by id.
+    """
+    crud.ensure_change_feed()
+    version = feed.parse_cursor(since) if since else None
+    while True:
+        changes = feed.since(version) if version is not None else None
+        if changes is None:
+            version = feed.version
+            overlays = await crud.list_overlays()
+            yield {
+                "type": "snapshot",
+                "version": version,
+                "cursor": feed.cursor(version),
+                "overlays": [o.model_dump() for o in overlays],
+            }
+            continue
+        for change in changes:
+            version = change.version
+            yield {"type": "change", **change.to_dict(), "cursor": feed.cursor(version)}
+        if not changes and not await feed.wait(version, FEED_KEEPALIVE_SECONDS):
+            yield {"type": "keepalive"}
+
+async def _sse(since: Optional[str]) -> AsyncIterator[str]:
+    async for message in _feed_messages(since):
+        if message["type"] == "keepalive":
+            yield ": keepalive\n\n"
+            continue
+        yield f"id: {message['cursor']}\nevent: {message['type']}\ndata: {json.dumps(message)}\n\n"
+
+@router.get("/changes")
+async def overlay_changes(
+    since: Optional[str] = Query(None, description="Cursor of the last change applied."),
+    last_event_id: Optional[str] = Header(None),
+):
+    """
+    Server-sent events feed of overlay changes. Reconnecting clients resume from
+    `Last-Event-ID` (or `since`); clients that fell too far behind get a new snapshot.
+    """
+    return StreamingResponse(
+        _sse(since or last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.websocket("/ws")
+async def overlay_changes_ws(websocket: WebSocket, since: Optional[str] = None):
+    """The overlay change feed over a WebSocket, one JSON message per snapshot/change."""
+    await websocket.accept()
+    try:
+        async for message in _feed_messages(since):
+            await websocket.send_json(message)
+    except WebSocketDisconnect:
+        pass
 
 @router.get("/{overlay_id}", response_model=OverlayDB)
-async def get_overlay(overlay_id: str):
-    ov = await crud.get_overlay(overlay_id)
-    if not ov:
+async def get_overlay(request: Request, overlay_id: str):
+    entry = await crud.read_overlay(overlay_id)
+    if not entry:
         raise HTTPException(status_code=404, detail="Overlay not found")
-    return ov
+    return cached_json(request, entry)
 
 @router.put("/{overlay_id}", response_model=OverlayDB)
-async def update_overlay(overlay_id: str, payload: OverlayUpdate):
+async def update_overlay(overlay_id: str, payload: OverlayUpdate, background: BackgroundTasks):
+    await _check_assets([payload.asset_id])
     updated = await crud.update_overlay(overlay_id, payload)
     if not updated:
         raise HTTPException(status_code=404, detail="Overlay not found")
+    _presize(background, [updated])
+    return updated
+
+@router.patch("/{overlay_id}", response_model=OverlayDB)
+async def patch_overlay(overlay_id: str, payload: OverlayPatch, background: BackgroundTasks):
+    """Change only the fields sent in the request body."""
+    await _check_assets([payload.asset_id])
+    updated = await crud.patch_overlay(overlay_id, payload)
+    if not updated:
+        raise HTTPException(status_code=404, detail="Overlay not found")
+    if {"asset_id", "width", "height"} & payload.model_fields_set:
+        _presize(background, [updated])
     return updated
 
 @router.delete("/{overlay_id}")
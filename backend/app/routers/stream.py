@@ -1,41 +1,189 @@
-from fastapi import APIRouter, HTTPException, Body
+from fastapi import APIRouter, HTTPException, Body, Query, Request, Response
 from pydantic import BaseModel, Field
-from typing import Dict
+from typing import Dict, List, Literal, Optional
 
-from .. import stream_manager
+from .. import capabilities, cluster, crud, snapshot, storage, stream_manager
+from ..models import OverlayDB
+from .conditional import cached_json, not_modified
 
 router = APIRouter(prefix="/streams", tags=["streaming"])
 
 class StreamRequest(BaseModel):
     stream_id: str = Field(..., description="A unique identifier for the stream, e.g., 'camera-1'.")
     rtsp_url: str = Field(..., description="The full RTSP URL of the source stream.")
+    low_latency: bool = Field(False, description="Produce Low-Latency HLS (CMAF parts, blocking playlist reload).")
+    abr: bool = Field(False, description="Encode the configured adaptive bitrate ladder (HLS_ABR_LADDER).")
+    audio: bool = Field(True, description="Whether the source carries an audio track (used when probing fails).")
+    mode: Literal["auto", "transcode", "remux"] = Field(
+        "auto", description="auto remuxes sources whose H.264 is already HLS-compatible and transcodes the rest."
+    )
+    on_demand: bool = Field(False, description="Register only; FFmpeg starts on the first playlist request and stops when idle.")
+    idle_timeout: Optional[float] = Field(
+        None, gt=0, description="Seconds without viewers before an on-demand stream is stopped (ON_DEMAND_IDLE_TIMEOUT)."
+    )
+    segment_format: Optional[Literal["ts", "fmp4"]] = Field(
+        None, description="MPEG-TS segment files, or fMP4/CMAF chunks with byte-range playlists (HLS_SEGMENT_FORMAT)."
+    )
+    burn_in: bool = Field(False, description="Render the overlays into the video; changes show up without a restart.")
+    dvr: bool = Field(False, description="Keep completed segments in a rolling archive (DVR_WINDOW_SECONDS) for time-shift playback.")
 
-@router.post("/start", status_code=201)
-async def start_new_stream(payload: StreamRequest):
+MAX_WAIT_SECONDS = 60
+
+@router.post("/start", status_code=202)
+async def start_new_stream(
+    payload: StreamRequest,
+    wait: float = Query(0, ge=0, le=MAX_WAIT_SECONDS, description="Seconds to wait for the first segment."),
+):
     """
     Start a new RTSP to HLS stream conversion.
+    Returns immediately with the stream state; poll the status URL to follow readiness.
+    On-demand streams are only registered and report the state 'idle'.
+    The stream is claimed in the stream registry first; 409 if another node runs it.
     """
-    hls_url = await stream_manager.start_stream(payload.stream_id, payload.rtsp_url)
+    spec = dict(
+        rtsp_url=payload.rtsp_url,
+        on_demand=payload.on_demand,
+        idle_timeout=payload.idle_timeout,
+        low_latency=payload.low_latency,
+        adaptive=payload.abr,
+        has_audio=payload.audio,
+        mode=payload.mode,
+        segment_format=payload.segment_format,
+        burn_in=payload.burn_in,
+        archive=payload.dvr,
+    )
+    try:
+        hls_url = await cluster.start_stream(payload.stream_id, spec)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except cluster.OwnedElsewhere as e:
+        raise HTTPException(status_code=409, detail=f"{e}.")
     if not hls_url:
+        raise HTTPException(status_code=409, detail=f"Stream '{payload.stream_id}' is already running.")
+    status = await stream_manager.wait_for_stream(payload.stream_id, timeout=wait)
+    return {
+        "stream_id": payload.stream_id,
+        "hls_url": hls_url,
+        "state": status["state"] if status else "failed",
+        "status_url": f"/api/streams/{payload.stream_id}/status",
+    }
+
+@router.get("/{stream_id}/status", response_model=dict)
+async def get_stream_status(
+    request: Request,
+    stream_id: str,
+    wait: float = Query(0, ge=0, le=MAX_WAIT_SECONDS, description="Long-poll while the stream is starting."),
+):
+    """
+    Get the state of a stream (starting|queued|ready|restarting|failed) and the node running it.
+    With `wait`, the request is held until the stream becomes ready or fails.
+    Streams of other nodes are proxied to their owner, or reported as last published.
+    """
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    status = await cluster.stream_status(stream_id, wait)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found.")
+    return status
+
+@router.get("/{stream_id}/stats", response_model=dict)
+async def get_stream_stats(
+    request: Request,
+    stream_id: str,
+    limit: Optional[int] = Query(None, ge=0, description="Return only the newest samples."),
+):
+    """
+    FFmpeg progress of a running stream: fps, speed, bitrate, dropped/duplicated frames and
+    output time, sampled every second into a fixed-size ring buffer, plus a summary.
+    """
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    stats = stream_manager.get_stream_stats(stream_id, limit=limit)
+    if stats is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' is not running.")
+    return stats
+
+@router.get("/{stream_id}/snapshot")
+async def get_stream_snapshot(
+    request: Request,
+    stream_id: str,
+    width: Optional[int] = Query(None, gt=0, le=snapshot.SNAPSHOT_MAX_WIDTH, description="Scale to this width."),
+    format: Literal["jpeg", "webp"] = Query("jpeg", description="Image format."),
+):
+    """
+    A still of a running stream for thumbnails: the keyframe that starts its newest segment,
+    decoded from disk (no new RTSP session) once per segment and cached until the next one.
+    Does not count as a viewer of on-demand streams; 503 until the first segment exists.
+    """
+    proxied = await cluster.forward(request, stream_id)
+    if proxied is not None:
+        return proxied
+    stream = stream_manager.get_stream(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' is not running.")
+    try:
+        image = await snapshot.get_snapshot(stream, width, format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except snapshot.SnapshotUnavailable as e:
         raise HTTPException(
-            status_code=500,
-            detail="Failed to start stream. Ensure FFmpeg is installed and the RTSP URL is valid."
+            status_code=503,
+            detail=f"No snapshot of '{stream_id}' yet: {e}",
+            headers={"Retry-After": str(stream_manager.HLS_SEGMENT_SECONDS)},
         )
-    return {"stream_id": payload.stream_id, "hls_url": hls_url}
+    headers = {"ETag": image.etag, "Cache-Control": f"public, max-age={stream_manager.HLS_SEGMENT_SECONDS}"}
+    if not_modified(request, image.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(image.body, media_type=image.content_type, headers=headers)
+
+@router.get("/{stream_id}/overlays", response_model=List[OverlayDB])
+async def get_stream_overlays(stream_id: str, request: Request):
+    """
+    The overlays of one stream, in drawing order (ascending z_order).
+    Served from an indexed lookup; supports conditional GETs like /api/overlays.
+    """
+    return cached_json(request, await crud.read_stream_overlays(stream_id))
 
 @router.post("/stop/{stream_id}", status_code=200)
 async def stop_existing_stream(stream_id: str):
     """
-    Stop a running stream conversion.
+    Stop a running stream conversion. A stream another node runs is stopped by its owner
+    within a lease renewal interval; the status is then 'stopping'.
     """
-    success = await stream_manager.stop_stream(stream_id)
-    if not success:
+    result = await cluster.stop_stream(stream_id)
+    if result is None:
         raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found or already stopped.")
-    return {"status": "stopped", "stream_id": stream_id}
+    return {"status": result, "stream_id": stream_id}
+
+@router.get("/storage", response_model=dict)
+async def get_storage_usage():
+    """
+    Disk (or tmpfs) usage of the stream output directory, per ingest, with the retention limits
+    the storage sweeper enforces.
+    """
+    return await storage.usage(stream_manager.STREAMS_BASE_DIR, await cluster.ingest_keys())
+
+@router.get("/capacity", response_model=dict)
+async def get_capacity():
+    """
+    CPU admission state of this node: capacity and committed cores, queued starts and core pinning.
+    """
+    return stream_manager.get_capacity()
+
+@router.get("/ffmpeg", response_model=dict)
+async def get_ffmpeg_capabilities():
+    """
+    The FFmpeg this node uses: resolved binary, version, encoders, muxers, filters and hwaccels.
+    Detected once after startup; `path` is null if no working FFmpeg was found.
+    """
+    return (await capabilities.get_capabilities()).to_dict()
 
 @router.get("/active", response_model=Dict[str, dict])
 async def get_active_streams():
     """
-    Get a list of all currently active streams.
+    Get a list of all currently active streams, including idle on-demand streams,
+    on every node of the stream registry.
     """
-    return stream_manager.get_active_streams()
+    return await cluster.active_streams()
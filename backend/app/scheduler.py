@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import math
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# off: no limit (costs are still tracked); reject: fail starts that do not fit;
+# queue: hold them until capacity frees. Limiting is opt-in, so existing deployments keep starting
+ADMISSION_POLICY = os.environ.get("ADMISSION_POLICY", "off")
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "300"))
+# Fraction of the node's cores that transcodes may use; the rest is left for the API and OS
+CPU_HEADROOM = float(os.environ.get("CPU_HEADROOM", "0.85"))
+CPU_PINNING = os.environ.get("FFMPEG_CPU_PINNING", "0") == "1"
+
+# Cost model, in cores. Rough x264 veryfast/zerolatency figures; tune per node type.
+TRANSCODE_PIXELS_PER_CORE = float(os.environ.get("TRANSCODE_PIXELS_PER_CORE", str(30e6)))
+DECODE_PIXELS_PER_CORE = float(os.environ.get("DECODE_PIXELS_PER_CORE", str(200e6)))
+REMUX_COST = float(os.environ.get("REMUX_COST", "0.05"))
+DEFAULT_SOURCE_SIZE = (1920, 1080)
+
+
+def _available_cpus() -> List[int]:
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not available on Windows/macOS
+        return list(range(os.cpu_count() or 1))
+
+
+def estimate_cost(
+    mode: str,
+    fps: float,
+    source_size: Optional[tuple] = None,
+    renditions: Optional[List[tuple]] = None,
+) -> float:
+    """
+    Estimated cores for one stream. `renditions` lists the (width, height) of every encode;
+    a single-rendition transcode encodes at the source size.
+    """
+    if mode == "remux":
+        return REMUX_COST
+    width, height = source_size or DEFAULT_SOURCE_SIZE
+    decode = width * height * fps / DECODE_PIXELS_PER_CORE
+    encodes = renditions or [(width, height)]
+    encode = sum(w * h * fps for w, h in encodes) / TRANSCODE_PIXELS_PER_CORE
+    return round(decode + encode, 3)
+
+
+@dataclass
+class Allocation:
+    cost: float
+    cpus: List[int] = field(default_factory=list)
+
+    @property
+    def threads(self) -> Optional[int]:
+        return len(self.cpus) or None
+
+
+class CapacityError(Exception):
+    pass
+
+
+class Scheduler:
+    """Tracks the estimated CPU committed to running FFmpeg processes on this node."""
+
+    def __init__(self, cpus: List[int], headroom: float = CPU_HEADROOM, pinning: bool = CPU_PINNING):
+        self.cpus = cpus
+        self.capacity = round(len(cpus) * headroom, 3)
+        self.pinning = pinning
+        self.used = 0.0
+        self.queued = 0
+        self._core_load: Dict[int, float] = {cpu: 0.0 for cpu in cpus}
+        self._released = asyncio.Event()
+
+    def try_admit(self, cost: float) -> Optional[Allocation]:
+        # A stream bigger than the whole node still runs when the node is otherwise idle
+        if self.used > 0 and self.used + cost > self.capacity:
+            return None
+        return self._reserve(cost)
+
+    def _reserve(self, cost: float) -> Allocation:
+        self.used = round(self.used + cost, 3)
+        allocation = Allocation(cost)
+        if self.pinning:
+            count = min(len(self.cpus), max(1, math.ceil(cost)))
+            allocation.cpus = sorted(sorted(self.cpus, key=lambda c: self._core_load[c])[:count])
+            for cpu in allocation.cpus:
+                self._core_load[cpu] += cost / count
+        return allocation
+
+    async def admit(self, cost: float, on_queued=None) -> Allocation:
+        """
+        Reserve capacity for a stream, waiting for it under the 'queue' policy.
+        `on_queued` is called once if the stream has to wait. Raises CapacityError.
+        """
+        policy = ADMISSION_POLICY
+        if policy == "off":
+            return self._reserve(cost)
+        allocation = self.try_admit(cost)
+        if allocation or policy != "queue":
+            if allocation is None:
+                raise CapacityError(f"needs {cost:.2f} cores, {self.capacity - self.used:.2f} of {self.capacity:.2f} free")
+            return allocation
+        if on_queued:
+            on_queued()
+        loop = asyncio.get_running_loop()
+        timeout = ADMISSION_QUEUE_TIMEOUT
+        deadline = loop.time() + timeout
+        self.queued += 1
+        try:
+            while allocation is None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise CapacityError(f"no capacity for {cost:.2f} cores within {timeout:.0f}s")
+                try:
+                    await asyncio.wait_for(self._released.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+                allocation = self.try_admit(cost)
+        finally:
+            self.queued -= 1
+        return allocation
+
+    def release(self, allocation: Allocation):
+        self.used = max(0.0, round(self.used - allocation.cost, 3))
+        for cpu in allocation.cpus:
+            self._core_load[cpu] = max(0.0, self._core_load[cpu] - allocation.cost / len(allocation.cpus))
+        self._released.set()
+        self._released = asyncio.Event()
+
+    def pin(self, pid: int, allocation: Allocation):
+        """Restrict every thread of a running process to the allocation's cores (Linux only)."""
+        if not allocation.cpus or not hasattr(os, "sched_setaffinity"):
+            return
+        try:
+            tids = [int(t) for t in os.listdir(f"/proc/{pid}/task")]
+        except OSError:
+            tids = [pid]
+        for tid in tids:
+            try:
+                os.sched_setaffinity(tid, allocation.cpus)
+            except OSError as e:
+                logger.warning(f"Could not pin thread {tid} of PID {pid}: {e}")
+
+    def snapshot(self) -> dict:
+        return {
+            "policy": ADMISSION_POLICY,
+            "capacity_cores": self.capacity,
+            "used_cores": self.used,
+            "free_cores": round(max(0.0, self.capacity - self.used), 3),
+            "queued": self.queued,
+            "pinning": self.pinning,
+            "core_load": {str(cpu): round(load, 3) for cpu, load in self._core_load.items()} if self.pinning else None,
+        }
+
+
+scheduler = Scheduler(_available_cpus())
@@ -0,0 +1,138 @@
+import asyncio
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+from .singleflight import SingleFlight
+
+CACHE_MAX_BYTES = int(os.environ.get("HLS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+CACHE_SEGMENTS_PER_STREAM = int(os.environ.get("HLS_CACHE_SEGMENTS", "12"))
+# Files larger than this are never cached (served straight from disk)
+CACHE_MAX_FILE_BYTES = int(os.environ.get("HLS_CACHE_MAX_FILE_BYTES", str(16 * 1024 * 1024)))
+
+
+@dataclass
+class CachedFile:
+    body: bytes
+    etag: str
+    # (st_mtime_ns, st_size) of the file it was read from
+    version: Optional[Tuple[int, int]] = None
+
+
+def _read_file(path: str) -> Optional[CachedFile]:
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size > CACHE_MAX_FILE_BYTES:
+            return None
+        body = f.read()
+    return CachedFile(body, f'"{st.st_mtime_ns:x}-{st.st_size:x}"', (st.st_mtime_ns, st.st_size))
+
+
+class SegmentCache:
+    """
+    Bounded in-memory cache of the current playlists and most recent segments of each stream.
+
+    Segments are immutable once FFmpeg lists them, so they are only evicted (LRU, per-stream
+    count and global byte limits). Playlists are rewritten in place and are invalidated by
+    the stream supervisor whenever FFmpeg moves on to a new segment.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES, segments_per_stream: int = CACHE_SEGMENTS_PER_STREAM):
+        self.max_bytes = max_bytes
+        self.segments_per_stream = segments_per_stream
+        self._entries: "OrderedDict[Tuple[str, str], CachedFile]" = OrderedDict()
+        self._segments: Dict[str, "OrderedDict[str, None]"] = {}
+        self._playlists: Dict[str, Set[str]] = {}
+        self._bytes = 0
+        self._loading: SingleFlight[Optional[CachedFile]] = SingleFlight()
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, stream_id: str, name: str) -> Optional[CachedFile]:
+        key = (stream_id, name)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def get_current(self, stream_id: str, name: str, path: str) -> Optional[CachedFile]:
+        """
+        Like get(), for files rewritten in place (playlists): the entry only counts while `path`
+        still has the mtime and size it was read with, whatever order FFmpeg's events came in.
+        """
+        entry = self.get(stream_id, name)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or (st.st_mtime_ns, st.st_size) != entry.version:
+            self._remove((stream_id, name))
+            return None
+        return entry
+
+    def _remove(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= len(entry.body)
+        stream_id, name = key
+        segments = self._segments.get(stream_id)
+        if segments is not None:
+            segments.pop(name, None)
+            if not segments:
+                del self._segments[stream_id]
+        playlists = self._playlists.get(stream_id)
+        if playlists is not None:
+            playlists.discard(name)
+            if not playlists:
+                del self._playlists[stream_id]
+
+    def put(self, stream_id: str, name: str, entry: CachedFile, is_playlist: bool = False):
+        key = (stream_id, name)
+        self._remove(key)
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        if is_playlist:
+            self._playlists.setdefault(stream_id, set()).add(name)
+        else:
+            segments = self._segments.setdefault(stream_id, OrderedDict())
+            segments[name] = None
+            while len(segments) > self.segments_per_stream:
+                self._remove((stream_id, next(iter(segments))))
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    async def load(self, stream_id: str, name: str, path: str, is_playlist: bool = False) -> Optional[CachedFile]:
+        """
+        Read a file off the event loop and cache it; concurrent misses share one read.
+        Returns None for files too large to cache, which should be served from disk.
+        """
+        return await self._loading.do((stream_id, name), lambda: self._load(stream_id, name, path, is_playlist))
+
+    async def _load(self, stream_id: str, name: str, path: str, is_playlist: bool) -> Optional[CachedFile]:
+        entry = await asyncio.to_thread(_read_file, path)
+        # An invalidation may have raced the read; only keep the result if still wanted
+        if entry is not None and self._loading.is_current((stream_id, name)):
+            self.put(stream_id, name, entry, is_playlist=is_playlist)
+        return entry
+
+    def invalidate_playlists(self, stream_id: str):
+        for name in list(self._playlists.get(stream_id, ())):
+            self._remove((stream_id, name))
+        for key in [k for k in self._loading if k[0] == stream_id and k[1].endswith(".m3u8")]:
+            self._loading.forget(key)
+
+    def drop_stream(self, stream_id: str):
+        names = list(self._playlists.get(stream_id, ())) + list(self._segments.get(stream_id, ()))
+        for name in names:
+            self._remove((stream_id, name))
+        for key in [k for k in self._loading if k[0] == stream_id]:
+            self._loading.forget(key)
+
+
+cache = SegmentCache()
@@ -0,0 +1,67 @@
+"""
+Single-flight: concurrent callers asking for the same key share one run of the work (an
+ffprobe, a decode, a file read) instead of each starting their own.
+
+The work runs as a task of its own, shielded from its callers: a caller that is cancelled
+(e.g. its client disconnected) only stops waiting, and the others still get the result.
+Once every caller has gone, the work is cancelled, so it can kill the subprocess it started.
+"""
+import asyncio
+from typing import Any, Callable, Coroutine, Dict, Generic, Hashable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+def _retrieve(task: asyncio.Task):
+    # Callers re-raise the exception; this only silences "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight(Generic[T]):
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    async def do(self, key: Hashable, work: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        """The result of `work()`, run once for all concurrent callers with the same key."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight(asyncio.create_task(work()))
+            flight.task.add_done_callback(_retrieve)
+            flight.task.add_done_callback(lambda task: self._finished(key, flight))
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Nobody wants the result anymore
+                flight.task.cancel()
+
+    def _finished(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def is_current(self, key: Hashable) -> bool:
+        """
+        Called from within the work: whether it is still the flight for `key`, i.e. it was not
+        forgotten meanwhile and its result may be cached.
+        """
+        flight = self._flights.get(key)
+        return flight is not None and flight.task is asyncio.current_task()
+
+    def forget(self, key: Hashable):
+        """Let the next caller start new work; callers already waiting still get the old result."""
+        self._flights.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._flights
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._flights))
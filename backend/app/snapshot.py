@@ -0,0 +1,221 @@
+"""
+Still frames of running streams for thumbnail grids. The keyframe that starts the newest
+segment FFmpeg has finished is decoded from disk, so no extra RTSP session is opened; the
+result is kept until the next segment, so any number of requests cost one decode per
+segment interval (and one resize per requested width and format).
+"""
+import asyncio
+import io
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, UnidentifiedImageError
+
+from . import capabilities, dvr, llhls, metrics, stream_manager
+from .singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_TIMEOUT = float(os.environ.get("SNAPSHOT_TIMEOUT", "10"))
+SNAPSHOT_MAX_WIDTH = int(os.environ.get("SNAPSHOT_MAX_WIDTH", "1920"))
+# Sized variants kept per ingest for the current segment
+SNAPSHOT_VARIANTS = 16
+JPEG_QUALITY = 80
+WEBP_QUALITY = 80
+
+CONTENT_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+decodes = metrics.Counter("hls_snapshot_decodes_total", "Keyframes decoded for stream snapshots.")
+
+
+class SnapshotUnavailable(Exception):
+    """No finished segment yet, or it could not be decoded."""
+
+
+@dataclass
+class Snapshot:
+    body: bytes
+    content_type: str
+    sequence: int
+
+    @property
+    def etag(self) -> str:
+        return f'"snap-{self.sequence}-{len(self.body):x}"'
+
+
+@dataclass
+class _Latest:
+    sequence: int
+    # (width, format) -> image; (None, "jpeg") is the full-size decode
+    variants: Dict[Tuple[Optional[int], str], Snapshot] = field(default_factory=dict)
+
+
+# ingest key -> snapshots of its newest segment; streams sharing an ingest share them
+_latest: Dict[str, _Latest] = {}
+# Keyed by (ingest key, sequence, width, format); concurrent requests share one decode/resize
+_renders: SingleFlight[Snapshot] = SingleFlight()
+
+# (media file, fMP4 init segment, (offset, length) within the media file)
+Source = Tuple[str, Optional[str], Optional[Tuple[int, int]]]
+
+
+def _newest_keyframe(stream: "stream_manager.StreamProcess") -> Optional[Tuple[int, Source]]:
+    """
+    Sequence number and location of the newest finished segment. Low-latency streams use
+    the first CMAF part of their newest segment, which starts with a keyframe.
+    """
+    if stream.low_latency:
+        per_segment = stream_manager.parts_per_segment()
+        starts = [p for p in llhls.read_parts(stream.output_dir) if p.index % per_segment == 0]
+        if not starts:
+            return None
+        init = os.path.join(stream.output_dir, llhls.INIT_SEGMENT)
+        return starts[-1].index // per_segment, (os.path.join(stream.output_dir, starts[-1].uri), init, None)
+    # The first ABR rendition is the largest
+    playlist = stream.playlist_path
+    try:
+        with open(playlist, encoding="utf-8", errors="replace") as f:
+            segments = dvr.parse_live_playlist(f.read())
+    except OSError:
+        return None
+    if not segments:
+        return None
+    newest = segments[-1]
+    directory = os.path.dirname(playlist)
+    init = os.path.join(directory, newest.init) if newest.init else None
+    return newest.sequence, (os.path.join(directory, newest.uri), init, newest.byterange)
+
+
+def _read_input(path: str, init: Optional[str], byterange: Optional[Tuple[int, int]]) -> bytes:
+    chunks = []
+    if init:
+        with open(init, "rb") as f:
+            chunks.append(f.read())
+    with open(path, "rb") as f:
+        if byterange is None:
+            chunks.append(f.read())
+        else:
+            f.seek(byterange[0])
+            chunks.append(f.read(byterange[1]))
+    return b"".join(chunks)
+
+
+async def _decode(path: str, init: Optional[str], byterange: Optional[Tuple[int, int]] = None) -> bytes:
+    """
+    JPEG of the first keyframe of a segment. fMP4 segments are fed after their init segment;
+    segments of chunk files are read from their byte range.
+    """
+    try:
+        data = await asyncio.to_thread(_read_input, path, init, byterange)
+    except OSError as e:
+        raise SnapshotUnavailable(f"Segment is gone: {e}")
+    command = [
+        capabilities.ffmpeg_path(), "-hide_banner", "-loglevel", "error",
+        "-skip_frame", "nokey", "-i", "pipe:0",
+        "-an", "-sn", "-frames:v", "1", "-pix_fmt", "yuvj420p",
+        "-c:v", "mjpeg", "-q:v", "3", "-f", "image2pipe", "pipe:1",
+    ]
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        raise SnapshotUnavailable(f"FFmpeg could not be started: {e}")
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(data), timeout=SNAPSHOT_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise SnapshotUnavailable(f"Decoding timed out after {SNAPSHOT_TIMEOUT:.0f}s")
+    except asyncio.CancelledError:
+        process.kill()
+        raise
+    if process.returncode != 0 or not stdout:
+        raise SnapshotUnavailable(
+            f"FFmpeg failed (rc={process.returncode}): {stderr.decode(errors='replace').strip()[:500]}"
+        )
+    return stdout
+
+
+def _resize(frame: bytes, width: Optional[int], fmt: str) -> bytes:
+    """Scale the full-size JPEG to `width` (keeping its aspect ratio) and encode it as `fmt`."""
+    try:
+        with Image.open(io.BytesIO(frame)) as image:
+            if width and width < image.width:
+                height = max(1, image.height * width // image.width)
+                # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale when that is still large enough
+                image.draft("RGB", (width, height))
+                image = image.convert("RGB").resize((width, height), Image.Resampling.LANCZOS)
+            else:
+                image = image.convert("RGB")
+            out = io.BytesIO()
+            if fmt == "webp":
+                image.save(out, "WEBP", quality=WEBP_QUALITY, method=4)
+            else:
+                image.save(out, "JPEG", quality=JPEG_QUALITY, optimize=True)
+    except (UnidentifiedImageError, OSError) as e:
+        raise SnapshotUnavailable(f"Unreadable frame: {e}")
+    return out.getvalue()
+
+
+async def _render(key: str, sequence: int, width: Optional[int], fmt: str, source: Source) -> Snapshot:
+    if width is None and fmt == "jpeg":
+        body = await _decode(*source)
+        decodes.inc()
+        logger.debug(f"Decoded snapshot of {key} segment {sequence} ({len(body)} bytes)")
+    else:
+        full = await _snapshot(key, sequence, None, "jpeg", source)
+        body = await asyncio.to_thread(_resize, full.body, width, fmt)
+    return Snapshot(body, CONTENT_TYPES[fmt], sequence)
+
+
+async def _snapshot(key: str, sequence: int, width: Optional[int], fmt: str, source: Source) -> Snapshot:
+    latest = _latest.get(key)
+    if latest is not None and latest.sequence == sequence:
+        cached = latest.variants.get((width, fmt))
+        if cached is not None:
+            return cached
+    return await _renders.do((key, sequence, width, fmt), lambda: _render_and_keep(key, sequence, width, fmt, source))
+
+
+async def _render_and_keep(key: str, sequence: int, width: Optional[int], fmt: str, source: Source) -> Snapshot:
+    snapshot = await _render(key, sequence, width, fmt, source)
+    latest = _latest.get(key)
+    if latest is None:
+        _forget_stopped()
+    if latest is None or latest.sequence != sequence:
+        latest = _latest[key] = _Latest(sequence)
+    if len(latest.variants) >= SNAPSHOT_VARIANTS:
+        latest.variants.pop(next(k for k in latest.variants if k != (None, "jpeg")), None)
+    latest.variants[(width, fmt)] = snapshot
+    return snapshot
+
+
+async def get_snapshot(
+    stream: "stream_manager.StreamProcess", width: Optional[int] = None, fmt: str = "jpeg"
+) -> Snapshot:
+    """
+    Snapshot of a running stream's newest segment, `width` pixels wide (full size by default).
+    Raises ValueError for unsupported options and SnapshotUnavailable when there is no frame.
+    """
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"Unsupported snapshot format '{fmt}'")
+    if width is not None and not 0 < width <= SNAPSHOT_MAX_WIDTH:
+        raise ValueError(f"Snapshot width must be between 1 and {SNAPSHOT_MAX_WIDTH}")
+    newest = await asyncio.to_thread(_newest_keyframe, stream)
+    if newest is None:
+        raise SnapshotUnavailable("No segment has been written yet")
+    sequence, source = newest
+    return await _snapshot(stream.key, sequence, width, fmt, source)
+
+
+def _forget_stopped():
+    """Drop the snapshots of ingests that are no longer running."""
+    running = stream_manager.ingest_keys()
+    for key in [k for k in _latest if k not in running]:
+        del _latest[key]
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Retention for live output. FFmpeg deletes segments that leave the playlist (delete_segments);
+# the sweeper enforces the rest and catches whatever FFmpeg leaves behind (restarts, crashes).
+SEGMENT_RETENTION_COUNT = int(os.environ.get("SEGMENT_RETENTION_COUNT", "30"))  # per rendition directory
+# fMP4 chunk files hold many segments each and are only deleted by the sweeper
+CHUNK_RETENTION_COUNT = int(os.environ.get("CHUNK_RETENTION_COUNT", "2"))  # unlisted, per directory
+CHUNK_PREFIX = "chunk_"
+SEGMENT_MAX_AGE = float(os.environ.get("SEGMENT_MAX_AGE", "600"))  # seconds; 0 disables
+STREAM_MAX_BYTES = int(os.environ.get("STREAM_MAX_BYTES", "0"))  # per ingest; 0 disables
+STORAGE_MAX_BYTES = int(os.environ.get("STORAGE_MAX_BYTES", "0"))  # whole output directory; 0 disables
+STORAGE_SWEEP_INTERVAL = float(os.environ.get("STORAGE_SWEEP_INTERVAL", "30"))
+# Directories of no running ingest are removed once they have been left alone this long
+ORPHAN_GRACE_SECONDS = 60.0
+# FFmpeg -report logs kept per ingest (one per run)
+REPORT_LOGS_KEEP = 3
+REPORT_LOG_PATTERN = "ffmpeg-%t.log"
+
+MEDIA_EXTENSIONS = (".ts", ".m4s", ".aac", ".mp4")
+TRASH_PREFIX = ".trash-"
+_REPORT_LOG = re.compile(r"^ffmpeg-\d{8}-\d{6}\.log$")
+_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+# Background deletions, referenced until they finish
+_pending: Set[asyncio.Task] = set()
+_sweeper: Optional[asyncio.Task] = None
+
+
+@dataclass
+class MediaFile:
+    path: str
+    size: int
+    mtime: float
+
+
+@dataclass
+class DirectoryUsage:
+    """Files of one ingest's output directory."""
+    bytes: int = 0
+    files: int = 0
+    segments: List[MediaFile] = field(default_factory=list)
+    referenced: Set[str] = field(default_factory=set)  # media still listed by a playlist
+    reports: List[MediaFile] = field(default_factory=list)
+
+
+@dataclass
+class SweepResult:
+    usage: Dict[str, DirectoryUsage] = field(default_factory=dict)
+    deleted_files: int = 0
+    freed_bytes: int = 0
+    removed_dirs: List[str] = field(default_factory=list)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(u.bytes for u in self.usage.values())
+
+
+def filesystem_type(path: str) -> Optional[str]:
+    """Type of the filesystem holding `path` (e.g. 'tmpfs'), from /proc/mounts; None elsewhere."""
+    try:
+        with open("/proc/mounts") as f:
+            mounts = [line.split()[1:3] for line in f]
+    except OSError:
+        return None
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    for mount_point, kind in mounts:
+        mount_point = mount_point.replace("\\040", " ")
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) > len(best):
+            best, fstype = mount_point, kind
+    return fstype
+
+
+def _playlist_references(path: str) -> Iterable[str]:
+    base = os.path.dirname(path)
+    try:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    names = []
+    for line in lines:
+        if line.startswith("#"):
+            names += _URI_ATTRIBUTE.findall(line)
+        elif line.strip():
+            names.append(line.strip())
+    # Only local names matter; query strings are not part of the file name
+    return [os.path.normpath(os.path.join(base, n.split("?")[0])) for n in names if "://" not in n]
+
+
+def scan_directory(path: str) -> DirectoryUsage:
+    usage = DirectoryUsage()
+    playlists = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            full = os.path.join(root, name)
+            try:
+                st = os.stat(full)
+            except OSError:  # deleted by FFmpeg meanwhile
+                continue
+            usage.bytes += st.st_size
+            usage.files += 1
+            if name.endswith(".m3u8"):
+                playlists.append(full)
+            elif name.endswith(MEDIA_EXTENSIONS):
+                usage.segments.append(MediaFile(full, st.st_size, st.st_mtime))
+            elif name.startswith("ffmpeg-") and name.endswith(".log"):
+                usage.reports.append(MediaFile(full, st.st_size, st.st_mtime))
+    for playlist in playlists:
+        usage.referenced.update(_playlist_references(playlist))
+    return usage
+
+
+def _delete(result: SweepResult, usage: DirectoryUsage, item: MediaFile) -> bool:
+    try:
+        os.remove(item.path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not delete {item.path}: {e}")
+        return False
+    usage.bytes -= item.size
+    usage.files -= 1
+    result.deleted_files += 1
+    result.freed_bytes += item.size
+    return True
+
+
+def _expired(usage: DirectoryUsage, now: float) -> List[MediaFile]:
+    """Unlisted segments (or chunks) beyond the per-directory count or older than the maximum age."""
+    by_dir: Dict[str, List[MediaFile]] = {}
+    for item in usage.segments:
+        by_dir.setdefault(os.path.dirname(item.path), []).append(item)
+    expired = []
+    for items in by_dir.values():
+        items.sort(key=lambda i: i.mtime, reverse=True)
+        chunks = 0
+        for rank, item in enumerate(items):
+            if item.path in usage.referenced:
+                continue
+            if os.path.basename(item.path).startswith(CHUNK_PREFIX):
+                chunks += 1
+                too_many = chunks > CHUNK_RETENTION_COUNT
+            else:
+                too_many = SEGMENT_RETENTION_COUNT and rank >= SEGMENT_RETENTION_COUNT
+            too_old = SEGMENT_MAX_AGE and now - item.mtime > SEGMENT_MAX_AGE
+            if too_many or too_old:
+                expired.append(item)
+    return expired
+
+
+def _evictable(usage: DirectoryUsage) -> List[MediaFile]:
+    """
+    Segments that may go to meet a byte quota, oldest first. Listed segments are never evicted,
+    nor is the newest file of each directory, which FFmpeg may still be writing.
+    """
+    newest: Dict[str, MediaFile] = {}
+    for item in usage.segments:
+        directory = os.path.dirname(item.path)
+        if directory not in newest or item.mtime > newest[directory].mtime:
+            newest[directory] = item
+    keep = {item.path for item in newest.values()} | usage.referenced
+    return sorted((s for s in usage.segments if s.path not in keep), key=lambda i: i.mtime)
+
+
+def _remove_tree(path: str, result: SweepResult):
+    shutil.rmtree(path, ignore_errors=True)
+    result.removed_dirs.append(os.path.basename(path))
+
+
+def sweep(base_dir: str, active: Set[str], dry_run: bool = False) -> SweepResult:
+    """
+    Enforce retention under `base_dir`, whose sub-directories are named by ingest key.
+    `active` are the keys of running ingests; other directories are orphans.
+    With `dry_run`, only measure usage. Blocking; run in a worker thread.
+    """
+    result = SweepResult()
+    now = time.time()
+    try:
+        entries = list(os.scandir(base_dir))
+    except FileNotFoundError:
+        return result
+    for entry in entries:
+        if not entry.is_dir(follow_symlinks=False):
+            continue
+        if entry.name.startswith(TRASH_PREFIX):
+            if not dry_run:
+                _remove_tree(entry.path, result)
+            continue
+        if entry.name not in active and not dry_run:
+            try:
+                idle = now - entry.stat().st_mtime
+            except OSError:
+                continue
+            if idle >= ORPHAN_GRACE_SECONDS:
+                logger.info(f"Removing orphaned output directory {entry.path}")
+                _remove_tree(entry.path, result)
+                continue
+        result.usage[entry.name] = scan_directory(entry.path)
+    if dry_run:
+        return result
+
+    for usage in result.usage.values():
+        for item in _expired(usage, now):
+            _delete(result, usage, item)
+        usage.segments = [s for s in usage.segments if os.path.exists(s.path)]
+        if STREAM_MAX_BYTES:
+            for item in _evictable(usage):
+                if usage.bytes <= STREAM_MAX_BYTES:
+                    break
+                _delete(result, usage, item)
+            usage.segments = [s for s in usage.segments if os.path.exists(s.path)]
+        usage.reports.sort(key=lambda i: i.mtime, reverse=True)
+        for item in usage.reports[REPORT_LOGS_KEEP:]:
+            _delete(result, usage, item)
+        usage.reports = usage.reports[:REPORT_LOGS_KEEP]
+
+    if STORAGE_MAX_BYTES and result.total_bytes > STORAGE_MAX_BYTES:
+        candidates = sorted(
+            ((item, usage) for usage in result.usage.values() for item in _evictable(usage)),
+            key=lambda pair: pair[0].mtime,
+        )
+        for item, usage in candidates:
+            if result.total_bytes <= STORAGE_MAX_BYTES:
+                break
+            _delete(result, usage, item)
+        if result.total_bytes > STORAGE_MAX_BYTES:
+            logger.warning(
+                f"Stream output uses {result.total_bytes} bytes, over STORAGE_MAX_BYTES={STORAGE_MAX_BYTES}, "
+                f"with only live segments left"
+            )
+    return result
+
+
+def report_env(output_dir: str) -> Dict[str, str]:
+    """Environment sending FFmpeg's -report log into the ingest's directory, one file per run."""
+    # ':' separates FFREPORT options and must be escaped in the path
+    path = os.path.join(output_dir, REPORT_LOG_PATTERN).replace("\\", "/").replace(":", "\\:")
+    return {**os.environ, "FFREPORT": f"file={path}:level=32"}
+
+
+def clean_report_logs(directory: str, keep: int = 0) -> int:
+    """Delete FFmpeg -report logs (ffmpeg-YYYYMMDD-HHMMSS.log) left in `directory`, keeping the newest `keep`."""
+    try:
+        logs = [e for e in os.scandir(directory) if e.is_file() and _REPORT_LOG.match(e.name)]
+    except OSError:
+        return 0
+    logs.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    removed = 0
+    for entry in logs[keep:]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+async def discard(path: str):
+    """
+    Remove a directory without blocking the event loop. It is renamed out of the way first,
+    so the same path can be reused immediately while the files are deleted in the background.
+    """
+    trash = os.path.join(os.path.dirname(path), f"{TRASH_PREFIX}{uuid.uuid4().hex[:8]}")
+    try:
+        await asyncio.to_thread(os.rename, path, trash)
+    except FileNotFoundError:
+        return
+    except OSError:
+        # e.g. a file still open on Windows: delete in place, before the path is reused
+        await asyncio.to_thread(shutil.rmtree, path, True)
+        return
+    task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, trash, True))
+    _pending.add(task)
+    task.add_done_callback(_pending.discard)
+
+
+async def usage(base_dir: str, active: Set[str]) -> dict:
+    """Current usage of the stream output directory, per ingest and in total."""
+    result = await asyncio.to_thread(sweep, base_dir, active, True)
+    disk = await asyncio.to_thread(shutil.disk_usage, base_dir)
+    return {
+        "base_dir": base_dir,
+        "filesystem": filesystem_type(base_dir),
+        "total_bytes": result.total_bytes,
+        "total_files": sum(u.files for u in result.usage.values()),
+        "disk": {"total": disk.total, "used": disk.used, "free": disk.free},
+        "limits": {
+            "segment_retention_count": SEGMENT_RETENTION_COUNT,
+            "segment_max_age": SEGMENT_MAX_AGE or None,
+            "stream_max_bytes": STREAM_MAX_BYTES or None,
+            "storage_max_bytes": STORAGE_MAX_BYTES or None,
+        },
+        "ingests": {
+            key: {"bytes": u.bytes, "files": u.files, "segments": len(u.segments), "active": key in active}
+            for key, u in sorted(result.usage.items())
+        },
+    }
+
+
+def start_sweeper(base_dir: str, active: Callable[[], Awaitable[Set[str]]]):
+    """
+    Sweep `base_dir` every STORAGE_SWEEP_INTERVAL seconds. `active` returns the keys of the
+    ingests running on every worker that shares the directory; a round is skipped if it fails.
+    """
+    global _sweeper
+    if _sweeper is None or _sweeper.done():
+        _sweeper = asyncio.create_task(_sweep_forever(base_dir, active))
+
+
+def stop_sweeper():
+    if _sweeper:
+        _sweeper.cancel()
+
+
+async def _sweep_forever(base_dir: str, active: Callable[[], Awaitable[Set[str]]]):
+    # Report logs of older versions, which wrote them to the working directory
+    removed = await asyncio.to_thread(clean_report_logs, os.getcwd())
+    if removed:
+        logger.info(f"Removed {removed} FFmpeg report logs from {os.getcwd()}")
+    while True:
+        try:
+            result = await asyncio.to_thread(sweep, base_dir, set(await active()))
+            if result.deleted_files or result.removed_dirs:
+                logger.info(
+                    f"Storage sweep: deleted {result.deleted_files} files ({result.freed_bytes} bytes), "
+                    f"removed {len(result.removed_dirs)} directories; {result.total_bytes} bytes in use"
+                )
+        except Exception as e:
+            logger.warning(f"Storage sweep failed: {type(e).__name__}: {e}")
+        await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
@@ -1,269 +1,1128 @@
 import asyncio
+import hashlib
 import os
-import shutil
-import subprocess
-import threading
-from dataclasses import dataclass
-from typing import Dict, Optional
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterator, List, Optional, Set, Tuple
 import logging
 
+from . import abr, capabilities, compositor, dvr, llhls, metrics, probe, proc_stats, progress, storage
+from .scheduler import Allocation, CapacityError, estimate_cost, scheduler
+from .segment_cache import cache as segment_cache
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+HLS_FPS = int(os.environ.get("HLS_FPS", "25"))
+HLS_SEGMENT_SECONDS = int(os.environ.get("HLS_SEG_TIME", "2"))
+HLS_LIST_SIZE = 10
+# ts: one MPEG-TS file per segment. fmp4: CMAF fragments appended to rolling chunk files of
+# about HLS_CHUNK_BYTES, listed with EXT-X-BYTERANGE (0: one .m4s file per segment instead)
+HLS_SEGMENT_FORMAT = os.environ.get("HLS_SEGMENT_FORMAT", "ts")
+HLS_CHUNK_BYTES = int(os.environ.get("HLS_CHUNK_BYTES", str(4 * 1024 * 1024)))
+SEGMENT_FORMATS = ("ts", "fmp4")
+# How long to wait for FFmpeg to move a byte-range playlist it started writing into place
+PLAYLIST_SETTLE_TIMEOUT = 1.0
+PLAYLIST_SETTLE_POLL = 0.02
+
+# Watchdog / supervisor tuning
+WATCHDOG_INTERVAL = float(os.environ.get("HLS_WATCHDOG_INTERVAL", "1"))
+STALL_TIMEOUT = float(os.environ.get("HLS_STALL_TIMEOUT", "10"))
+STARTUP_TIMEOUT = float(os.environ.get("HLS_STARTUP_TIMEOUT", "60"))
+MAX_RESTARTS = int(os.environ.get("FFMPEG_MAX_RESTARTS", "5"))
+RESTART_BACKOFF_BASE = float(os.environ.get("FFMPEG_RESTART_BACKOFF", "1"))
+RESTART_BACKOFF_MAX = float(os.environ.get("FFMPEG_RESTART_BACKOFF_MAX", "30"))
+# A run that stays healthy this long resets the consecutive-failure counter
+HEALTHY_RESET_SECONDS = float(os.environ.get("FFMPEG_HEALTHY_RESET", "60"))
+STOP_TIMEOUT = 5.0
+# Raw FFmpeg log lines forwarded to the logger per stream per second; the rest are counted and dropped
+FFMPEG_LOG_RATE = float(os.environ.get("FFMPEG_LOG_RATE", "5"))
+
+# On-demand streams: FFmpeg runs only while someone is watching
+ON_DEMAND_IDLE_TIMEOUT = float(os.environ.get("ON_DEMAND_IDLE_TIMEOUT", "60"))
+# How long the first playlist request of a cold stream is held waiting for its first segment
+ON_DEMAND_START_WAIT = float(os.environ.get("ON_DEMAND_START_WAIT", "20"))
+# A client counts as a viewer while it has fetched a playlist or segment this recently
+VIEWER_WINDOW = float(os.environ.get("ON_DEMAND_VIEWER_WINDOW", "15"))
+ON_DEMAND_REAP_INTERVAL = 5.0
+COLD_START_HISTORY = 20
+# Layer size for burned-in overlays when the source's resolution could not be probed
+BURN_IN_DEFAULT_SIZE = (1920, 1080)
+H264_ENCODER = "libx264"
+LAVFI_PREFIX = "lavfi:"
+
+_LINE_SPLIT = re.compile(r"[\r\n]+")
+# FFmpeg logs every file it opens; the muxer rewrites the playlist before opening the next segment
+_OPENING_FILE = re.compile(r"Opening '([^']+)' for writing")
+_ERROR_LINE = re.compile(r"\b(error|invalid|failed)\b", re.IGNORECASE)
+
+
 @dataclass
 class StreamProcess:
+    """One FFmpeg ingest of a source, shared by every logical stream (consumer) that uses it."""
     rtsp_url: str
-    process: subprocess.Popen
     output_dir: str
-    thread: threading.Thread
+    key: str = ""
+    consumers: Set[str] = field(default_factory=set)
+    low_latency: bool = False
+    renditions: List[abr.Rendition] = field(default_factory=list)
+    has_audio: bool = True
+    requested_mode: str = "auto"  # auto|transcode|remux
+    segment_format: str = "ts"  # ts|fmp4; low-latency output is always fMP4 parts
+    burn_in: bool = False  # render overlays into the video
+    scene: Optional[str] = None  # stream whose overlays are burned in
+    # DVR archives of the streams served by this ingest that asked for one, by stream id
+    archives: Dict[str, dvr.Archive] = field(default_factory=dict)
+    archiver: Optional[asyncio.Task] = None
+    mode: str = "probing"  # probing|transcode|remux, resolved from requested_mode
+    source: Optional[probe.SourceInfo] = None
+    allocation: Optional[Allocation] = None
+    process: Optional[asyncio.subprocess.Process] = None
+    task: Optional[asyncio.Task] = None
+    state: str = "starting"  # starting|queued|ready|restarting|failed
+    restarts: int = 0
+    last_error: Optional[str] = None
+    # Media files opened per output directory (one per rendition)
+    cpu_sample: Optional[Tuple[float, float]] = None
+    cpu_percent: Optional[float] = None
+    # Recent -progress samples, kept across restarts
+    progress_samples: Deque[progress.ProgressSample] = field(
+        default_factory=lambda: deque(maxlen=progress.PROGRESS_HISTORY)
+    )
+    started_at: float = field(default_factory=time.monotonic)
+    ready_after: Optional[float] = None
+    last_segment_at: Optional[float] = None  # monotonic
+    state_changed: asyncio.Event = field(default_factory=asyncio.Event)
+    segment_written: asyncio.Event = field(default_factory=asyncio.Event)
+    settling: Optional[asyncio.Task] = None  # waiting for FFmpeg to rename a rewritten playlist
+    stopping: bool = False
 
-# In-memory store for active stream processes
+    @property
+    def playlist_path(self) -> str:
+        """The playlist FFmpeg rewrites on every segment (watched for stalls)."""
+        if self.low_latency:
+            return os.path.join(self.output_dir, llhls.PARTS_PLAYLIST)
+        if self.renditions:
+            return os.path.join(self.output_dir, self.renditions[0].name, "index.m3u8")
+        return os.path.join(self.output_dir, "index.m3u8")
+
+    @property
+    def layer_path(self) -> str:
+        return os.path.join(self.output_dir, compositor.LAYER_FILE)
+
+    @property
+    def byte_ranges(self) -> bool:
+        """Whether segments are byte ranges of rolling chunk files."""
+        return self.segment_format == "fmp4" and not self.low_latency and HLS_CHUNK_BYTES > 0
+
+    def hls_url(self, stream_id: str) -> str:
+        return _hls_url(stream_id, self.low_latency, bool(self.renditions))
+
+
+@dataclass
+class OnDemandStream:
+    """A registered stream whose ingest is started by its first viewer and stopped when idle."""
+    rtsp_url: str
+    low_latency: bool = False
+    adaptive: bool = False
+    has_audio: bool = True
+    mode: str = "auto"
+    segment_format: Optional[str] = None
+    burn_in: bool = False
+    archive: bool = False
+    idle_timeout: float = ON_DEMAND_IDLE_TIMEOUT
+    last_activity: Optional[float] = None
+    # client -> time of its last playlist/segment request
+    viewers: Dict[str, float] = field(default_factory=dict)
+    last_start: Optional[float] = None
+    cold_starts: Deque[float] = field(default_factory=lambda: deque(maxlen=COLD_START_HISTORY))
+    cold_start_count: int = 0
+    idle_stops: int = 0
+    starting: Optional[asyncio.Task] = None
+
+def _hls_url(stream_id: str, low_latency: bool, adaptive: bool) -> str:
+    if low_latency:
+        name = "llhls.m3u8"
+    elif adaptive:
+        name = "master.m3u8"
+    else:
+        name = "index.m3u8"
+    return f"/streams/{stream_id}/{name}"
+
+def _set_state(stream: StreamProcess, state: str):
+    """Update the stream state and wake everything long-polling on it."""
+    if stream.state == state:
+        return
+    stream.state = state
+    if state == "ready" and stream.ready_after is None:
+        stream.ready_after = time.monotonic() - stream.started_at
+    stream.state_changed.set()
+    stream.state_changed = asyncio.Event()
+
+
+# In-memory store for active streams: logical stream_id -> (possibly shared) ingest
 _active_streams: Dict[str, StreamProcess] = {}
-STREAMS_BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "streams"))
+# Running ingests by ingest key; one FFmpeg (and one RTSP session) per source and output config
+_ingests: Dict[str, StreamProcess] = {}
+# Registered on-demand streams, whether or not their ingest is currently running
+_on_demand: Dict[str, OnDemandStream] = {}
+_reaper: Optional[asyncio.Task] = None
+# Point at a tmpfs mount (e.g. /dev/shm/streams) to keep live segments in RAM
+STREAMS_BASE_DIR = os.path.abspath(os.environ.get(
+    "HLS_OUTPUT_DIR", os.path.join(os.path.dirname(__file__), "..", "streams")
+))
 
-def get_stream_output_dir(stream_id: str) -> str:
-    return os.path.join(STREAMS_BASE_DIR, stream_id)
+def get_stream_output_dir(key: str) -> str:
+    return os.path.join(STREAMS_BASE_DIR, key)
 
-def _monitor_process(process: subprocess.Popen, stream_id: str):
-    """Monitor FFmpeg process output in a separate thread."""
-    try:
-        # Read stderr line by line (already decoded because text=True)
-        while True:
-            line = process.stderr.readline()
-            if not line:
-                break
-            logger.info(f"[ffmpeg_{stream_id}]: {line.strip()}")
-        
-        # Wait for process to complete
-        process.wait()
-        logger.info(f"FFmpeg process for stream '{stream_id}' has ended with return code {process.returncode}")
-    except Exception as e:
-        logger.error(f"Error monitoring FFmpeg process: {e}", exc_info=True)
+def _ingest_key(
+    rtsp_url: str, low_latency: bool, adaptive: bool, mode: str, scene: Optional[str] = None, segment_format: str = "ts"
+) -> str:
+    config = f"{rtsp_url}|{low_latency}|{adaptive}|{mode}|{scene}"
+    if segment_format != "ts" and not low_latency:
+        config += f"|{segment_format}"
+    digest = hashlib.sha1(config.encode()).hexdigest()[:12]
+    return f"ingest-{digest}"
 
-async def start_stream(stream_id: str, rtsp_url: str) -> Optional[str]:
-    """
-    Starts an FFmpeg process to convert an RTSP stream to HLS.
-    Returns the HLS playlist URL if successful, otherwise None.
-    """
-    if stream_id in _active_streams:
-        logger.warning(f"Stream '{stream_id}' is already running.")
-        return None
+def get_stream(stream_id: str) -> Optional[StreamProcess]:
+    return _active_streams.get(stream_id)
 
-    output_dir = get_stream_output_dir(stream_id)
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir)
-    
-    # Ensure the output directory exists
-    logger.info(f"Output directory: {output_dir}")
-    hls_playlist = os.path.join(output_dir, "index.m3u8")
-    logger.info(f"HLS playlist path: {hls_playlist}")
+def has_stream(stream_id: str) -> bool:
+    """Whether `stream_id` runs (or is registered on demand) on this node."""
+    return stream_id in _active_streams or stream_id in _on_demand
+
+def parts_per_segment() -> int:
+    return llhls.parts_per_segment(HLS_SEGMENT_SECONDS)
+
+def _hls_output_args(stream: StreamProcess) -> List[str]:
+    ffmpeg_output_dir = stream.output_dir.replace("\\", "/")
+    segment_seconds = str(HLS_SEGMENT_SECONDS)
+    if stream.low_latency:
+        # CMAF fragments of one LL-HLS part each; llhls groups them into parent segments.
+        # split_by_time cuts between keyframes, which only fall on parent segment boundaries.
+        per_segment = parts_per_segment()
+        return [
+            "-f", "hls",
+            "-hls_time", f"{llhls.PART_SECONDS}",
+            "-hls_list_size", str(per_segment * 10),
+            "-hls_flags", "split_by_time+program_date_time+delete_segments+temp_file",
+            "-hls_delete_threshold", str(per_segment),
+            "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", llhls.INIT_SEGMENT,
+            "-hls_segment_filename", f"{ffmpeg_output_dir}/part_%d.m4s",
+            "-start_number", str(llhls.next_start_number(stream.output_dir, per_segment)),
+        ]
+    # temp_file (in every mode): playlists are written aside and renamed into place, so they
+    # are never read half-written, and the rename tells when a segment is complete
+    args = [
+        "-f", "hls",
+        "-hls_time", segment_seconds,
+        "-hls_list_size", str(HLS_LIST_SIZE),
+        "-hls_allow_cache", "0",
+    ]
+    if stream.byte_ranges:
+        # Segments are appended to one chunk file until it reaches HLS_CHUNK_BYTES, so a file is
+        # created every few dozen seconds instead of every segment. A chunk stays listed until
+        # its last segment leaves the playlist; the storage sweeper deletes it after that.
+        args += [
+            "-hls_flags", "independent_segments+program_date_time+temp_file",
+            "-hls_segment_size", str(HLS_CHUNK_BYTES),
+        ]
+    else:
+        args += [
+            "-hls_flags", "independent_segments+program_date_time+delete_segments+temp_file",
+            # Segments that left the playlist are kept a while for slow clients, then deleted by FFmpeg
+            "-hls_delete_threshold", str(max(1, storage.SEGMENT_RETENTION_COUNT - HLS_LIST_SIZE)),
+        ]
+    if stream.segment_format == "fmp4":
+        name = f"{storage.CHUNK_PREFIX}%d.m4s" if stream.byte_ranges else "segment_%d.m4s"
+        args += ["-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", llhls.INIT_SEGMENT]
+    else:
+        name = "segment_%d.ts"
+        args += ["-hls_segment_type", "mpegts"]
+    if stream.renditions:
+        # One sub-directory per rendition; FFmpeg writes the multi-variant master itself
+        return args + [
+            "-var_stream_map", abr.var_stream_map(stream.renditions, stream.has_audio),
+            "-hls_segment_filename", f"{ffmpeg_output_dir}/%v/{name}",
+            "-master_pl_name", "master.m3u8",
+        ]
+    return args + [
+        "-hls_segment_filename", f"{ffmpeg_output_dir}/{name}",
+        "-master_pl_name", "master.m3u8",
+    ]
+
+def _video_args(stream: StreamProcess) -> List[str]:
+    segment_seconds = str(HLS_SEGMENT_SECONDS)
+    gop = str(HLS_FPS * HLS_SEGMENT_SECONDS)  # frames per segment
+    keyframes = [
+        "-g", gop,
+        "-keyint_min", gop,
+        "-sc_threshold", "0",
+        "-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})",
+    ]
+    if stream.mode == "remux":
+        # Source is already HLS-compatible H.264: copy it, segments cut on its own keyframes
+        return ["-c:v", "copy"]
+    # Overlays are composited onto the decoded source, before any scaling
+    overlay = compositor.overlay_filter("0:v", "1:v") if stream.burn_in else None
+    if stream.renditions:
+        # Decode once, split/scale inside the filter graph and encode every rendition in this process
+        return [
+            "-filter_complex", abr.filter_graph(stream.renditions, HLS_FPS, source=overlay or "[0:v]"),
+            *abr.encoder_args(stream.renditions, stream.has_audio),
+            "-c:v", H264_ENCODER,
+            "-preset", "veryfast",
+            "-tune", "zerolatency",
+            "-profile:v", "main",
+            *keyframes,
+        ]
+    if overlay:
+        # Two inputs: map the composited video and the source's audio explicitly
+        filters = ["-filter_complex", f"{overlay},format=yuv420p[vout]", "-map", "[vout]", "-map", "0:a:0?"]
+    else:
+        filters = ["-vf", "format=yuv420p"]
+    return [
+        "-r", str(HLS_FPS),              # enforce CFR output
+        "-c:v", H264_ENCODER,
+        "-preset", "veryfast",
+        "-tune", "zerolatency",
+        "-profile:v", "baseline",
+        "-level", "3.0",
+        *keyframes,
+        "-pix_fmt", "yuv420p",
+        *filters,
+    ]
 
+def _audio_args(stream: StreamProcess) -> List[str]:
+    if stream.mode == "remux" and stream.source and stream.source.audio_codec == "aac":
+        return ["-c:a", "copy"]
+    return ["-c:a", "aac", "-b:a", "128k"]
+
+def _thread_args(stream: StreamProcess) -> List[str]:
+    """Match encoder/filter threads to the pinned cores so encodes don't oversubscribe them."""
+    threads = stream.allocation.threads if stream.allocation else None
+    if not threads or stream.mode == "remux":
+        return []
+    return ["-threads", str(threads), "-filter_threads", str(threads)]
+
+def _input_args(stream: StreamProcess) -> List[str]:
+    if stream.rtsp_url.startswith(LAVFI_PREFIX):
+        # Synthetic source for benchmarks and smoke tests, e.g. "lavfi:testsrc2=size=1280x720:rate=25"
+        return ["-re", "-f", "lavfi", "-i", stream.rtsp_url[len(LAVFI_PREFIX):]]
+    return [
+        "-rtsp_transport", "tcp",
+        "-fflags", "+genpts+discardcorrupt",
+        "-analyzeduration", "500000",
+        "-probesize", "500000",
+        "-i", stream.rtsp_url,
+    ]
+
+def _build_ffmpeg_command(stream: StreamProcess) -> List[str]:
     # Convert Windows paths to forward slashes for FFmpeg compatibility
-    ffmpeg_output_dir = output_dir.replace("\\", "/")
-    ffmpeg_playlist = hls_playlist.replace("\\", "/")
-    
+    if stream.renditions:
+        ffmpeg_playlist = os.path.join(stream.output_dir, "%v", "index.m3u8").replace("\\", "/")
+    else:
+        ffmpeg_playlist = stream.playlist_path.replace("\\", "/")
+
     # Revised transcode command: enforce constant frame rate & keyframes, remove deletion for debugging
     # Rationale:
     # - Removed -use_wallclock_as_timestamps (was producing huge start PTS)
     # - Force CFR (-r 25) so timestamps advance predictably
     # - Force keyframes every 2s via GOP + force_key_frames expression
-    # - Removed delete_segments & temp_file to observe playlist growth while debugging
+    # - Segments that left the playlist are deleted (delete_segments); see storage for retention
     # - Added -flush_packets 1 and -max_delay 0 to push data sooner
-    # - Keep report for diagnostics
-    forced_fps = os.environ.get("HLS_FPS", "25")
-    segment_seconds = os.environ.get("HLS_SEG_TIME", "2")
-    gop = str(int(int(forced_fps) * int(segment_seconds)))  # frames per segment
-    command = [
-        "ffmpeg",
+    # - Keep report for diagnostics (written into the output directory, see storage.report_env)
+    return [
+        capabilities.ffmpeg_path(),
         "-report",
         "-hide_banner",
         "-loglevel", "info",
+        # Machine-readable stats on stdout instead of stats lines on stderr
+        "-nostats",
+        "-progress", "pipe:1",
         "-stats_period", "1",
-        "-rtsp_transport", "tcp",
-        "-fflags", "+genpts+discardcorrupt",
-        "-analyzeduration", "500000",
-        "-probesize", "500000",
-        "-i", rtsp_url,
+        *_input_args(stream),
+        *(compositor.input_args(stream.layer_path) if stream.burn_in else []),
         # Video
-        "-r", forced_fps,              # enforce CFR output
-        "-c:v", "libx264",
-        "-preset", "veryfast",
-        "-tune", "zerolatency",
-        "-profile:v", "baseline",
-        "-level", "3.0",
-        "-g", gop,
-        "-keyint_min", gop,
-        "-sc_threshold", "0",
-        "-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})",
-        "-pix_fmt", "yuv420p",
-        "-vf", "format=yuv420p",
+        *_video_args(stream),
+        *_thread_args(stream),
         # Audio
-        "-c:a", "aac",
-        "-b:a", "128k",
+        *_audio_args(stream),
         # Output / mux tuning
         "-flush_packets", "1",
         "-max_delay", "0",
-        "-f", "hls",
-        "-hls_time", segment_seconds,
-        "-hls_list_size", "10",
-        "-hls_flags", "independent_segments+program_date_time",
-        "-hls_allow_cache", "0",
-        "-hls_segment_type", "mpegts",
-        "-hls_segment_filename", f"{ffmpeg_output_dir}/segment_%d.ts",
-        "-master_pl_name", "master.m3u8",
+        *_hls_output_args(stream),
         "-y",
         ffmpeg_playlist,
     ]
 
-    logger.info(f"Starting FFmpeg with command: {' '.join(command)}")
-    
-    # Test if ffmpeg is accessible using regular subprocess
+def _playlist_version(path: str) -> Optional[Tuple[int, int]]:
     try:
-        logger.info("Testing FFmpeg accessibility...")
-        test_process = subprocess.run(
-            ["ffmpeg", "-version"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        if test_process.returncode == 0:
-            logger.info("FFmpeg is accessible")
-            logger.info(f"FFmpeg version info: {test_process.stdout[:200]}...")  # First 200 chars
-        else:
-            logger.error(f"FFmpeg test failed with return code {test_process.returncode}")
-            logger.error(f"FFmpeg stderr: {test_process.stderr}")
-            return None
-    except FileNotFoundError as e:
-        logger.error(f"FFmpeg not found in PATH: {e}")
-        logger.info(f"Current PATH: {os.environ.get('PATH', 'Not found')}")
-        return None
-    except Exception as e:
-        logger.error(f"FFmpeg test failed: {type(e).__name__}: {e}", exc_info=True)
+        st = os.stat(path)
+    except OSError:
         return None
-    
+    return st.st_mtime_ns, st.st_size
+
+def _playlist_mtime(path: str) -> Optional[float]:
     try:
-        # Start FFmpeg process using regular subprocess (Windows compatible)
-        process = subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1,  # Line buffered
-            universal_newlines=True
-        )
-        
-        # Start monitoring thread
-        monitor_thread = threading.Thread(
-            target=_monitor_process,
-            args=(process, stream_id),
-            daemon=True
-        )
-        monitor_thread.start()
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime if st.st_size > 0 else None
+
+def _mark_ready(stream_id: str, stream: StreamProcess):
+    if stream.state in ("starting", "restarting"):
+        logger.info(f"HLS playlist for stream '{stream_id}' is ready")
+        _set_state(stream, "ready")
 
-        _active_streams[stream_id] = StreamProcess(
-            rtsp_url=rtsp_url,
-            process=process,
-            output_dir=output_dir,
-            thread=monitor_thread
+def _segment_completed(stream_id: str, stream: StreamProcess):
+    stream.last_segment_at = time.monotonic()
+    segment_cache.invalidate_playlists(stream_id)
+    stream.segment_written.set()
+    stream.segment_written = asyncio.Event()
+    if _playlist_mtime(stream.playlist_path) is not None:
+        _mark_ready(stream_id, stream)
+
+async def _await_playlist(stream_id: str, stream: StreamProcess, previous: Optional[Tuple[int, int]]):
+    """Report a segment once FFmpeg has renamed the playlist it is writing into place."""
+    deadline = time.monotonic() + PLAYLIST_SETTLE_TIMEOUT
+    while _playlist_version(stream.playlist_path) == previous and time.monotonic() < deadline:
+        await asyncio.sleep(PLAYLIST_SETTLE_POLL)
+    _segment_completed(stream_id, stream)
+
+def _on_ffmpeg_line(stream_id: str, stream: StreamProcess, line: str):
+    match = _OPENING_FILE.search(line)
+    if not match:
+        return
+    # Every completed segment (or LL-HLS part) rewrites the playlist through a .tmp file. Only
+    # once that is renamed into place does the playlist list it: opening the next media file
+    # comes earlier, and readers would still get the previous (or a half-written) playlist.
+    settling = stream.settling is not None and not stream.settling.done()
+    if match.group(1) == stream.playlist_path.replace("\\", "/") + ".tmp" and not settling:
+        stream.settling = asyncio.create_task(
+            _await_playlist(stream_id, stream, _playlist_version(stream.playlist_path))
         )
-        
-        logger.info(f"Started FFmpeg (transcode CFR) for stream '{stream_id}' with PID {process.pid}")
-
-        # Monitor playlist/segments availability & detect stall
-        import time
-        playlist_created = False
-        last_size = -1
-        last_mtime = 0
-        stalled_checks = 0
-        for i in range(60):  # allow up to 60s initial ramp
-            await asyncio.sleep(1)
-            if process.poll() is not None:
-                logger.error(f"FFmpeg exited early (rc={process.returncode}) before playlist creation")
-                break
-            if os.path.exists(hls_playlist):
-                sz = os.path.getsize(hls_playlist)
-                mtime = os.path.getmtime(hls_playlist)
-                if sz > 0 and not playlist_created:
-                    playlist_created = True
-                    logger.info(f"HLS playlist file created (size={sz})")
-                    try:
-                        with open(hls_playlist, 'r') as f:
-                            logger.info(f"Initial playlist head:\n{f.read(500)}")
-                    except Exception as e:
-                        logger.warning(f"Playlist read error: {e}")
-                # Detect if playlist stops growing for >10 consecutive checks after creation
-                if playlist_created:
-                    if (sz == last_size) and (mtime == last_mtime):
-                        stalled_checks += 1
-                    else:
-                        stalled_checks = 0
-                    last_size = sz
-                    last_mtime = mtime
-                    if stalled_checks >= 10:  # ~10s stall
-                        logger.error("Detected playlist stall (no change 10s). Restarting FFmpeg process.")
-                        try:
-                            process.terminate()
-                        except Exception:
-                            pass
-                        # Recursive restart attempt once
-                        _active_streams.pop(stream_id, None)
-                        return await start_stream(stream_id, rtsp_url)
-            if i in (5, 10, 20, 30, 45):
-                segs = []
-                if os.path.exists(output_dir):
-                    for f in sorted(os.listdir(output_dir)):
-                        if f.startswith('segment_') and f.endswith('.ts'):
-                            segs.append(f)
-                logger.info(f"[t+{i}s] segments: {segs[-6:]} (total {len(segs)}) playlist_created={playlist_created}")
-            if playlist_created and stalled_checks == 0 and i >= 15:
-                # Good steady state; break out early
-                break
-        if not playlist_created:
-            logger.error("Playlist still not created after 60s window.")
-            try:
-                report_files = [f for f in os.listdir('.') if f.startswith('ffmpeg') and f.endswith('.log')]
-                logger.error(f"FFmpeg reports present: {report_files}")
-            except Exception:
-                pass
-        
-        # The HLS URL is relative to the static path we will set up
-        return f"/streams/{stream_id}/index.m3u8"
-
-    except FileNotFoundError as e:
-        logger.error(f"ffmpeg command not found. Please ensure FFmpeg is installed and in your system's PATH. Error: {e}")
-        return None
+
+class _LogLimiter:
+    """Token bucket for raw FFmpeg log lines, so a chatty process can't flood the logs."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.suppressed += 1
+        return False
+
+def _log_ffmpeg_line(stream_id: str, limiter: _LogLimiter, line: str):
+    # Errors are worth seeing at the default level; everything else is debug output
+    level = logging.WARNING if _ERROR_LINE.search(line) else logging.DEBUG
+    if not logger.isEnabledFor(level) or not limiter.allow():
+        return
+    if limiter.suppressed:
+        logger.log(level, f"[ffmpeg_{stream_id}]: ({limiter.suppressed} lines suppressed)")
+        limiter.suppressed = 0
+    logger.log(level, f"[ffmpeg_{stream_id}]: {line}")
+
+async def _drain_stderr(stream_id: str, stream: StreamProcess, reader: asyncio.StreamReader):
+    """
+    Watch FFmpeg stderr for readiness events, forwarding it to the logger at a limited rate.
+    Progress-style lines end in '\\r', so split on both.
+    """
+    limiter = _LogLimiter(FFMPEG_LOG_RATE)
+    pending = ""
+    while True:
+        chunk = await reader.read(4096)
+        if not chunk:
+            break
+        pending += chunk.decode(errors="replace")
+        *lines, pending = _LINE_SPLIT.split(pending)
+        for line in lines:
+            if line.strip():
+                _log_ffmpeg_line(stream_id, limiter, line.strip())
+                _on_ffmpeg_line(stream_id, stream, line)
+    if pending.strip():
+        _log_ffmpeg_line(stream_id, limiter, pending.strip())
+
+async def _read_progress(stream: StreamProcess, reader: asyncio.StreamReader):
+    """Parse FFmpeg's -progress output into the stream's sample ring buffer."""
+    parser = progress.ProgressParser()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        sample = parser.feed(line.decode(errors="replace"))
+        if sample is not None:
+            stream.progress_samples.append(sample)
+
+async def _terminate(process: asyncio.subprocess.Process):
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+    except ProcessLookupError:
+        return
+    try:
+        await asyncio.wait_for(process.wait(), timeout=STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"FFmpeg PID {process.pid} ignored SIGTERM, killing")
+        try:
+            process.kill()
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+async def _watch(stream_id: str, stream: StreamProcess, process: asyncio.subprocess.Process) -> str:
+    """
+    Watch a single FFmpeg run until it exits or stalls.
+    Returns the reason the run ended: 'exited', 'stalled' or 'startup_timeout'.
+    """
+    playlist = stream.playlist_path
+    started = time.monotonic()
+    # A playlist left over from a previous run must not count as progress
+    last_mtime = _playlist_mtime(playlist)
+    last_change: Optional[float] = None
+    while True:
+        try:
+            await asyncio.wait_for(process.wait(), timeout=WATCHDOG_INTERVAL)
+            return "exited"
+        except asyncio.TimeoutError:
+            pass
+        now = time.monotonic()
+        mtime = _playlist_mtime(playlist)
+        if mtime is not None and mtime != last_mtime:
+            if last_change is None:
+                # Fallback for when the FFmpeg log gave no readiness signal
+                _mark_ready(stream_id, stream)
+            last_mtime = mtime
+            last_change = now
+        elif last_change is None:
+            if now - started >= STARTUP_TIMEOUT:
+                return "startup_timeout"
+        elif now - last_change >= STALL_TIMEOUT:
+            return "stalled"
+
+async def _select_mode(stream_id: str, stream: StreamProcess):
+    """
+    Resolve 'auto' to remux or transcode from a (cached) probe of the source and the
+    (cached) capabilities of the installed FFmpeg.
+    """
+    if stream.requested_mode == "transcode" and not stream.renditions and not stream.burn_in:
+        stream.mode = "transcode"
+        return
+    if stream.rtsp_url.startswith(LAVFI_PREFIX):
+        stream.mode = "transcode"  # nothing to copy from a filter graph
+        stream.has_audio = False
+        return
+    stream.source = await probe.probe_source(stream.rtsp_url)
+    if stream.source is not None:
+        stream.has_audio = stream.source.has_audio
+    if stream.requested_mode != "auto":
+        stream.mode = stream.requested_mode
+        return
+    if stream.low_latency or stream.renditions or stream.burn_in:
+        stream.mode = "transcode"
+        return
+    if stream.source is None:
+        logger.info(f"Stream '{stream_id}': probe failed, transcoding")
+        stream.mode = "transcode"
+        return
+    blockers = probe.remux_blockers(stream.source, HLS_SEGMENT_SECONDS)
+    ffmpeg = await capabilities.get_capabilities()
+    if blockers and ffmpeg.available and not ffmpeg.has_encoder(H264_ENCODER) and stream.source.video_codec == "h264":
+        # Copying a non-ideal H.264 beats failing every restart on a missing encoder
+        logger.warning(f"Stream '{stream_id}': FFmpeg has no {H264_ENCODER} encoder, remuxing despite {', '.join(blockers)}")
+        blockers = []
+    stream.mode = "transcode" if blockers else "remux"
+    reason = f" ({', '.join(blockers)})" if blockers else ""
+    logger.info(f"Stream '{stream_id}': {stream.mode}{reason}")
+
+def _estimated_cost(stream: StreamProcess) -> float:
+    source = stream.source
+    size = (source.width, source.height) if source and source.width and source.height else None
+    return estimate_cost(
+        stream.mode,
+        HLS_FPS,
+        source_size=size,
+        renditions=[(r.width, r.height) for r in stream.renditions],
+    )
+
+async def _supervise(stream_id: str, stream: StreamProcess):
+    """Admit the stream against node CPU capacity, then keep its FFmpeg running."""
+    await capabilities.get_capabilities()  # resolves the binary; detected once per process
+    await _select_mode(stream_id, stream)
+    cost = _estimated_cost(stream)
+    try:
+        stream.allocation = await scheduler.admit(cost, on_queued=lambda: _set_state(stream, "queued"))
+    except CapacityError as e:
+        logger.warning(f"Stream '{stream_id}' not admitted: {e}")
+        stream.last_error = f"capacity exhausted: {e}"
+        _set_state(stream, "failed")
+        return
+    if stream.state == "queued":
+        _set_state(stream, "starting")
+    layer = None
+    try:
+        if stream.burn_in:
+            layer = await _start_layer(stream_id, stream)
+        await _run(stream_id, stream)
+    finally:
+        if layer:
+            layer.cancel()
+        scheduler.release(stream.allocation)
+        stream.allocation = None
+
+async def _start_layer(stream_id: str, stream: StreamProcess) -> asyncio.Task:
+    """
+    Render the overlay layer before FFmpeg first reads it, then keep it current.
+    FFmpeg re-reads the file, so overlay changes never restart the encoder.
+    """
+    source = stream.source
+    size = (source.width, source.height) if source and source.width and source.height else BURN_IN_DEFAULT_SIZE
+    try:
+        await compositor.render_to(stream.layer_path, size, stream.scene)
     except Exception as e:
-        logger.error(f"Failed to start FFmpeg for stream '{stream_id}': {type(e).__name__}: {e}", exc_info=True)
+        # Start with a transparent layer; the follower retries the real one
+        logger.warning(f"Stream '{stream_id}': could not render overlays: {type(e).__name__}: {e}")
+        await asyncio.to_thread(compositor.write_layer, stream.layer_path, compositor.render_layer([], size))
+    return asyncio.create_task(compositor.follow(stream.layer_path, size, stream.scene))
+
+async def _run(stream_id: str, stream: StreamProcess):
+    """Run FFmpeg for the whole lifetime of the stream, restarting with bounded backoff."""
+    failures = 0
+    while not stream.stopping:
+        # A new run reuses segment names, so nothing cached from the last one is valid
+        segment_cache.drop_stream(stream_id)
+        command = _build_ffmpeg_command(stream)
+        logger.info(f"Starting FFmpeg with command: {' '.join(command)}")
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                env=storage.report_env(stream.output_dir),
+            )
+        except FileNotFoundError as e:
+            logger.error(f"ffmpeg command not found. Please ensure FFmpeg is installed and in your system's PATH. Error: {e}")
+            stream.last_error = "ffmpeg not found"
+            break
+        except Exception as e:
+            logger.error(f"Failed to start FFmpeg for stream '{stream_id}': {type(e).__name__}: {e}", exc_info=True)
+            stream.last_error = f"{type(e).__name__}: {e}"
+            break
+
+        stream.process = process
+        scheduler.pin(process.pid, stream.allocation)
+        stream.cpu_sample = (time.monotonic(), 0.0)
+        stream.cpu_percent = None
+        logger.info(f"Started FFmpeg ({stream.mode}) for stream '{stream_id}' with PID {process.pid}")
+        drain = asyncio.create_task(_drain_stderr(stream_id, stream, process.stderr))
+        stats = asyncio.create_task(_read_progress(stream, process.stdout))
+        run_started = time.monotonic()
+        try:
+            reason = await _watch(stream_id, stream, process)
+        finally:
+            await _terminate(process)
+            await drain
+            await stats
+
+        if stream.stopping:
+            break
+        logger.error(f"FFmpeg for stream '{stream_id}' {reason} (rc={process.returncode})")
+        stream.last_error = reason
+        # The camera may have been reconfigured; make the next start probe it again
+        probe.invalidate(stream.rtsp_url)
+        if time.monotonic() - run_started >= HEALTHY_RESET_SECONDS:
+            failures = 0
+        failures += 1
+        if failures > MAX_RESTARTS:
+            logger.error(f"Stream '{stream_id}' exceeded {MAX_RESTARTS} consecutive restarts, giving up")
+            break
+        delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** (failures - 1))
+        _set_state(stream, "restarting")
+        stream.restarts += 1
+        logger.info(f"Restarting stream '{stream_id}' in {delay:.1f}s (attempt {failures}/{MAX_RESTARTS})")
+        await asyncio.sleep(delay)
+
+    if not stream.stopping:
+        stream.process = None
+        _set_state(stream, "failed")
+
+async def start_stream(
+    stream_id: str,
+    rtsp_url: str,
+    low_latency: bool = False,
+    adaptive: bool = False,
+    has_audio: bool = True,
+    mode: str = "auto",
+    burn_in: bool = False,
+    archive: bool = False,
+    segment_format: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Starts a supervised FFmpeg process to convert an RTSP stream to HLS.
+    With `adaptive`, every rendition of the configured ABR ladder is encoded in that one process.
+    Returns the HLS playlist URL immediately, without waiting for the first segment,
+    or None if the stream is already running. Use wait_for_stream to follow readiness.
+    `mode` is 'transcode', 'remux' (copy the source's H.264) or 'auto', which probes the source
+    and remuxes when it is HLS-compatible. With `burn_in`, overlays are rendered into the video
+    and follow overlay changes live. With `archive`, completed segments are kept in the
+    stream's DVR archive (see dvr). `segment_format` is 'ts' or 'fmp4' (HLS_SEGMENT_FORMAT
+    by default).
+    Raises ValueError for unsupported option combinations.
+    """
+    _validate_options(stream_id, low_latency, adaptive, mode, burn_in, archive, segment_format)
+    if stream_id in _on_demand:
+        logger.warning(f"Stream '{stream_id}' is registered on demand.")
+        return None
+    existing = _active_streams.get(stream_id)
+    if existing and existing.state == "failed":
+        await _detach(stream_id)
+    elif existing:
+        logger.warning(f"Stream '{stream_id}' is already running.")
+        return None
+    return await _attach(stream_id, rtsp_url, low_latency, adaptive, has_audio, mode, burn_in, archive, segment_format)
+
+def _validate_options(
+    stream_id: str,
+    low_latency: bool,
+    adaptive: bool,
+    mode: str,
+    burn_in: bool = False,
+    archive: bool = False,
+    segment_format: Optional[str] = None,
+):
+    if mode not in ("auto", "transcode", "remux"):
+        raise ValueError(f"Unknown mode '{mode}'")
+    if (segment_format or HLS_SEGMENT_FORMAT) not in SEGMENT_FORMATS:
+        raise ValueError(f"Unknown segment format '{segment_format or HLS_SEGMENT_FORMAT}'")
+    if adaptive and low_latency:
+        raise ValueError("Adaptive bitrate is not supported in low-latency mode")
+    if mode == "remux" and (adaptive or low_latency):
+        raise ValueError("Remux mode cannot be combined with adaptive bitrate or low-latency output")
+    if mode == "remux" and burn_in:
+        raise ValueError("Burning in overlays requires transcoding")
+    if archive and (low_latency or adaptive):
+        raise ValueError("DVR is not supported with adaptive bitrate or low-latency output")
+    if archive:
+        dvr.archive_root(stream_id)
+
+async def _attach(
+    stream_id: str,
+    rtsp_url: str,
+    low_latency: bool,
+    adaptive: bool,
+    has_audio: bool,
+    mode: str,
+    burn_in: bool = False,
+    archive: bool = False,
+    segment_format: Optional[str] = None,
+) -> str:
+    """Serve `stream_id` from the ingest for this source and config, starting one if needed."""
+    # Burned-in overlays belong to one stream, so those ingests are never shared
+    scene = stream_id if burn_in else None
+    segment_format = segment_format or HLS_SEGMENT_FORMAT
+    key = _ingest_key(rtsp_url, low_latency, adaptive, mode, scene, segment_format)
+    stream = _ingests.get(key)
+    if stream and stream.state != "failed":
+        # Same source and output config: fan the running ingest out to this stream too
+        stream.consumers.add(stream_id)
+        _active_streams[stream_id] = stream
+        logger.info(f"Stream '{stream_id}' shares ingest {key} with {sorted(stream.consumers - {stream_id})}")
+        if archive:
+            await _enable_archive(stream_id, stream)
+        return stream.hls_url(stream_id)
+    if any(s.rtsp_url == rtsp_url for s in _ingests.values()):
+        logger.warning(f"Source of stream '{stream_id}' is already ingested with other options; opening another session")
+
+    renditions = abr.get_ladder() if adaptive else []
+    output_dir = get_stream_output_dir(key)
+    stream = StreamProcess(
+        rtsp_url=rtsp_url,
+        output_dir=output_dir,
+        key=key,
+        consumers={stream_id},
+        low_latency=low_latency,
+        renditions=renditions,
+        has_audio=has_audio,
+        requested_mode=mode,
+        segment_format="fmp4" if low_latency else segment_format,
+        burn_in=burn_in,
+        scene=scene,
+    )
+    _ingests[key] = stream
+    _active_streams[stream_id] = stream
+    await storage.discard(output_dir)
+    await asyncio.to_thread(_make_output_dir, output_dir, [r.name for r in renditions])
+    logger.info(f"Output directory: {output_dir}")
+
+    stream.task = asyncio.create_task(_supervise(key, stream))
+    if archive:
+        await _enable_archive(stream_id, stream)
+
+    # The HLS URL is relative to the static path we will set up
+    return stream.hls_url(stream_id)
+
+async def _enable_archive(stream_id: str, stream: StreamProcess):
+    """Archive the ingest's segments into the stream's DVR archive, starting the archiver if needed."""
+    stream.archives[stream_id] = await dvr.open_archive(stream_id, create=True)
+    if stream.archiver is None or stream.archiver.done():
+        stream.archiver = asyncio.create_task(dvr.follow(
+            stream.playlist_path,
+            lambda: list(stream.archives.values()),
+            lambda timeout: wait_for_segment(stream, timeout),
+            HLS_SEGMENT_SECONDS,
+        ))
+
+def register_stream(
+    stream_id: str,
+    rtsp_url: str,
+    low_latency: bool = False,
+    adaptive: bool = False,
+    has_audio: bool = True,
+    mode: str = "auto",
+    idle_timeout: Optional[float] = None,
+    burn_in: bool = False,
+    archive: bool = False,
+    segment_format: Optional[str] = None,
+) -> Optional[str]:
+    """
+    Register an on-demand stream without starting FFmpeg. Its ingest is started by the first
+    playlist request (see open_stream) and stopped after `idle_timeout` seconds without viewers.
+    Returns the HLS playlist URL, or None if the stream already exists.
+    Raises ValueError for unsupported option combinations.
+    """
+    _validate_options(stream_id, low_latency, adaptive, mode, burn_in, archive, segment_format)
+    if stream_id in _on_demand or stream_id in _active_streams:
+        logger.warning(f"Stream '{stream_id}' already exists.")
         return None
+    _on_demand[stream_id] = OnDemandStream(
+        rtsp_url=rtsp_url,
+        low_latency=low_latency,
+        adaptive=adaptive,
+        has_audio=has_audio,
+        mode=mode,
+        segment_format=segment_format,
+        burn_in=burn_in,
+        archive=archive,
+        idle_timeout=ON_DEMAND_IDLE_TIMEOUT if idle_timeout is None else idle_timeout,
+    )
+    _ensure_reaper()
+    logger.info(f"Registered on-demand stream '{stream_id}'")
+    return _hls_url(stream_id, low_latency, adaptive)
+
+async def open_stream(stream_id: str, viewer: str, start: bool = False) -> Optional[StreamProcess]:
+    """
+    Record a playlist/segment request for a stream and return its ingest, if running.
+    With `start` (playlist requests), a cold on-demand stream is started and the request is
+    held up to ON_DEMAND_START_WAIT seconds for its first segment.
+    """
+    entry = _on_demand.get(stream_id)
+    if entry is None:
+        return _active_streams.get(stream_id)
+    now = time.monotonic()
+    entry.last_activity = now
+    entry.viewers[viewer] = now
+    stream = _active_streams.get(stream_id)
+    if not start:
+        return stream
+    # A failed ingest is retried by viewers, but no more often than the supervisor's longest backoff
+    retry = stream is not None and stream.state == "failed" and now - (entry.last_start or 0) >= RESTART_BACKOFF_MAX
+    if stream is None or retry:
+        if retry:
+            await _detach(stream_id)
+        logger.info(f"Cold start of on-demand stream '{stream_id}'")
+        entry.last_start = now
+        await _attach(
+            stream_id,
+            entry.rtsp_url,
+            entry.low_latency,
+            entry.adaptive,
+            entry.has_audio,
+            entry.mode,
+            entry.burn_in,
+            entry.archive,
+            entry.segment_format,
+        )
+        entry.starting = asyncio.create_task(_record_cold_start(stream_id, entry, now))
+    await wait_for_stream(stream_id, timeout=ON_DEMAND_START_WAIT)
+    return _active_streams.get(stream_id)
+
+async def _record_cold_start(stream_id: str, entry: OnDemandStream, requested_at: float):
+    """Measure the time from the first playlist request to the first listed segment."""
+    info = await wait_for_stream(stream_id, timeout=STARTUP_TIMEOUT + RESTART_BACKOFF_MAX)
+    if info is None or info["state"] != "ready":
+        return
+    latency = time.monotonic() - requested_at
+    entry.cold_starts.append(latency)
+    entry.cold_start_count += 1
+    logger.info(f"On-demand stream '{stream_id}' ready {latency:.2f}s after its first request")
+
+def _ensure_reaper():
+    global _reaper
+    loop = asyncio.get_running_loop()
+    if _reaper is None or _reaper.done() or _reaper.get_loop() is not loop:
+        _reaper = loop.create_task(_reap_idle())
+
+async def _reap_idle():
+    """Stop the ingest of on-demand streams nobody has requested for their idle timeout."""
+    while _on_demand:
+        await asyncio.sleep(ON_DEMAND_REAP_INTERVAL)
+        now = time.monotonic()
+        for stream_id, entry in list(_on_demand.items()):
+            entry.viewers = {v: t for v, t in entry.viewers.items() if now - t < VIEWER_WINDOW}
+            if stream_id not in _active_streams:
+                continue
+            if entry.last_activity is None or now - entry.last_activity >= entry.idle_timeout:
+                logger.info(f"On-demand stream '{stream_id}' idle for {entry.idle_timeout:.0f}s, stopping")
+                entry.idle_stops += 1
+                if entry.starting:
+                    entry.starting.cancel()
+                await _detach(stream_id)
+
+async def wait_for_stream(stream_id: str, timeout: float = 0) -> Optional[dict]:
+    """
+    Long-poll a stream until it leaves the 'starting'/'queued'/'restarting' state or the timeout expires.
+    Returns the stream status, or None if the stream is unknown.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        stream = _active_streams.get(stream_id)
+        if stream is None:
+            entry = _on_demand.get(stream_id)
+            return _idle_info(stream_id, entry) if entry else None
+        remaining = deadline - time.monotonic()
+        if stream.state not in ("starting", "queued", "restarting") or remaining <= 0:
+            return _stream_info(stream_id, stream)
+        try:
+            await asyncio.wait_for(stream.state_changed.wait(), timeout=remaining)
+        except asyncio.TimeoutError:
+            pass
+
+async def wait_for_segment(stream: StreamProcess, timeout: float) -> bool:
+    """Block until FFmpeg finishes its next segment (or part). Returns False on timeout."""
+    try:
+        await asyncio.wait_for(stream.segment_written.wait(), timeout=timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+def _make_output_dir(output_dir: str, subdirs: List[str] = ()):
+    os.makedirs(output_dir)
+    for name in subdirs:
+        os.makedirs(os.path.join(output_dir, name))
 
 async def stop_stream(stream_id: str) -> bool:
-    """Stops a running FFmpeg process and cleans up its files."""
+    """
+    Stops a logical stream (unregistering it if it is on demand). Its ingest's FFmpeg process
+    is stopped and its files cleaned up once no other stream uses it.
+    """
+    entry = _on_demand.pop(stream_id, None)
+    if entry and entry.starting:
+        entry.starting.cancel()
+    if not _on_demand and _reaper:
+        _reaper.cancel()
+    return await _detach(stream_id) or entry is not None
+
+async def _detach(stream_id: str) -> bool:
+    """Stop serving `stream_id` from its ingest, stopping the ingest if it was the last consumer."""
     stream = _active_streams.pop(stream_id, None)
-    if stream:
-        logger.info(f"Stopping stream '{stream_id}' (PID: {stream.process.pid})")
-        stream.process.terminate()
-        stream.process.wait()  # Wait for process to actually terminate
-        
-        # Clean up the stream directory
+    if not stream:
+        return False
+    stream.consumers.discard(stream_id)
+    stream.archives.pop(stream_id, None)
+    if stream.consumers:
+        logger.info(f"Stream '{stream_id}' stopped; ingest {stream.key} still used by {sorted(stream.consumers)}")
+        return True
+    # A failed ingest may already have been replaced by a new one writing to the same directory
+    replaced = _ingests.get(stream.key) not in (stream, None)
+    if not replaced:
+        _ingests.pop(stream.key, None)
+    pid = stream.process.pid if stream.process else None
+    logger.info(f"Stopping stream '{stream_id}' and ingest {stream.key} (PID: {pid})")
+    stream.stopping = True
+    if stream.archiver:
+        stream.archiver.cancel()
+    if stream.process:
+        await _terminate(stream.process)
+    if stream.task:
+        stream.task.cancel()
         try:
-            shutil.rmtree(stream.output_dir)
-            logger.info(f"Cleaned up directory: {stream.output_dir}")
-        except OSError as e:
-            logger.error(f"Error cleaning up directory {stream.output_dir}: {e}")
-            
+            await stream.task
+        except asyncio.CancelledError:
+            pass
+
+    if replaced:
         return True
-    return False
 
-def get_active_streams() -> Dict[str, dict]:
-    """Returns a dictionary of active streams and their details."""
-    return {
-        stream_id: {
-            "rtsp_url": stream.rtsp_url,
-            "pid": stream.process.pid,
-            "output_dir": stream.output_dir,
-            "hls_url": f"/streams/{stream_id}/index.m3u8"
+    # Clean up the stream directory
+    llhls.forget(stream.output_dir)
+    segment_cache.drop_stream(stream.key)
+    try:
+        await storage.discard(stream.output_dir)
+        logger.info(f"Cleaned up directory: {stream.output_dir}")
+    except OSError as e:
+        logger.error(f"Error cleaning up directory {stream.output_dir}: {e}")
+    return True
+
+CPU_SAMPLE_MIN_INTERVAL = 1.0
+
+def _cpu_info(stream: StreamProcess) -> Optional[dict]:
+    """Encoder CPU usage since the previous sample, split across renditions by pixel rate."""
+    if not stream.process or stream.process.returncode is not None:
+        return None
+    now = time.monotonic()
+    # Shared ingests are reported once per consumer; don't resample within one listing
+    if stream.cpu_sample is None or now - stream.cpu_sample[0] >= CPU_SAMPLE_MIN_INTERVAL:
+        percent, stream.cpu_sample = proc_stats.cpu_percent(stream.process.pid, stream.cpu_sample, now)
+        if percent is not None:
+            stream.cpu_percent = percent
+    percent = stream.cpu_percent
+    if percent is None:
+        return None
+    info = {"percent": round(percent, 1)}
+    if stream.renditions:
+        info["renditions_estimate"] = {
+            name: round(percent * weight, 1) for name, weight in abr.cpu_weights(stream.renditions).items()
         }
+    return info
+
+def _on_demand_info(entry: OnDemandStream) -> dict:
+    now = time.monotonic()
+    cold_starts = list(entry.cold_starts)
+    return {
+        "idle_timeout": entry.idle_timeout,
+        "idle_for": round(now - entry.last_activity, 1) if entry.last_activity is not None else None,
+        "viewers": sum(1 for t in entry.viewers.values() if now - t < VIEWER_WINDOW),
+        "cold_starts": entry.cold_start_count,
+        "idle_stops": entry.idle_stops,
+        "last_cold_start": round(cold_starts[-1], 3) if cold_starts else None,
+        "max_cold_start": round(max(cold_starts), 3) if cold_starts else None,
+    }
+
+def _idle_info(stream_id: str, entry: OnDemandStream) -> dict:
+    return {
+        "rtsp_url": entry.rtsp_url,
+        "pid": None,
+        "state": "idle",
+        "low_latency": entry.low_latency,
+        "mode": entry.mode,
+        "segment_format": "fmp4" if entry.low_latency else entry.segment_format or HLS_SEGMENT_FORMAT,
+        "burn_in": entry.burn_in,
+        "dvr": entry.archive,
+        "hls_url": _hls_url(stream_id, entry.low_latency, entry.adaptive),
+        "on_demand": _on_demand_info(entry),
+    }
+
+def _stream_info(stream_id: str, stream: StreamProcess) -> dict:
+    entry = _on_demand.get(stream_id)
+    return {
+        "rtsp_url": stream.rtsp_url,
+        "pid": stream.process.pid if stream.process else None,
+        "state": stream.state,
+        "restarts": stream.restarts,
+        "last_error": stream.last_error,
+        "ready_after": round(stream.ready_after, 3) if stream.ready_after is not None else None,
+        "low_latency": stream.low_latency,
+        "renditions": [r.name for r in stream.renditions],
+        "mode": stream.mode,
+        "segment_format": stream.segment_format,
+        "burn_in": stream.burn_in,
+        "dvr": stream_id in stream.archives,
+        "cpu": _cpu_info(stream),
+        "estimated_cores": stream.allocation.cost if stream.allocation else None,
+        "cpus": stream.allocation.cpus if stream.allocation else None,
+        "ingest": stream.key,
+        "shared_with": sorted(stream.consumers - {stream_id}),
+        "output_dir": stream.output_dir,
+        "hls_url": stream.hls_url(stream_id),
+        "on_demand": _on_demand_info(entry) if entry else None,
+    }
+
+def get_stream_stats(stream_id: str, limit: Optional[int] = None) -> Optional[dict]:
+    """FFmpeg progress samples of a stream's ingest (newest last) and a summary over them."""
+    stream = _active_streams.get(stream_id)
+    if stream is None:
+        return None
+    samples = list(stream.progress_samples)
+    if limit is not None:
+        samples = samples[-limit:] if limit else []
+    return {
+        "stream_id": stream_id,
+        "ingest": stream.key,
+        "state": stream.state,
+        "restarts": stream.restarts,
+        "latest": progress.to_dict(stream.progress_samples[-1]) if stream.progress_samples else None,
+        "summary": progress.summarize(list(stream.progress_samples)),
+        "samples": [progress.to_dict(s) for s in samples],
+    }
+
+def ingest_keys() -> Set[str]:
+    """Keys (output directory names) of the running ingests."""
+    return set(_ingests)
+
+def get_active_streams() -> Dict[str, dict]:
+    """Returns a dictionary of active streams, and idle on-demand streams, and their details."""
+    streams = {
+        stream_id: _stream_info(stream_id, stream)
         for stream_id, stream in _active_streams.items()
     }
+    for stream_id, entry in _on_demand.items():
+        if stream_id not in streams:
+            streams[stream_id] = _idle_info(stream_id, entry)
+    return streams
+
+def get_capacity() -> dict:
+    return scheduler.snapshot()
+
+def collect_metrics() -> Iterator[metrics.Family]:
+    """Per-stream and per-FFmpeg gauges for /metrics, read when scraped (see metrics)."""
+    now = time.monotonic()
+    states, restarts, segment_age, speed = [], [], [], []
+    for stream_id, stream in _active_streams.items():
+        labels = {"stream_id": stream_id}
+        states.append(({**labels, "state": stream.state}, 1))
+        restarts.append((labels, stream.restarts))
+        if stream.last_segment_at is not None:
+            segment_age.append((labels, round(now - stream.last_segment_at, 3)))
+        latest = stream.progress_samples[-1] if stream.progress_samples else None
+        if latest is not None and latest.speed is not None:
+            speed.append((labels, latest.speed))
+    for stream_id in _on_demand.keys() - _active_streams.keys():
+        states.append(({"stream_id": stream_id, "state": "idle"}, 1))
+    yield "hls_stream_state", "gauge", "Current state of each stream (1 for its state).", states
+    yield "hls_stream_restarts_total", "counter", "FFmpeg restarts of the stream's ingest.", restarts
+    yield "hls_stream_last_segment_age_seconds", "gauge", "Seconds since the stream's last completed segment.", segment_age
+    yield "hls_stream_encode_speed", "gauge", "FFmpeg encode speed (1.0 = real time) of the stream's ingest.", speed
+
+    cpu, rss = [], []
+    for key, stream in _ingests.items():
+        process = stream.process
+        if process is None or process.returncode is not None:
+            continue
+        labels = {"ingest": key, "pid": str(process.pid)}
+        seconds = proc_stats.cpu_seconds(process.pid)
+        if seconds is not None:
+            cpu.append((labels, seconds))
+        size = proc_stats.rss_bytes(process.pid)
+        if size is not None:
+            rss.append((labels, size))
+    yield "ffmpeg_cpu_seconds_total", "counter", "CPU time used by each FFmpeg process (from /proc).", cpu
+    yield "ffmpeg_resident_memory_bytes", "gauge", "Resident memory of each FFmpeg process (from /proc).", rss
+
+    capacity = scheduler.snapshot()
+    yield "node_cpu_capacity_cores", "gauge", "CPU cores this node admits streams up to.", [({}, capacity["capacity_cores"])]
+    yield "node_cpu_committed_cores", "gauge", "Estimated cores committed to admitted streams.", [({}, capacity["used_cores"])]
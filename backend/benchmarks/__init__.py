@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for the streaming and overlay paths; no cameras or network needed.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run compare baseline.json results.json
+
+Run from the backend directory. See benchmarks.run for the options.
+"""
@@ -0,0 +1,118 @@
+"""
+Overlay API throughput and latency, in process through the ASGI app (no sockets), against
+the in-memory store or MongoDB. Mongo is the server at MONGODB_URI when it answers, else
+mongomock-motor when installed; otherwise that backend is skipped.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from httpx import ASGITransport, AsyncClient
+
+from app import crud, db
+from app.main import app
+from app.overlay_cache import cache
+from .stats import summarize
+
+MONGO_PING_TIMEOUT = 3.0
+
+
+async def _connect_mongo() -> Optional[str]:
+    """Point the app at a usable MongoDB; returns what it is, or None."""
+    try:
+        await asyncio.wait_for((await db.get_db()).command("ping"), timeout=MONGO_PING_TIMEOUT)
+        return "server"
+    except Exception:
+        pass
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        return None
+    db._MONGO_CLIENT = AsyncMongoMockClient()
+    db._DB = db._MONGO_CLIENT["livestream_bench"]
+    return "mongomock"
+
+
+async def _timed(samples: List[float], call: Callable[[], Awaitable]):
+    started = time.perf_counter()
+    r = await call()
+    samples.append(time.perf_counter() - started)
+    r.raise_for_status()
+    return r
+
+
+async def _phase(name: str, count: int, concurrency: int, op: Callable[[int, List[float]], Awaitable]) -> dict:
+    """Run op(0..count-1) from `concurrency` workers; report throughput and latency."""
+    samples: List[float] = []
+    queue = iter(range(count))
+
+    async def worker():
+        for i in queue:
+            await op(i, samples)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "op": name,
+        "requests": count,
+        "throughput_rps": round(count / elapsed, 1) if elapsed else None,
+        "latency_s": summarize(samples, digits=6),
+    }
+
+
+async def run(backend: str, count: int = 500, concurrency: int = 16, streams: int = 10) -> dict:
+    """Create, read, list, patch and delete `count` overlays through the API."""
+    result: Dict = {"backend": backend, "overlays": count, "concurrency": concurrency}
+    previous = crud.USE_DB
+    if backend == "mongo":
+        mongo = await _connect_mongo()
+        if mongo is None:
+            return {**result, "skipped": "no MongoDB reachable and mongomock-motor not installed"}
+        result["mongo"] = mongo
+        crud.USE_DB = True
+        try:
+            await crud.ensure_indexes()
+        except Exception:
+            pass
+    else:
+        crud.USE_DB = False
+    cache.clear()
+    ids: List[str] = [""] * count
+    try:
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://bench") as client:
+            async def create(i, samples):
+                body = {"kind": "text", "content": f"bench {i}", "x": i % 1920, "y": i % 1080,
+                        "stream_id": f"bench-cam-{i % streams}", "z_order": i % 7}
+                ids[i] = (await _timed(samples, lambda: client.post("/api/overlays", json=body))).json()["id"]
+
+            async def get(i, samples):
+                await _timed(samples, lambda: client.get(f"/api/overlays/{ids[i]}"))
+
+            async def list_all(i, samples):
+                await _timed(samples, lambda: client.get("/api/overlays"))
+
+            async def list_stream(i, samples):
+                await _timed(samples, lambda: client.get(f"/api/streams/bench-cam-{i % streams}/overlays"))
+
+            async def patch(i, samples):
+                await _timed(samples, lambda: client.patch(f"/api/overlays/{ids[i]}", json={"x": (i * 7) % 1920}))
+
+            async def delete(i, samples):
+                await _timed(samples, lambda: client.delete(f"/api/overlays/{ids[i]}"))
+
+            reads = max(1, count // 5)
+            result["phases"] = [
+                await _phase("create", count, concurrency, create),
+                await _phase("get", count, concurrency, get),
+                # Lists are served from the read cache until the next write
+                await _phase("list", reads, concurrency, list_all),
+                await _phase("list_stream", reads, concurrency, list_stream),
+                await _phase("patch", count, concurrency, patch),
+                await _phase("delete", count, concurrency, delete),
+            ]
+    finally:
+        crud.USE_DB = previous
+        cache.clear()
+    return result
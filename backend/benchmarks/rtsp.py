@@ -0,0 +1,106 @@
+"""
+Local RTSP stand-in: a MediaMTX server on loopback, fed by FFmpeg publishing lavfi test
+patterns, so the RTSP ingest path is exercised without cameras. MediaMTX is found through
+MEDIAMTX_PATH or PATH; without it the RTSP scenario is skipped.
+"""
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+from typing import List, Optional
+
+
+MEDIAMTX_PATH = os.environ.get("MEDIAMTX_PATH", "mediamtx")
+READY_TIMEOUT = 10.0
+
+_CONFIG = """
+logLevel: warn
+rtspAddress: 127.0.0.1:{port}
+rtmp: no
+hls: no
+webrtc: no
+srt: no
+api: no
+paths:
+  all_others:
+"""
+
+
+def find_server() -> Optional[str]:
+    return shutil.which(MEDIAMTX_PATH)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def _port_open(port: int, timeout: float) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+
+class RtspServer:
+    """`async with RtspServer(ffmpeg) as server: urls = await server.publish(n, size, fps)`"""
+
+    def __init__(self, ffmpeg: str, server: Optional[str] = None):
+        self.ffmpeg = ffmpeg
+        self.server = server or find_server()
+        self.port = _free_port()
+        self._processes: List[asyncio.subprocess.Process] = []
+        self._config_dir: Optional[str] = None
+
+    async def __aenter__(self) -> "RtspServer":
+        if self.server is None:
+            raise RuntimeError("MediaMTX not found (set MEDIAMTX_PATH)")
+        self._config_dir = tempfile.mkdtemp(prefix="bench-rtsp-")
+        config = os.path.join(self._config_dir, "mediamtx.yml")
+        with open(config, "w") as f:
+            f.write(_CONFIG.format(port=self.port))
+        self._processes.append(await asyncio.create_subprocess_exec(
+            self.server, config, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+        ))
+        if not await _port_open(self.port, READY_TIMEOUT):
+            await self.__aexit__(None, None, None)
+            raise RuntimeError(f"MediaMTX did not listen on port {self.port}")
+        return self
+
+    async def publish(self, count: int, size: str, fps: int) -> List[str]:
+        """Start `count` test-pattern publishers; returns their RTSP URLs."""
+        urls = []
+        for _ in range(count):
+            url = f"rtsp://127.0.0.1:{self.port}/bench-{len(self._processes)}"
+            self._processes.append(await asyncio.create_subprocess_exec(
+                self.ffmpeg, "-hide_banner", "-loglevel", "error",
+                "-re", "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={fps}",
+                "-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency",
+                "-g", str(fps), "-pix_fmt", "yuv420p",
+                "-f", "rtsp", "-rtsp_transport", "tcp", url,
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+            ))
+            urls.append(url)
+        await asyncio.sleep(1.0)  # let the publishers announce before readers connect
+        return urls
+
+    async def __aexit__(self, *exc):
+        for process in reversed(self._processes):
+            if process.returncode is None:
+                process.terminate()
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+        self._processes.clear()
+        if self._config_dir:
+            shutil.rmtree(self._config_dir, ignore_errors=True)
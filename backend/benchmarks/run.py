@@ -0,0 +1,146 @@
+"""
+Run the benchmarks and write one JSON document, or compare two of them.
+
+    python -m benchmarks.run [--suite all|streams|overlays] [--levels 1,2,4,8]
+                             [--source lavfi|rtsp|both] [--duration 20] [--output results.json]
+    python -m benchmarks.run compare baseline.json results.json [--threshold 0.1]
+
+`compare` lists every metric that got worse by more than the threshold (10% by default)
+and exits with status 1 if there is one, so it can gate CI.
+Leave ADMISSION_POLICY off (the default) to measure past this node's CPU budget.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from app import capabilities
+from . import overlays, streams
+
+# Metrics where a higher value is better; for every other compared metric lower is better
+HIGHER_IS_BETTER = {"throughput_rps", "ready"}
+COMPARED_STATS = {"mean", "p50", "p99"}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def _environment() -> dict:
+    ffmpeg = await capabilities.get_capabilities()
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "ffmpeg": ffmpeg.version,
+    }
+
+
+async def _run(args) -> dict:
+    results = {"environment": await _environment()}
+    if args.suite in ("all", "overlays"):
+        results["overlays"] = [
+            await overlays.run(backend, args.overlays, args.concurrency) for backend in ("memory", "mongo")
+        ]
+    if args.suite in ("all", "streams"):
+        levels = [int(n) for n in args.levels.split(",")]
+        sources = ["lavfi", "rtsp"] if args.source == "both" else [args.source]
+        results["streams"] = [
+            await streams.run(levels, source, args.duration, args.size, args.fps) for source in sources
+        ]
+    return results
+
+
+def _metrics(node, path: str = "") -> Iterator[Tuple[str, float]]:
+    """Flatten a result into (path, value) pairs; list items are keyed by what they measure."""
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _metrics(value, f"{path}.{key}" if path else key)
+    elif isinstance(node, list):
+        for item in node:
+            if isinstance(item, dict):
+                label = next((str(item[k]) for k in ("op", "backend", "source", "streams") if k in item), "?")
+                yield from _metrics(item, f"{path}[{label}]")
+    elif isinstance(node, (int, float)) and not isinstance(node, bool):
+        yield path, node
+
+
+def _compared(path: str) -> bool:
+    name = path.rsplit(".", 1)[-1]
+    if name in HIGHER_IS_BETTER:
+        return True
+    # Segment spacing is judged by its jitter; the interval itself should just match the target
+    return name in COMPARED_STATS and ".segment_interval_s." not in path
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[dict]:
+    """Metrics of `current` that are worse than in `baseline` by more than `threshold` (relative)."""
+    before: Dict[str, float] = dict(_metrics(baseline))
+    regressions = []
+    for path, value in _metrics(current):
+        if path.startswith("environment") or not _compared(path):
+            continue
+        old = before.get(path)
+        if not old:
+            continue
+        change = (value - old) / abs(old)
+        if path.rsplit(".", 1)[-1] in HIGHER_IS_BETTER:
+            change = -change
+        if change > threshold:
+            regressions.append({"metric": path, "baseline": old, "current": value, "worse_by": round(change, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="command")
+    cmp = sub.add_parser("compare", help="Compare two result files")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--suite", choices=["all", "streams", "overlays"], default="all")
+    parser.add_argument("--levels", default="1,2,4,8", help="Concurrent stream counts to measure")
+    parser.add_argument("--source", choices=["lavfi", "rtsp", "both"], default="both")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds measured per level")
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--overlays", type=int, default=500, help="Overlays created per backend")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent overlay API clients")
+    parser.add_argument("--output", help="Write the results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        json.dump(regressions, sys.stdout, indent=2)
+        print()
+        sys.exit(1 if regressions else 0)
+
+    logging.basicConfig(level=logging.WARNING, force=True)  # the app logs every request at INFO
+    results = asyncio.run(_run(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
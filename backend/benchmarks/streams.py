@@ -0,0 +1,118 @@
+"""
+Streaming path under growing concurrency: for 1..N simultaneous streams, the time from
+start_stream to the first listed segment, the spacing of later segments (jitter against
+HLS_SEG_TIME), and CPU/RSS of each FFmpeg from /proc. Sources are lavfi test patterns read
+directly, or the same patterns published through the local RTSP stand-in (see rtsp).
+"""
+import asyncio
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from app import capabilities, proc_stats, stream_manager
+from . import rtsp
+from .stats import summarize
+
+SAMPLE_INTERVAL = 1.0
+
+
+def lavfi_sources(count: int, size: str, fps: int) -> List[str]:
+    # Distinct graphs, so every stream gets its own ingest instead of sharing one
+    return [f"{stream_manager.LAVFI_PREFIX}testsrc2=size={size}:rate={fps},hue=h={i}" for i in range(count)]
+
+
+async def _segment_times(stream: stream_manager.StreamProcess, duration: float) -> List[float]:
+    deadline = time.monotonic() + duration
+    times = []
+    while (remaining := deadline - time.monotonic()) > 0:
+        if await stream_manager.wait_for_segment(stream, remaining):
+            times.append(time.monotonic())
+    return times
+
+
+async def _sample_processes(pids: List[int], duration: float) -> Dict[str, List[float]]:
+    cpu: List[float] = []
+    rss: List[float] = []
+    previous: Dict[int, Optional[tuple]] = {pid: None for pid in pids}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        now = time.monotonic()
+        for pid in pids:
+            percent, previous[pid] = proc_stats.cpu_percent(pid, previous[pid], now)
+            if percent is not None:
+                cpu.append(percent)
+            size = proc_stats.rss_bytes(pid)
+            if size is not None:
+                rss.append(size / 2**20)
+        await asyncio.sleep(SAMPLE_INTERVAL)
+    return {"cpu": cpu, "rss": rss}
+
+
+async def _level(sources: List[str], duration: float, startup_timeout: float) -> dict:
+    """Start one stream per source at once, measure for `duration` seconds, stop them."""
+    ids = [f"bench-{i}" for i in range(len(sources))]
+    started = time.monotonic()
+    for stream_id, source in zip(ids, sources):
+        await stream_manager.start_stream(stream_id, source, has_audio=False, mode="transcode")
+    try:
+        async def first_segment(stream_id: str) -> Optional[float]:
+            info = await stream_manager.wait_for_stream(stream_id, timeout=startup_timeout)
+            return time.monotonic() - started if info and info["state"] == "ready" else None
+
+        ready = await asyncio.gather(*(first_segment(s) for s in ids))
+        running = [stream_manager.get_stream(s) for s, t in zip(ids, ready) if t is not None]
+        pids = [s.process.pid for s in running if s and s.process]
+        measured = await asyncio.gather(
+            _sample_processes(pids, duration),
+            *(_segment_times(s, duration) for s in running),
+        )
+        usage, segment_times = measured[0], measured[1:]
+        intervals = [b - a for times in segment_times for a, b in zip(times, times[1:])]
+        target = stream_manager.HLS_SEGMENT_SECONDS
+        failed = [stream_manager.get_stream(s) for s, t in zip(ids, ready) if t is None]
+        errors = sorted({s.last_error for s in failed if s and s.last_error})
+        return {
+            "streams": len(sources),
+            "ready": len(running),
+            "errors": errors,
+            "time_to_first_segment_s": summarize([t for t in ready if t is not None]),
+            "segment_interval_s": summarize(intervals),
+            "jitter_s": summarize([abs(i - target) for i in intervals]),
+            "cpu_percent_per_stream": summarize(usage["cpu"], digits=1),
+            "rss_mib_per_stream": summarize(usage["rss"], digits=1),
+        }
+    finally:
+        for stream_id in ids:
+            await stream_manager.stop_stream(stream_id)
+
+
+async def run(
+    levels: List[int],
+    source: str = "lavfi",
+    duration: float = 20.0,
+    size: str = "1280x720",
+    fps: int = 25,
+    startup_timeout: float = 30.0,
+) -> dict:
+    result: Dict = {"source": source, "size": size, "fps": fps, "duration_s": duration,
+                    "segment_seconds": stream_manager.HLS_SEGMENT_SECONDS}
+    ffmpeg = await capabilities.get_capabilities()
+    if not ffmpeg.available:
+        return {**result, "skipped": "no working FFmpeg"}
+    previous_dir = stream_manager.STREAMS_BASE_DIR
+    stream_manager.STREAMS_BASE_DIR = tempfile.mkdtemp(prefix="bench-streams-")
+    try:
+        if source == "rtsp":
+            if rtsp.find_server() is None:
+                return {**result, "skipped": "MediaMTX not found (set MEDIAMTX_PATH)"}
+            async with rtsp.RtspServer(ffmpeg.path) as server:
+                urls = await server.publish(max(levels), size, fps)
+                result["levels"] = [await _level(urls[:n], duration, startup_timeout) for n in levels]
+        else:
+            sources = lavfi_sources(max(levels), size, fps)
+            result["levels"] = [await _level(sources[:n], duration, startup_timeout) for n in levels]
+    finally:
+        shutil.rmtree(stream_manager.STREAMS_BASE_DIR, ignore_errors=True)
+        stream_manager.STREAMS_BASE_DIR = previous_dir
+    return result
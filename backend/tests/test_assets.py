@@ -0,0 +1,69 @@
+import io
+import os
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+from PIL import Image
+from app import assets
+from app.main import app
+
+
+def _png(size=(64, 32)) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGBA", size, (255, 0, 0, 128)).save(out, "PNG")
+    return out.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_assets_are_stored_once_and_served_resized(monkeypatch, tmp_path):
+    monkeypatch.setattr(assets, "ASSETS_DIR", str(tmp_path))
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        files = {"file": ("logo.png", _png(), "image/png")}
+        r = await ac.post("/api/assets", files=files)
+        assert r.status_code == 201, r.text
+        asset = r.json()
+        assert (asset["width"], asset["height"], asset["format"]) == (64, 32, "png")
+        r = await ac.post("/api/assets", files=files)
+        assert r.status_code == 200 and r.json()["id"] == asset["id"]
+
+        r = await ac.get(asset["url"], params={"w": 16, "h": 16, "format": "webp"})
+        assert r.status_code == 200 and r.headers["content-type"] == "image/webp"
+        assert "immutable" in r.headers["cache-control"]
+        assert Image.open(io.BytesIO(r.content)).size == (32, 16)
+        # Sizes are rounded up to ASSET_VARIANT_STEP (32): 20x30 is the same 32x32 variant
+        r = await ac.get(asset["url"], params={"w": 20, "h": 30, "format": "webp"},
+                         headers={"If-None-Match": r.headers["etag"]})
+        assert r.status_code == 304
+
+        r = await ac.post("/api/overlays", json={"kind": "image", "asset_id": asset["id"], "width": 20})
+        assert r.status_code == 200 and r.json()["content"] == ""
+        # Variants for the overlay's box are rendered after the response
+        info = await assets.get_asset(asset["id"])
+        assert (tmp_path / asset["id"][:2] / asset["id"] / "w32h0.webp").exists()
+        assert assets.variant_path(info, 32, None, "png").endswith("w32h0.png")
+        await ac.delete(f"/api/overlays/{r.json()['id']}")
+
+        r = await ac.post("/api/overlays", json={"kind": "image", "asset_id": "0" * 32})
+        assert r.status_code == 400
+        r = await ac.post("/api/assets", files={"file": ("x.png", b"not an image", "image/png")})
+        assert r.status_code == 400
+        r = await ac.get("/api/assets/../../etc")
+        assert r.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_variants_are_evicted(monkeypatch, tmp_path):
+    monkeypatch.setattr(assets, "ASSETS_DIR", str(tmp_path))
+    monkeypatch.setattr(assets, "ASSET_MAX_VARIANTS", 2)
+    info, _ = await assets.store_asset(_png())
+    directory = tmp_path / info.id[:2] / info.id
+
+    first, _ = await assets.asset_file(info, 10, None, "png")
+    second, _ = await assets.asset_file(info, 40, None, "png")
+    os.utime(first, ns=(1, 1))
+    os.utime(second, ns=(2, 2))
+    # Using a variant makes it the most recent
+    await assets.asset_file(info, 20, None, "png")
+    await assets.asset_file(info, 100, None, "png")
+    assert sorted(p.name for p in directory.glob("w*")) == ["w128h0.png", "w32h0.png"]
@@ -0,0 +1,26 @@
+import pytest
+
+from benchmarks import overlays
+from benchmarks.run import compare
+
+
+@pytest.mark.asyncio
+async def test_overlay_benchmark_reports_every_phase():
+    result = await overlays.run("memory", count=20, concurrency=4, streams=2)
+    assert [p["op"] for p in result["phases"]] == ["create", "get", "list", "list_stream", "patch", "delete"]
+    assert all(p["latency_s"]["count"] == p["requests"] for p in result["phases"])
+
+
+def test_compare_flags_regressions_in_either_direction():
+    def result(p99, rps, interval):
+        return {
+            "overlays": [{"backend": "memory", "phases": [{"op": "get", "throughput_rps": rps, "latency_s": {"p99": p99}}]}],
+            "streams": [{"source": "lavfi", "levels": [{"streams": 4, "segment_interval_s": {"mean": interval}}]}],
+        }
+
+    assert compare(result(0.010, 1000, 2.0), result(0.0105, 950, 4.0), threshold=0.1) == []
+    regressions = compare(result(0.010, 1000, 2.0), result(0.020, 800, 2.0), threshold=0.1)
+    assert {r["metric"] for r in regressions} == {
+        "overlays[memory].phases[get].latency_s.p99",
+        "overlays[memory].phases[get].throughput_rps",
+    }
@@ -0,0 +1,81 @@
+import os
+import sys
+
+import pytest
+
+from app import capabilities, probe
+
+ENCODERS = """Encoders:
+ V..... = Video
+ A..... = Audio
+ ------
+ V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)
+ V....D h264_nvenc           NVIDIA NVENC H.264 encoder (codec h264)
+ A....D aac                  AAC (Advanced Audio Coding)
+"""
+
+# Answers like FFmpeg for the flags the detection uses
+FAKE_FFMPEG = f"""#!{sys.executable}
+import os, sys
+args = sys.argv[1:]
+with open(os.path.join(os.path.dirname(__file__), "calls.log"), "a") as log:
+    log.write(args[-1] + "\\n")
+outputs = {{
+    "-version": "ffmpeg version 6.1.1 Copyright (c) 2000-2023 the FFmpeg developers\\n",
+    "-encoders": {ENCODERS!r},
+    "-muxers": " D. = Demuxing supported\\n .E = Muxing supported\\n --\\n  E hls             Apple HTTP Live Streaming\\n  E mp4             MP4 (MPEG-4 Part 14)\\n",
+    "-filters": "Filters:\\n  T.. = Timeline support\\n ... overlay           VV->V      Overlay a video source on top of the input.\\n TSC scale             V->V       Scale the input video size.\\n",
+    "-hwaccels": "Hardware acceleration methods:\\nvaapi\\ncuda\\n\\n",
+}}
+print(outputs[args[-1]], end="")
+"""
+
+
+def test_listing_parsers_skip_legends():
+    assert capabilities.parse_listing(ENCODERS) == {"libx264", "h264_nvenc", "aac"}
+    assert capabilities.parse_version("ffmpeg version n7.0-static https://x\n") == "n7.0-static"
+    assert capabilities.parse_hwaccels("Hardware acceleration methods:\n") == []
+
+
+@pytest.mark.asyncio
+async def test_detection_runs_once_and_resolves_the_binary(tmp_path, monkeypatch):
+    fake = tmp_path / "ffmpeg"
+    fake.write_text(FAKE_FFMPEG)
+    os.chmod(fake, 0o755)
+    monkeypatch.setattr(capabilities, "FFMPEG_PATH", str(tmp_path / "missing-ffmpeg"))
+    monkeypatch.setattr(capabilities, "find_ffmpeg_installations", lambda: [str(fake)])
+    monkeypatch.setattr(capabilities, "_capabilities", None)
+
+    detected = await capabilities.get_capabilities()
+    assert detected.path == str(fake) and capabilities.ffmpeg_path() == str(fake)
+    assert detected.version == "6.1.1"
+    assert detected.has_encoder("h264_nvenc") and "hls" in detected.muxers
+    assert detected.filters == {"overlay", "scale"}
+    assert detected.hwaccels == ["vaapi", "cuda"]
+    # The -version run that picked the binary also provides its version
+    calls = (tmp_path / "calls.log").read_text().split()
+    assert calls.count("-version") == 1 and len(calls) == 5
+
+    os.remove(fake)
+    assert await capabilities.get_capabilities() is detected  # cached, no further runs
+
+
+@pytest.mark.asyncio
+async def test_failed_detection_is_retried_and_ffprobe_follows_ffmpeg(tmp_path, monkeypatch):
+    installations = []
+    monkeypatch.setattr(capabilities, "FFMPEG_PATH", str(tmp_path / "missing-ffmpeg"))
+    monkeypatch.setattr(capabilities, "find_ffmpeg_installations", lambda: list(installations))
+    monkeypatch.setattr(capabilities, "_capabilities", None)
+    monkeypatch.setattr(probe, "FFPROBE_PATH", None)
+    assert not (await capabilities.get_capabilities()).available
+
+    fake = tmp_path / "bin" / "ffmpeg"
+    fake.parent.mkdir()
+    fake.write_text(FAKE_FFMPEG)
+    os.chmod(fake, 0o755)
+    installations.append(str(fake))
+    assert (await capabilities.get_capabilities()).path == str(fake)
+    assert probe.ffprobe_path() == str(tmp_path / "bin" / "ffprobe")
+
+    monkeypatch.setattr(probe, "FFPROBE_PATH", "/opt/probe/ffprobe")
+    assert probe.ffprobe_path() == "/opt/probe/ffprobe"
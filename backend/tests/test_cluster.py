@@ -0,0 +1,98 @@
+import os
+import time
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+from app import cluster, storage, stream_manager
+from app.main import app
+from app.registry import SqliteRegistry, StreamRecord
+
+SPEC = {"rtsp_url": "rtsp://example/cam", "on_demand": False, "idle_timeout": None, "mode": "auto"}
+
+
+@pytest.fixture
+def shared_registry(tmp_path, monkeypatch):
+    registry = SqliteRegistry(str(tmp_path / "registry.sqlite3"))
+    monkeypatch.setattr(cluster, "registry", registry)
+    monkeypatch.setattr(cluster, "_locations", {})
+    monkeypatch.setattr(cluster, "NODE_ID", "node-b")
+    return registry
+
+
+@pytest.mark.asyncio
+async def test_leases_are_exclusive_until_they_expire(shared_registry):
+    now = time.time()
+    assert await shared_registry.claim(StreamRecord("cam-1", "node-a", now + 15, SPEC), now)
+    assert not await shared_registry.claim(StreamRecord("cam-1", "node-b", now + 15, SPEC), now)
+
+    assert await shared_registry.renew("node-a", {"cam-1": {"state": "ready"}}, now + 30) == {"cam-1": False}
+    assert await shared_registry.renew("node-b", {"cam-1": {}}, now + 30) == {}
+    assert await shared_registry.request_stop("cam-1")
+    assert await shared_registry.renew("node-a", {"cam-1": {"state": "ready"}}, now + 30) == {"cam-1": True}
+
+    await shared_registry.expire("node-a")
+    assert await shared_registry.claim(StreamRecord("cam-1", "node-b", now + 15, SPEC), now)
+    record = await shared_registry.get("cam-1")
+    assert record.owner == "node-b" and record.spec == SPEC and not record.stop_requested
+    # The old owner finds out at its next renewal
+    assert await shared_registry.renew("node-a", {"cam-1": {}}, now + 30) == {}
+
+
+@pytest.mark.asyncio
+async def test_expired_streams_are_taken_over_one_per_tick(shared_registry, monkeypatch):
+    started = []
+
+    async def start_local(stream_id, spec):
+        started.append((stream_id, spec["rtsp_url"]))
+        return f"/streams/{stream_id}/index.m3u8"
+    monkeypatch.setattr(cluster, "_start_local", start_local)
+    monkeypatch.setattr(stream_manager, "get_capacity", lambda: {"free_cores": 2.0})
+
+    past = time.time() - 60
+    for stream_id in ("cam-1", "cam-2"):
+        await shared_registry.claim(StreamRecord(stream_id, "node-a", past, SPEC), past)
+    await shared_registry.claim(StreamRecord("cam-3", "node-a", past, SPEC), past)
+    await shared_registry.request_stop("cam-3")
+
+    await cluster._rebalance()
+    assert len(started) == 1
+    assert await shared_registry.get("cam-3") is None  # stopped while its owner was down
+    await cluster._rebalance()
+    assert sorted(s for s, _ in started) == ["cam-1", "cam-2"]
+    assert {r.owner for r in await shared_registry.list()} == {"node-b"}
+
+
+@pytest.mark.asyncio
+async def test_streams_of_other_nodes_through_the_api(shared_registry):
+    now = time.time()
+    await shared_registry.claim(StreamRecord("cam-remote", "node-a", now + 15, SPEC), now)
+    await shared_registry.renew("node-a", {"cam-remote": {"state": "ready", "hls_url": "/streams/cam-remote/index.m3u8"}}, now + 15)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/streams/start", json={"stream_id": "cam-remote", "rtsp_url": "rtsp://example/other"})
+        assert r.status_code == 409 and "node-a" in r.json()["detail"]
+
+        r = await ac.get("/api/streams/cam-remote/status")
+        assert r.json()["state"] == "ready" and r.json()["node"] == "node-a"
+        assert (await ac.get("/api/streams/active")).json()["cam-remote"]["node"] == "node-a"
+
+        r = await ac.post("/api/streams/stop/cam-remote")
+        assert r.json()["status"] == "stopping"
+    assert (await shared_registry.get("cam-remote")).stop_requested
+
+
+@pytest.mark.asyncio
+async def test_sweeper_keeps_the_ingests_of_other_workers(shared_registry, tmp_path):
+    now = time.time()
+    await shared_registry.claim(StreamRecord("cam-1", "node-a", now + 15, SPEC), now)
+    await shared_registry.renew("node-a", {"cam-1": {"state": "ready", "ingest": "ingest-a"}}, now + 15)
+    await shared_registry.claim(StreamRecord("cam-2", "node-c", now - 1, SPEC), now - 2)
+
+    assert await cluster.ingest_keys() == {"ingest-a"}
+    (tmp_path / "streams" / "ingest-a" / "720p").mkdir(parents=True)
+    old = now - 600
+    os.utime(tmp_path / "streams" / "ingest-a", (old, old))
+    result = storage.sweep(str(tmp_path / "streams"), await cluster.ingest_keys())
+    assert result.removed_dirs == [] and (tmp_path / "streams" / "ingest-a").is_dir()
@@ -0,0 +1,94 @@
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from app import abr, compositor, stream_manager
+from app.models import OverlayDB
+from app.overlay_feed import feed
+
+
+def _png(color, size=(10, 10)) -> str:
+    out = io.BytesIO()
+    Image.new("RGBA", size, color).save(out, "PNG")
+    return "data:image/png;base64," + base64.b64encode(out.getvalue()).decode()
+
+
+def test_layer_scales_editor_coordinates_to_the_video(monkeypatch):
+    monkeypatch.setattr(compositor, "OVERLAY_CANVAS_SIZE", "640x360")
+    overlays = [
+        OverlayDB(id="a", kind="image", content=_png((255, 0, 0, 255)), x=320, y=180, width=64, height=36),
+        OverlayDB(id="b", kind="image", content=_png((0, 0, 255, 255)), x=0, y=0, opacity=0.5),
+        OverlayDB(id="c", kind="image", content="https://example.com/remote.png", x=100, y=100),
+        OverlayDB(id="d", kind="text", content="Live", x=10, y=300),
+    ]
+    layer = Image.open(io.BytesIO(compositor.render_layer(overlays, (1280, 720))))
+    assert layer.size == (1280, 720) and layer.mode == "RGBA"
+    # 2x scale: the 64x36 box at (320, 180) covers (640..768, 360..432)
+    assert layer.getpixel((700, 400)) == (255, 0, 0, 255)
+    assert layer.getpixel((770, 400))[3] == 0
+    assert layer.getpixel((5, 5))[2] == 255 and layer.getpixel((5, 5))[3] == 127
+    assert layer.getpixel((210, 210))[3] == 0  # remote URLs are skipped
+    assert layer.getpixel((22, 602))[3] > 0  # text box background
+
+
+def test_burn_in_adds_the_layer_input_and_overlay_filter():
+    stream = stream_manager.StreamProcess(
+        rtsp_url="rtsp://x", output_dir="/tmp/burn", burn_in=True, mode="transcode"
+    )
+    command = stream_manager._build_ffmpeg_command(stream)
+    assert command.count("-i") == 2
+    assert command[command.index("-f") + 1] == "image2"
+    assert "/tmp/burn/overlay_layer.png" in command
+    graph = command[command.index("-filter_complex") + 1]
+    assert graph.startswith("[0:v][1:v]overlay=0:0") and graph.endswith("[vout]")
+    assert "-vf" not in command and "[vout]" in command
+
+
+def test_burn_in_with_abr_overlays_before_scaling(monkeypatch):
+    monkeypatch.setenv("HLS_ABR_LADDER", "720p:1280x720:2800k,360p:640x360:800k")
+    stream = stream_manager.StreamProcess(
+        rtsp_url="rtsp://x", output_dir="/tmp/burn", renditions=abr.get_ladder(), burn_in=True
+    )
+    graph = stream_manager._build_ffmpeg_command(stream)
+    graph = graph[graph.index("-filter_complex") + 1]
+    assert graph.startswith("[0:v][1:v]overlay=0:0:format=auto:eof_action=repeat,fps=25")
+    assert "split=2[s0][s1]" in graph
+
+
+@pytest.mark.asyncio
+async def test_burn_in_cannot_remux():
+    with pytest.raises(ValueError):
+        await stream_manager.start_stream("cam-burn", "rtsp://x", mode="remux", burn_in=True)
+
+
+@pytest.mark.asyncio
+async def test_layer_is_re_rendered_only_for_changes_to_its_stream(monkeypatch):
+    renders = []
+
+    async def fake_render_to(path, size, stream_id):
+        renders.append(stream_id)
+        return [OverlayDB(id="mine", kind="text", content="Live", stream_id=stream_id)]
+
+    monkeypatch.setattr(compositor, "render_to", fake_render_to)
+    task = asyncio.create_task(compositor.follow("/tmp/layer.png", (640, 360), "cam-1"))
+    try:
+        await asyncio.sleep(0.01)
+        assert len(renders) == 1
+        feed.publish("create", "theirs", {"id": "theirs", "stream_id": "cam-2"})
+        feed.publish("delete", "gone")
+        await asyncio.sleep(0.01)
+        assert len(renders) == 1
+
+        feed.publish("create", "new", {"id": "new", "stream_id": "cam-1"})
+        await asyncio.sleep(0.01)
+        assert len(renders) == 2
+        # Moved away: only known as one of the overlays drawn
+        feed.publish("update", "mine", {"id": "mine", "stream_id": "cam-2"})
+        await asyncio.sleep(0.01)
+        assert len(renders) == 3
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
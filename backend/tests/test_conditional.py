@@ -0,0 +1,18 @@
+from starlette.requests import Request
+
+from app.routers.conditional import not_modified
+
+
+def _request(if_none_match=None) -> Request:
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match is not None else []
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": headers})
+
+
+def test_if_none_match_accepts_lists_weak_tags_and_star():
+    assert not_modified(_request('"abc"'), '"abc"')
+    assert not_modified(_request('"x", W/"abc" ,"y"'), '"abc"')
+    assert not_modified(_request('W/"abc"'), '"abc"')
+    assert not_modified(_request("*"), '"abc"')
+    assert not not_modified(_request('"abcd", "ab"'), '"abc"')
+    assert not not_modified(_request(), '"abc"')
+    assert not not_modified(_request(""), '"abc"')
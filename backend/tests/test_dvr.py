@@ -0,0 +1,154 @@
+import time
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+from app import dvr
+from app.main import app
+
+LIVE_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-PROGRAM-DATE-TIME:2024-01-01T12:00:00.000+0000
+#EXTINF:2.000000,
+segment_7.ts
+#EXTINF:2.000000,
+segment_8.ts
+"""
+
+
+def test_live_playlist_start_times_come_from_program_date_time():
+    segments = dvr.parse_live_playlist(LIVE_PLAYLIST)
+    assert [(s.sequence, s.uri) for s in segments] == [(7, "segment_7.ts"), (8, "segment_8.ts")]
+    assert segments[0].start == 1704110400.0
+    assert segments[1].start == 1704110402.0  # carried forward without its own tag
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(dvr, "DVR_DIR", str(tmp_path / "dvr"))
+    monkeypatch.setattr(dvr, "_archives", {})
+    source = tmp_path / "segment.ts"
+    source.write_bytes(b"\x47" * 188)
+    return str(source)
+
+
+async def _fill(archive, source, starts):
+    for i, start in enumerate(starts):
+        await archive.add(dvr.LiveSegment(i, f"segment_{i}.ts", 2.0, start), source)
+
+
+@pytest.mark.asyncio
+async def test_archive_windows_survive_reload_and_prune(archive_dir):
+    now = time.time()
+    base = now - 600
+    archive = await dvr.open_archive("cam-dvr", create=True)
+    # 10 contiguous segments, a restart gap, then 5 more
+    await _fill(archive, archive_dir, [base + 2 * i for i in range(10)] + [base + 60 + 2 * i for i in range(5)])
+    assert len(archive) == 15
+
+    window = archive.window_segments(base + 3, base + 9)
+    assert [s.start - base for s in window] == [2, 4, 6, 8]
+    assert archive.window_segments(base + 40, base + 50) == []
+    assert archive.window_segments(None, None)[-1].sequence == 14
+    assert archive.window_segments(base + 60, None)[0].discontinuity
+
+    reloaded = dvr.Archive("cam-dvr").load()
+    assert [(s.sequence, s.uri) for s in reloaded.window_segments(None, None)] == \
+        [(s.sequence, s.uri) for s in archive.window_segments(None, None)]
+
+    archive.window = 600 - 10
+    archive.prune(now)
+    assert archive.window_segments(None, None)[0].start - base == 10  # [8, 10) ended at the cutoff
+
+
+@pytest.mark.asyncio
+async def test_dvr_playlist_endpoint(archive_dir):
+    base = int(time.time()) - 60
+    archive = await dvr.open_archive("cam-rewind", create=True)
+    await _fill(archive, archive_dir, [base + 2 * i for i in range(30)])
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.get("/streams/cam-rewind/dvr.m3u8", params={"from": base + 10, "to": base + 20})
+        assert r.status_code == 200, r.text
+        lines = r.text.splitlines()
+        assert "#EXT-X-PLAYLIST-TYPE:VOD" in lines and lines[-1] == "#EXT-X-ENDLIST"
+        uris = [line for line in lines if line.startswith("dvr/")]
+        assert len(uris) == 5
+
+        r = await ac.get(f"/streams/cam-rewind/{uris[0]}")
+        assert r.status_code == 200 and r.content == b"\x47" * 188
+
+        # `last` is pinned to an absolute start once, so the EVENT playlist only ever grows
+        r = await ac.get("/streams/cam-rewind/dvr.m3u8", params={"last": 10})
+        assert r.status_code == 307 and "last=" not in r.headers["location"]
+        location = r.headers["location"]
+        r = await ac.get(location)
+        assert "#EXT-X-PLAYLIST-TYPE:EVENT" in r.text and "#EXT-X-ENDLIST" not in r.text
+        first = r.text.splitlines()
+        await _fill(archive, archive_dir, [base + 60])
+        again = (await ac.get(location)).text.splitlines()
+        assert again[:len(first)] == first and len(again) > len(first)
+
+        assert (await ac.get("/streams/unknown-cam/dvr.m3u8")).status_code == 404
+        assert (await ac.get("/streams/cam-rewind/dvr/2024/01/x.ts")).status_code == 404
+
+
+CHUNK_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:3
+#EXT-X-MAP:URI="init.mp4"
+#EXT-X-PROGRAM-DATE-TIME:2024-01-01T12:00:00.000+0000
+#EXTINF:2.000000,
+#EXT-X-BYTERANGE:100@0
+chunk_0.m4s
+#EXTINF:2.000000,
+#EXT-X-BYTERANGE:50
+chunk_0.m4s
+#EXTINF:2.000000,
+#EXT-X-BYTERANGE:70@0
+chunk_1.m4s
+"""
+
+
+@pytest.mark.asyncio
+async def test_fmp4_chunk_ranges_are_archived_with_their_init_segment(archive_dir, tmp_path):
+    segments = dvr.parse_live_playlist(CHUNK_PLAYLIST)
+    assert [(s.uri, s.byterange, s.init) for s in segments] == [
+        ("chunk_0.m4s", (0, 100), "init.mp4"),
+        ("chunk_0.m4s", (100, 50), "init.mp4"),
+        ("chunk_1.m4s", (0, 70), "init.mp4"),
+    ]
+    (tmp_path / "chunk_0.m4s").write_bytes(bytes(range(150)))
+    (tmp_path / "init.mp4").write_bytes(b"init")
+
+    archive = await dvr.open_archive("cam-cmaf", create=True)
+    start = time.time() - 60
+    for i, live in enumerate(segments[:2]):
+        live.start = start + 2 * i
+        await archive.add(live, str(tmp_path / live.uri), init_source=str(tmp_path / "init.mp4"))
+    first, second = archive.window_segments(None, None)
+    assert first.init == second.init and first.init.endswith(".mp4")
+    with open(archive.segment_path(*second.uri.split("/")), "rb") as f:
+        assert f.read() == bytes(range(100, 150))
+    with open(archive.segment_path(*first.init.split("/")), "rb") as f:
+        assert f.read() == b"init"
+
+    playlist = dvr.render_playlist(archive.window_segments(None, None), ended=True)
+    assert playlist.count("#EXT-X-MAP:") == 1 and "#EXT-X-VERSION:7" in playlist
+    assert dvr.Archive("cam-cmaf").load().window_segments(None, None)[1].init == second.init
+
+
+@pytest.mark.asyncio
+async def test_archived_segments_survive_ffmpeg_rewriting_the_live_file(archive_dir):
+    archive = await dvr.open_archive("cam-restart", create=True)
+    segment = await archive.add(dvr.LiveSegment(0, "segment.ts", 2.0, time.time() - 10), archive_dir)
+    # A restarted FFmpeg opens segment_0.ts again with O_TRUNC
+    with open(archive_dir, "r+b") as f:
+        f.truncate(0)
+        f.write(b"new run")
+    with open(archive.segment_path(*segment.uri.split("/")), "rb") as f:
+        assert f.read() == b"\x47" * 188
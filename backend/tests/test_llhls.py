@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from httpx import AsyncClient, ASGITransport
+from app import llhls, stream_manager
+from app.main import app
+
+
+def _parts_playlist(count: int) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7", "#EXT-X-TARGETDURATION:1", '#EXT-X-MAP:URI="init.mp4"']
+    for i in range(count):
+        lines += ["#EXTINF:0.500000,", f"part_{i}.m4s"]
+    return "\n".join(lines) + "\n"
+
+
+def test_render_groups_parts_into_segments():
+    parts = llhls.parse_parts(_parts_playlist(10))
+    playlist = llhls.render_playlist(parts, per_segment=4)
+    assert "#EXT-X-PART-INF:PART-TARGET=0.500" in playlist
+    assert "CAN-BLOCK-RELOAD=YES" in playlist
+    # Two complete parent segments, the third is still being built
+    assert playlist.count("#EXTINF:") == 2
+    assert "llseg_1.m4s" in playlist and "llseg_2.m4s" not in playlist
+    assert playlist.count("INDEPENDENT=YES") == 3
+    assert playlist.rstrip().endswith('#EXT-X-PRELOAD-HINT:TYPE=PART,URI="part_10.m4s"')
+
+
+@pytest.mark.asyncio
+async def test_blocking_playlist_reload(monkeypatch, tmp_path):
+    playlist = tmp_path / llhls.PARTS_PLAYLIST
+    playlist.write_text(_parts_playlist(6))
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir=str(tmp_path), low_latency=True)
+    monkeypatch.setitem(stream_manager._active_streams, "ll-cam", stream)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.get("/streams/ll-cam/llhls.m3u8")
+        assert r.status_code == 200
+        assert "part_5.m4s" in r.text
+
+        pending = asyncio.create_task(ac.get("/streams/ll-cam/llhls.m3u8?_HLS_msn=1&_HLS_part=3"))
+        await asyncio.sleep(0.05)
+        assert not pending.done()
+        playlist.write_text(_parts_playlist(8))
+        stream.segment_written.set()
+        r = await pending
+        assert r.status_code == 200
+        assert "llseg_1.m4s" in r.text
+
+        r = await ac.get("/streams/ll-cam/llhls.m3u8?_HLS_msn=9")
+        assert r.status_code == 400
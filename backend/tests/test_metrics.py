@@ -0,0 +1,42 @@
+import pytest
+from httpx import AsyncClient, ASGITransport
+
+from app import metrics, stream_manager
+from app.main import app
+
+
+def test_histogram_exposition_is_cumulative():
+    histogram = metrics.Histogram("test_latency_seconds", "Test.", ("op",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 3.0):
+        histogram.observe(("read",), value)
+    lines = histogram.render()
+    assert 'test_latency_seconds_bucket{op="read",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{op="read",le="1.0"} 3' in lines
+    assert 'test_latency_seconds_bucket{op="read",le="+Inf"} 4' in lines
+    assert 'test_latency_seconds_count{op="read"} 4' in lines
+    metrics._metrics.remove(histogram)
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(stream_manager, "STREAMS_BASE_DIR", str(tmp_path))
+    (tmp_path / "cam-metrics").mkdir()
+    (tmp_path / "cam-metrics" / "segment_1.ts").write_bytes(b"\x47" * 376)
+    stream_manager.register_stream("cam-idle", "rtsp://example/idle")
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/overlays", json={"kind": "text", "content": "m"})
+        assert (await ac.get(f"/api/overlays/{r.json()['id']}")).status_code == 200
+        assert (await ac.get("/streams/cam-metrics/segment_1.ts")).status_code == 200
+
+        r = await ac.get("/metrics")
+    await stream_manager.stop_stream("cam-idle")
+
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = r.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/overlays/{overlay_id}",status="2xx"}' in text
+    assert 'overlay_store_operation_seconds_count{op="create",backend="memory"}' in text
+    served = [line for line in text.splitlines() if line.startswith('hls_bytes_served_total{kind="segment"}')]
+    assert served and float(served[0].split()[-1]) >= 376
+    assert 'hls_stream_state{stream_id="cam-idle",state="idle"} 1' in text
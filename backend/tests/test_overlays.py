@@ -35,3 +35,211 @@ async def test_overlay_crud_cycle():
         # get 404
         r = await ac.get(f"/api/overlays/{oid}")
         assert r.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_overlay_change_feed_sends_deltas_and_catches_up():
+    from app import crud
+    from app.models import OverlayCreate, OverlayUpdate
+    from app.routers.overlays import _feed_messages
+
+    messages = _feed_messages(None)
+    snapshot = await messages.__anext__()
+    assert snapshot["type"] == "snapshot"
+
+    payload = OverlayCreate(kind="text", content="Live", x=0, y=0)
+    created = await crud.create_overlay(payload)
+    change = await messages.__anext__()
+    assert change["op"] == "create" and change["id"] == created.id
+    assert change["version"] == snapshot["version"] + 1
+
+    # A reconnecting client only receives what it missed
+    await crud.update_overlay(created.id, OverlayUpdate(**(payload.model_dump() | {"content": "Updated"})))
+    await crud.delete_overlay(created.id)
+    resumed = _feed_messages(change["cursor"])
+    update = await resumed.__anext__()
+    assert update["op"] == "update" and update["overlay"]["content"] == "Updated"
+    assert (await resumed.__anext__())["op"] == "delete"
+
+    # Cursors from another process (or beyond the retained history) fall back to a snapshot
+    assert (await _feed_messages("stale:3").__anext__())["type"] == "snapshot"
+
+
+@pytest.mark.asyncio
+async def test_overlay_patch_and_batch():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/overlays", json={"kind": "text", "content": "Score", "x": 5, "width": 100})
+        oid = r.json()["id"]
+
+        r = await ac.patch(f"/api/overlays/{oid}", json={"x": 40, "width": None})
+        assert r.status_code == 200, r.text
+        assert r.json() == {"id": oid, "kind": "text", "content": "Score", "x": 40, "y": 0,
+                            "width": None, "height": None, "opacity": 1.0, "asset_id": None,
+                            "stream_id": None, "z_order": 0}
+        r = await ac.patch(f"/api/overlays/{oid}", json={"content": None})
+        assert r.status_code == 422
+        r = await ac.patch("/api/overlays/nope", json={"x": 1})
+        assert r.status_code == 404
+
+        batch = {
+            "create": [{"kind": "text", "content": f"Line {i}"} for i in range(3)],
+            "update": [{"id": oid, "y": 12}, {"id": "gone", "y": 1}],
+            "delete": [],
+        }
+        r = await ac.post("/api/overlays/batch", json=batch)
+        assert r.status_code == 200, r.text
+        result = r.json()
+        assert len(result["created"]) == 3
+        assert result["updated"][0]["y"] == 12 and result["updated"][0]["x"] == 40
+        assert result["missing"] == ["gone"]
+
+        ids = [o["id"] for o in result["created"]] + [oid]
+        r = await ac.post("/api/overlays/batch", json={"delete": ids})
+        assert r.json()["deleted"] == ids
+        listed = {o["id"] for o in (await ac.get("/api/overlays")).json()}
+        assert not listed & set(ids)
+
+
+@pytest.mark.asyncio
+async def test_overlay_reads_are_cached_with_etags(monkeypatch):
+    from app import crud
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/overlays", json={"kind": "text", "content": "Cached"})
+        oid = r.json()["id"]
+        r = await ac.get("/api/overlays")
+        etag = r.headers["etag"]
+
+        # A conditional hit is answered from the cache without loading anything
+        async def no_load():
+            raise AssertionError("cache miss")
+        monkeypatch.setattr(crud, "_load_overlays", no_load)
+        r = await ac.get("/api/overlays", headers={"If-None-Match": etag})
+        assert r.status_code == 304 and r.content == b""
+        monkeypatch.undo()
+
+        r = await ac.get(f"/api/overlays/{oid}")
+        item_etag = r.headers["etag"]
+        assert r.json()["content"] == "Cached"
+
+        # Writes go through the cache, changing both ETags
+        await ac.patch(f"/api/overlays/{oid}", json={"content": "Fresh"})
+        r = await ac.get(f"/api/overlays/{oid}", headers={"If-None-Match": item_etag})
+        assert r.status_code == 200 and r.json()["content"] == "Fresh"
+        r = await ac.get("/api/overlays", headers={"If-None-Match": etag})
+        assert r.status_code == 200
+        assert any(o["content"] == "Fresh" for o in r.json())
+        await ac.delete(f"/api/overlays/{oid}")
+
+
+@pytest.mark.asyncio
+async def test_overlay_listing_pages_projects_and_streams():
+    import json
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/overlays/batch", json={
+            "create": [{"kind": "image", "content": "x" * 1000, "x": i} for i in range(5)]
+        })
+        created = {o["id"] for o in r.json()["created"]}
+
+        seen, after = [], None
+        while True:
+            params = {"limit": 2, "fields": "x,kind"} | ({"after": after} if after else {})
+            page = (await ac.get("/api/overlays", params=params)).json()
+            assert all(set(o) == {"id", "x", "kind"} for o in page["items"])
+            seen += [o["id"] for o in page["items"]]
+            after = page["next_after"]
+            if after is None:
+                break
+        assert seen == sorted(seen) and created <= set(seen)
+
+        r = await ac.get("/api/overlays", params={"fields": "y"}, headers={"Accept": "application/x-ndjson"})
+        lines = [json.loads(line) for line in r.text.splitlines()]
+        assert r.headers["content-type"] == "application/x-ndjson"
+        assert {o["id"] for o in lines} == set(seen) and all(set(o) == {"id", "y"} for o in lines)
+
+        r = await ac.get("/api/overlays", params={"fields": "secret"})
+        assert r.status_code == 400
+        await ac.post("/api/overlays/batch", json={"delete": sorted(created)})
+
+
+@pytest.mark.asyncio
+async def test_stream_overlays_are_indexed_and_ordered():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/overlays/batch", json={"create": [
+            {"kind": "text", "content": "top", "stream_id": "cam-a", "z_order": 5},
+            {"kind": "text", "content": "bottom", "stream_id": "cam-a", "z_order": -1},
+            {"kind": "text", "content": "other", "stream_id": "cam-b"},
+        ]})
+        top, bottom, other = (o["id"] for o in r.json()["created"])
+
+        r = await ac.get("/api/streams/cam-a/overlays")
+        assert [o["id"] for o in r.json()] == [bottom, top]
+        r2 = await ac.get("/api/streams/cam-a/overlays", headers={"If-None-Match": r.headers["etag"]})
+        assert r2.status_code == 304
+
+        # Moving an overlay between streams updates both lists
+        await ac.patch(f"/api/overlays/{other}", json={"stream_id": "cam-a", "z_order": 1})
+        assert [o["id"] for o in (await ac.get("/api/streams/cam-a/overlays")).json()] == [bottom, other, top]
+        assert (await ac.get("/api/streams/cam-b/overlays")).json() == []
+
+        await ac.post("/api/overlays/batch", json={"delete": [top, bottom, other]})
+        assert (await ac.get("/api/streams/cam-a/overlays")).json() == []
+
+
+@pytest.mark.asyncio
+async def test_equal_z_order_is_drawn_in_creation_order():
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.post("/api/overlays/batch", json={"create": [
+            {"kind": "text", "content": "oldest", "stream_id": "cam-d"},
+            {"kind": "text", "content": "middle", "stream_id": "cam-c"},
+            {"kind": "text", "content": "newest", "stream_id": "cam-c"},
+        ]})
+        oldest, middle, newest = (o["id"] for o in r.json()["created"])
+        # Joins cam-c last, but was created first
+        await ac.patch(f"/api/overlays/{oldest}", json={"stream_id": "cam-c"})
+        assert [o["id"] for o in (await ac.get("/api/streams/cam-c/overlays")).json()] == [oldest, middle, newest]
+        await ac.post("/api/overlays/batch", json={"delete": [oldest, middle, newest]})
+
+
+@pytest.mark.asyncio
+async def test_standalone_mongo_disables_the_change_stream_once(monkeypatch):
+    from pymongo.errors import OperationFailure
+    from app import crud
+    from app.overlay_feed import feed
+
+    class Standalone:
+        watches = 0
+
+        def watch(self, **kwargs):
+            Standalone.watches += 1
+            raise OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+
+    async def collection():
+        return Standalone()
+
+    monkeypatch.setattr(crud, "USE_DB", True)
+    monkeypatch.setattr(crud, "_change_watcher", None)
+    monkeypatch.setattr(crud, "_change_streams_unsupported", False)
+    monkeypatch.setattr(crud, "get_overlays_collection", collection)
+    version = feed.version
+
+    crud.ensure_change_feed()
+    await crud._change_watcher
+    crud.ensure_change_feed()
+    assert Standalone.watches == 1 and crud._change_watcher.done()
+    # Nothing was missed, so subscribers are not made to resync
+    assert feed.version == version
+
+    crud._publish_write("delete", "gone")
+    assert feed.version == version + 1
+
+
+def test_overlay_listing_documents_both_media_types():
+    content = app.openapi()["paths"]["/api/overlays"]["get"]["responses"]["200"]["content"]
+    assert set(content) == {"application/json", "application/x-ndjson"}
+    assert len(content["application/json"]["schema"]["oneOf"]) == 2
@@ -0,0 +1,41 @@
+from app import progress
+
+BLOCK = """frame=250
+fps=24.8
+stream_0_0_q=23.0
+bitrate=1510.3kbits/s
+total_size=1888256
+out_time_us=10000000
+out_time=00:00:10.000000
+dup_frames=1
+drop_frames=3
+speed=0.99x
+progress=continue
+"""
+
+
+def test_progress_blocks_are_parsed_into_samples():
+    parser = progress.ProgressParser()
+    samples = [s for s in (parser.feed(line) for line in BLOCK.splitlines()) if s]
+    assert len(samples) == 1
+    sample = samples[0]
+    assert sample.frame == 250 and sample.fps == 24.8
+    assert sample.bitrate_kbps == 1510.3 and sample.out_time == 10.0
+    assert sample.drop_frames == 3 and sample.dup_frames == 1 and sample.speed == 0.99
+
+    # Before the first packet FFmpeg reports N/A
+    early = progress.parse_block({"bitrate": "N/A", "speed": "N/A", "out_time_us": "N/A"})
+    assert early.bitrate_kbps is None and early.speed is None and early.out_time is None
+
+
+def test_summary_counts_drops_across_restarts():
+    samples = [
+        progress.ProgressSample(time=t, fps=fps, drop_frames=drops)
+        for t, fps, drops in ((0, 25.0, 0), (1, 20.0, 4), (2, 25.0, 1), (3, 25.0, 2))
+    ]
+    summary = progress.summarize(samples)
+    assert summary["window_seconds"] == 3
+    assert summary["fps_min"] == 20.0 and summary["fps_avg"] == 23.75
+    # 0 -> 4, then FFmpeg restarted (4 -> 1 counts the new run's 1), then 1 -> 2
+    assert summary["drop_frames"] == 6
+    assert summary["speed_avg"] is None
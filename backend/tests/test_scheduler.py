@@ -0,0 +1,48 @@
+import asyncio
+import pytest
+from app import scheduler as scheduler_module
+from app.scheduler import CapacityError, Scheduler, estimate_cost
+
+
+def test_cost_model_orders_modes():
+    remux = estimate_cost("remux", 25)
+    sd = estimate_cost("transcode", 25, source_size=(640, 360))
+    hd = estimate_cost("transcode", 25, source_size=(1920, 1080))
+    ladder = estimate_cost("transcode", 25, renditions=[(1920, 1080), (1280, 720), (640, 360)])
+    assert remux < sd < hd < ladder
+
+
+@pytest.mark.asyncio
+async def test_admission_is_unlimited_by_default():
+    assert scheduler_module.ADMISSION_POLICY == "off"
+    s = Scheduler(cpus=[0, 1], headroom=1.0)
+    await s.admit(2.0)
+    await s.admit(2.0)
+    assert s.used == 4.0
+
+
+@pytest.mark.asyncio
+async def test_reject_policy(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "ADMISSION_POLICY", "reject")
+    s = Scheduler(cpus=[0, 1, 2, 3], headroom=1.0)
+    first = await s.admit(3.0)
+    with pytest.raises(CapacityError):
+        await s.admit(2.0)
+    s.release(first)
+    assert s.used == 0
+    await s.admit(2.0)
+
+
+@pytest.mark.asyncio
+async def test_queue_policy_waits_for_release(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "ADMISSION_POLICY", "queue")
+    s = Scheduler(cpus=[0, 1], headroom=1.0, pinning=True)
+    first = await s.admit(1.5)
+    assert first.cpus == [0, 1] and first.threads == 2
+    queued = []
+    waiter = asyncio.create_task(s.admit(1.0, on_queued=lambda: queued.append(True)))
+    await asyncio.sleep(0.01)
+    assert queued and s.snapshot()["queued"] == 1
+    s.release(first)
+    second = await asyncio.wait_for(waiter, 1)
+    assert second.cpus == [0] and s.used == 1.0
@@ -0,0 +1,101 @@
+import pytest
+from httpx import AsyncClient, ASGITransport
+from app import stream_manager
+from app.main import app
+from app.segment_cache import CachedFile, SegmentCache, cache
+
+PLAYLIST = "#EXTM3U\n#EXT-X-TARGETDURATION:2\n#EXTINF:2.0,\nsegment_0.ts\n"
+
+
+def test_segment_cache_bounds():
+    c = SegmentCache(max_bytes=10, segments_per_stream=2)
+    for i in range(3):
+        c.put("cam", f"segment_{i}.ts", CachedFile(b"xx", f'"{i}"'))
+    assert c.get("cam", "segment_0.ts") is None
+    assert c.get("cam", "segment_2.ts") is not None
+    c.put("cam", "index.m3u8", CachedFile(b"x" * 8, '"p"'), is_playlist=True)
+    assert c.size_bytes <= 10
+    c.drop_stream("cam")
+    assert c.size_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_serves_listed_segments_from_memory(monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_manager, "STREAMS_BASE_DIR", str(tmp_path))
+    out = tmp_path / "cache-cam"
+    out.mkdir()
+    (out / "index.m3u8").write_text(PLAYLIST)
+    (out / "segment_0.ts").write_bytes(b"ts-data")
+    (out / "segment_1.ts").write_bytes(b"partial")
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir=str(out), key="cache-cam")
+    monkeypatch.setitem(stream_manager._active_streams, "cache-cam", stream)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.get("/streams/cache-cam/segment_0.ts")
+        assert r.status_code == 200 and r.content == b"ts-data"
+        etag = r.headers["etag"]
+        # Served from memory even once the file is gone
+        (out / "segment_0.ts").unlink()
+        r = await ac.get("/streams/cache-cam/segment_0.ts")
+        assert r.content == b"ts-data"
+        r = await ac.get("/streams/cache-cam/segment_0.ts", headers={"If-None-Match": etag})
+        assert r.status_code == 304
+
+        # Not yet listed, so it comes from disk and is not cached
+        r = await ac.get("/streams/cache-cam/segment_1.ts")
+        assert r.content == b"partial"
+        assert cache.get("cache-cam", "segment_1.ts") is None
+
+        # The cached playlist is served while the file is unchanged
+        assert cache.get("cache-cam", "index.m3u8") is not None
+        r = await ac.get("/streams/cache-cam/index.m3u8")
+        assert r.text == PLAYLIST
+        # A rewrite is picked up even before the supervisor invalidates the playlists
+        (out / "index.m3u8").write_text(PLAYLIST + "#EXTINF:2.0,\nsegment_1.ts\n")
+        r = await ac.get("/streams/cache-cam/index.m3u8")
+        assert "segment_1.ts" in r.text
+
+        r = await ac.get("/streams/cache-cam/..")
+        assert r.status_code == 404
+    cache.drop_stream("cache-cam")
+
+
+@pytest.mark.asyncio
+async def test_byte_ranges_of_fmp4_chunks(monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_manager, "STREAMS_BASE_DIR", str(tmp_path))
+    out = tmp_path / "chunk-cam"
+    out.mkdir()
+    (out / "index.m3u8").write_text(
+        "#EXTM3U\n#EXT-X-MAP:URI=\"init.mp4\"\n#EXTINF:2.0,\n#EXT-X-BYTERANGE:4@0\nchunk_0.m4s\n"
+        "#EXTINF:2.0,\n#EXT-X-BYTERANGE:6@4\nchunk_0.m4s\n"
+        "#EXTINF:2.0,\n#EXT-X-BYTERANGE:3@0\nchunk_1.m4s\n#EXTINF:2.0,\n#EXT-X-BYTERANGE:2@3\nchunk_1.m4s\n"
+    )
+    (out / "chunk_0.m4s").write_bytes(b"0123456789")
+    (out / "chunk_1.m4s").write_bytes(b"abcde")
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir=str(out), key="chunk-cam", segment_format="fmp4")
+    monkeypatch.setitem(stream_manager._active_streams, "chunk-cam", stream)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.get("/streams/chunk-cam/chunk_0.m4s", headers={"Range": "bytes=2-5"})
+        assert r.status_code == 206 and r.content == b"2345"
+        assert r.headers["content-range"] == "bytes 2-5/10"
+        assert cache.get("chunk-cam", "chunk_0.m4s") is not None
+        r = await ac.get("/streams/chunk-cam/chunk_0.m4s", headers={"Range": "bytes=-3"})
+        assert r.content == b"789"
+        r = await ac.get("/streams/chunk-cam/chunk_0.m4s", headers={"Range": "bytes=10-"})
+        assert r.status_code == 416 and r.headers["content-range"] == "bytes */10"
+
+        # The newest chunk is still growing, although two of its segments are listed: it is served
+        # from disk and never cached, here or by shared caches
+        r = await ac.get("/streams/chunk-cam/chunk_1.m4s", headers={"Range": "bytes=0-2"})
+        assert r.status_code == 206 and r.content == b"abc"
+        assert r.headers["cache-control"] == "no-cache"
+        assert cache.get("chunk-cam", "chunk_1.m4s") is None
+        with open(out / "chunk_1.m4s", "ab") as f:
+            f.write(b"fgh")
+        r = await ac.get("/streams/chunk-cam/chunk_1.m4s", headers={"Range": "bytes=5-7"})
+        assert r.status_code == 206 and r.content == b"fgh"
+        assert cache.get("chunk-cam", "chunk_1.m4s") is None
+    cache.drop_stream("chunk-cam")
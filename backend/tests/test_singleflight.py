@@ -0,0 +1,54 @@
+import asyncio
+
+import pytest
+
+from app import probe
+from app.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_the_others():
+    flights = SingleFlight()
+    runs = []
+
+    async def work():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return "done"
+
+    first = asyncio.create_task(flights.do("k", work))
+    second = asyncio.create_task(flights.do("k", work))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    assert await second == "done"
+    assert runs == [1] and first.cancelled()
+    assert "k" not in flights
+
+
+@pytest.mark.asyncio
+async def test_abandoned_probe_kills_ffprobe(monkeypatch):
+    killed = []
+
+    class Process:
+        returncode = None
+
+        async def communicate(self):
+            await asyncio.sleep(60)
+
+        def kill(self):
+            killed.append(True)
+
+    async def fake_exec(*command, **kwargs):
+        return Process()
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", fake_exec)
+    callers = [asyncio.create_task(probe.probe_source("rtsp://abandoned/cam")) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    callers[0].cancel()
+    await asyncio.sleep(0.01)
+    assert not killed
+    callers[1].cancel()
+    await asyncio.gather(*callers, return_exceptions=True)
+    await asyncio.sleep(0.01)
+    assert killed == [True]
+    assert "rtsp://abandoned/cam" not in probe._probes
@@ -0,0 +1,61 @@
+import asyncio
+import io
+
+import pytest
+from httpx import AsyncClient, ASGITransport
+from PIL import Image
+
+from app import snapshot, stream_manager
+from app.main import app
+
+PLAYLIST = "#EXTM3U\n#EXT-X-MEDIA-SEQUENCE:7\n#EXT-X-TARGETDURATION:2\n#EXTINF:2.0,\nsegment_7.ts\n"
+
+
+def _jpeg(width: int, height: int) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), "navy").save(out, "JPEG")
+    return out.getvalue()
+
+
+@pytest.mark.asyncio
+async def test_snapshot_decodes_once_per_segment(monkeypatch, tmp_path):
+    out = tmp_path / "snap-ingest"
+    out.mkdir()
+    (out / "segment_7.ts").write_bytes(b"\x47" * 188)
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir=str(out), key="snap-ingest")
+    monkeypatch.setitem(stream_manager._active_streams, "snap-cam", stream)
+    decoded = []
+
+    async def fake_decode(path, init, byterange=None):
+        decoded.append(path)
+        await asyncio.sleep(0.01)
+        return _jpeg(640, 360)
+
+    monkeypatch.setattr(snapshot, "_decode", fake_decode)
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.get("/api/streams/snap-cam/snapshot")
+        assert r.status_code == 503 and r.headers["retry-after"]
+
+        (out / "index.m3u8").write_text(PLAYLIST)
+        responses = await asyncio.gather(*(ac.get("/api/streams/snap-cam/snapshot") for _ in range(10)))
+        assert all(r.status_code == 200 and r.headers["content-type"] == "image/jpeg" for r in responses)
+        assert decoded == [str(out / "segment_7.ts")]
+
+        r = await ac.get("/api/streams/snap-cam/snapshot", params={"width": 160, "format": "webp"})
+        assert r.headers["content-type"] == "image/webp"
+        assert Image.open(io.BytesIO(r.content)).size == (160, 90)
+        r = await ac.get(
+            "/api/streams/snap-cam/snapshot", params={"width": 160, "format": "webp"}, headers={"If-None-Match": r.headers["etag"]}
+        )
+        assert r.status_code == 304
+        assert len(decoded) == 1
+
+        (out / "index.m3u8").write_text(PLAYLIST + "#EXTINF:2.0,\nsegment_8.ts\n")
+        (out / "segment_8.ts").write_bytes(b"\x47" * 188)
+        assert (await ac.get("/api/streams/snap-cam/snapshot")).status_code == 200
+        assert decoded[-1] == str(out / "segment_8.ts")
+
+        assert (await ac.get("/api/streams/no-such-cam/snapshot")).status_code == 404
+    snapshot._latest.pop("snap-ingest", None)
@@ -0,0 +1,79 @@
+import os
+import time
+
+import pytest
+
+from app import storage
+
+
+def _write(path, size=100, age=0.0):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def _live_ingest(base, key="ingest-live", segments=8):
+    """Segments 0..n-1, oldest first; the playlist lists the last three."""
+    directory = os.path.join(base, key)
+    for i in range(segments):
+        _write(os.path.join(directory, f"segment_{i}.ts"), age=(segments - i) * 2)
+    listed = "".join(f"#EXTINF:2.0,\nsegment_{i}.ts\n" for i in range(segments - 3, segments))
+    with open(os.path.join(directory, "index.m3u8"), "w") as f:
+        f.write(f"#EXTM3U\n#EXT-X-MEDIA-SEQUENCE:{segments - 3}\n{listed}")
+    return directory
+
+
+def test_sweep_applies_count_age_and_report_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "SEGMENT_RETENTION_COUNT", 5)
+    monkeypatch.setattr(storage, "SEGMENT_MAX_AGE", 0)
+    live = _live_ingest(str(tmp_path))
+    for i in range(5):
+        _write(os.path.join(live, f"ffmpeg-2024010{i}-000000.log"), age=100 - i)
+
+    result = storage.sweep(str(tmp_path), {"ingest-live"})
+    remaining = sorted(os.listdir(live))
+    assert [n for n in remaining if n.endswith(".ts")] == [f"segment_{i}.ts" for i in range(3, 8)]
+    assert len([n for n in remaining if n.endswith(".log")]) == storage.REPORT_LOGS_KEEP
+    assert result.deleted_files == 3 + 2
+
+    monkeypatch.setattr(storage, "SEGMENT_MAX_AGE", 7)
+    storage.sweep(str(tmp_path), {"ingest-live"})
+    # Old but still listed segments stay
+    assert sorted(n for n in os.listdir(live) if n.endswith(".ts")) == [f"segment_{i}.ts" for i in (5, 6, 7)]
+
+
+def test_sweep_removes_orphans_and_enforces_the_global_quota(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "SEGMENT_RETENTION_COUNT", 0)
+    monkeypatch.setattr(storage, "SEGMENT_MAX_AGE", 0)
+    live = _live_ingest(str(tmp_path))
+    orphan = os.path.join(str(tmp_path), "ingest-gone")
+    _write(os.path.join(orphan, "segment_0.ts"))
+    os.utime(orphan, (time.time() - 3600,) * 2)
+    fresh = os.path.join(str(tmp_path), "ingest-starting")
+    os.makedirs(fresh)
+    os.makedirs(os.path.join(str(tmp_path), storage.TRASH_PREFIX + "1234"))
+
+    usage = storage.sweep(str(tmp_path), {"ingest-live"}, dry_run=True)
+    assert set(usage.usage) == {"ingest-live", "ingest-gone", "ingest-starting"}
+
+    monkeypatch.setattr(storage, "STORAGE_MAX_BYTES", 500)
+    result = storage.sweep(str(tmp_path), {"ingest-live"})
+    assert not os.path.exists(orphan) and os.path.exists(fresh)
+    assert "ingest-gone" in result.removed_dirs
+    # Down to the three listed segments plus the playlist; the rest were evicted oldest first
+    assert sorted(n for n in os.listdir(live) if n.endswith(".ts")) == [f"segment_{i}.ts" for i in (5, 6, 7)]
+    assert result.total_bytes <= 500
+
+
+@pytest.mark.asyncio
+async def test_discard_frees_the_path_immediately(tmp_path):
+    directory = str(tmp_path / "ingest-x")
+    _write(os.path.join(directory, "segment_0.ts"))
+    await storage.discard(directory)
+    assert not os.path.exists(directory)
+    os.makedirs(directory)  # reusable right away
+    for task in list(storage._pending):
+        await task
+    assert os.listdir(str(tmp_path)) == ["ingest-x"]
@@ -0,0 +1,199 @@
+import os
+import sys
+import asyncio
+import pytest
+from httpx import AsyncClient, ASGITransport
+from app import abr, probe, stream_manager
+from app.main import app
+
+# Stand-in for FFmpeg: keeps rewriting the playlist and reporting progress until terminated
+FAKE_FFMPEG = """
+import os, sys, time
+out = sys.argv[1]
+n = 0
+while True:
+    with open(os.path.join(out, "index.m3u8"), "w") as f:
+        f.write(f"#EXTM3U\\n#EXT-X-MEDIA-SEQUENCE:{n}\\n")
+    print(f"frame={n}\\nfps=10.0\\nout_time_us={n * 100000}\\nspeed=1.0x\\nprogress=continue", flush=True)
+    n += 1
+    time.sleep(0.1)
+"""
+
+
+@pytest.fixture
+def fast_supervisor(monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_manager, "STREAMS_BASE_DIR", str(tmp_path))
+    monkeypatch.setattr(stream_manager, "WATCHDOG_INTERVAL", 0.05)
+    monkeypatch.setattr(stream_manager, "STARTUP_TIMEOUT", 5)
+    monkeypatch.setattr(stream_manager, "RESTART_BACKOFF_BASE", 0.01)
+
+    async def no_probe(url):
+        return None
+    monkeypatch.setattr(probe, "probe_source", no_probe)
+    return tmp_path
+
+
+@pytest.mark.asyncio
+async def test_supervised_stream_start_and_stop(fast_supervisor, monkeypatch):
+    monkeypatch.setattr(
+        stream_manager, "_build_ffmpeg_command",
+        lambda stream: [sys.executable, "-c", FAKE_FFMPEG, stream.output_dir],
+    )
+    hls_url = await stream_manager.start_stream("cam-test", "rtsp://example/stream")
+    assert hls_url == "/streams/cam-test/index.m3u8"
+    assert stream_manager.get_active_streams()["cam-test"]["state"] == "starting"
+    info = await stream_manager.wait_for_stream("cam-test", timeout=5)
+    assert info["state"] == "ready"
+    assert info["pid"]
+    assert info["ready_after"] is not None
+    # Readiness comes from the playlist, which can be written before the first -progress block
+    deadline = asyncio.get_running_loop().time() + 5
+    while stream_manager.get_stream_stats("cam-test")["latest"] is None:
+        assert asyncio.get_running_loop().time() < deadline, "no FFmpeg progress parsed"
+        await asyncio.sleep(0.02)
+    stats = stream_manager.get_stream_stats("cam-test", limit=1)
+    assert stats["latest"]["fps"] == 10.0 and len(stats["samples"]) == 1
+    assert stats["summary"]["speed_avg"] == 1.0
+
+    assert await stream_manager.stop_stream("cam-test")
+    assert "cam-test" not in stream_manager.get_active_streams()
+    assert not os.path.exists(info["output_dir"])
+
+
+@pytest.mark.asyncio
+async def test_streams_sharing_a_source_share_one_ingest(fast_supervisor, monkeypatch):
+    monkeypatch.setattr(
+        stream_manager, "_build_ffmpeg_command",
+        lambda stream: [sys.executable, "-c", FAKE_FFMPEG, stream.output_dir],
+    )
+    await stream_manager.start_stream("lobby-a", "rtsp://example/lobby")
+    assert await stream_manager.start_stream("lobby-b", "rtsp://example/lobby") == "/streams/lobby-b/index.m3u8"
+    a = await stream_manager.wait_for_stream("lobby-a", timeout=5)
+    b = await stream_manager.wait_for_stream("lobby-b", timeout=5)
+    assert a["pid"] == b["pid"] and a["ingest"] == b["ingest"]
+    assert b["shared_with"] == ["lobby-a"]
+
+    assert await stream_manager.stop_stream("lobby-a")
+    assert os.path.exists(b["output_dir"])
+    assert stream_manager.get_active_streams()["lobby-b"]["state"] == "ready"
+    assert await stream_manager.stop_stream("lobby-b")
+    assert not os.path.exists(b["output_dir"])
+
+
+@pytest.mark.asyncio
+async def test_on_demand_stream_starts_on_first_view_and_stops_when_idle(fast_supervisor, monkeypatch):
+    monkeypatch.setattr(stream_manager, "ON_DEMAND_REAP_INTERVAL", 0.05)
+    monkeypatch.setattr(
+        stream_manager, "_build_ffmpeg_command",
+        lambda stream: [sys.executable, "-c", FAKE_FFMPEG, stream.output_dir],
+    )
+    assert stream_manager.register_stream("cam-lazy", "rtsp://example/lazy", idle_timeout=0.5)
+    assert stream_manager.get_active_streams()["cam-lazy"]["state"] == "idle"
+    assert not stream_manager._ingests
+
+    transport = ASGITransport(app=app)
+    async with AsyncClient(transport=transport, base_url="http://test") as ac:
+        r = await ac.get("/streams/cam-lazy/index.m3u8")
+    assert r.status_code == 200 and r.text.startswith("#EXTM3U")
+    info = stream_manager.get_active_streams()["cam-lazy"]
+    assert info["state"] == "ready" and info["on_demand"]["viewers"] == 1
+    await asyncio.sleep(0.05)
+    assert stream_manager.get_active_streams()["cam-lazy"]["on_demand"]["cold_starts"] == 1
+
+    await asyncio.sleep(1)
+    info = await stream_manager.wait_for_stream("cam-lazy")
+    assert info["state"] == "idle" and info["on_demand"]["idle_stops"] == 1
+    assert not stream_manager._ingests
+    assert await stream_manager.stop_stream("cam-lazy")
+    assert await stream_manager.wait_for_stream("cam-lazy") is None
+
+
+@pytest.mark.asyncio
+async def test_supervisor_gives_up_after_bounded_restarts(fast_supervisor, monkeypatch):
+    monkeypatch.setattr(stream_manager, "MAX_RESTARTS", 2)
+    monkeypatch.setattr(
+        stream_manager, "_build_ffmpeg_command",
+        lambda stream: [sys.executable, "-c", "raise SystemExit(1)"],
+    )
+    assert await stream_manager.start_stream("cam-dead", "rtsp://example/dead")
+    info = await stream_manager.wait_for_stream("cam-dead", timeout=5)
+    assert info["state"] == "failed"
+    assert info["restarts"] == 2
+    assert await stream_manager.stop_stream("cam-dead")
+
+
+@pytest.mark.asyncio
+async def test_readiness_detected_from_ffmpeg_log(fast_supervisor):
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir=str(fast_supervisor))
+    playlist = fast_supervisor / "index.m3u8"
+    stream_manager._on_ffmpeg_line("cam", stream, f"[hls @ 0x1] Opening '{fast_supervisor}/segment_0.ts.tmp' for writing")
+    stream_manager._on_ffmpeg_line("cam", stream, f"[hls @ 0x1] Opening '{fast_supervisor}/segment_1.ts.tmp' for writing")
+    assert stream.state == "starting" and stream.settling is None
+    # The segment counts once the playlist listing it has been renamed into place
+    stream_manager._on_ffmpeg_line("cam", stream, f"[hls @ 0x1] Opening '{playlist}.tmp' for writing")
+    await asyncio.sleep(0.05)
+    assert stream.state == "starting" and stream.last_segment_at is None
+    playlist.write_text("#EXTM3U\n")
+    await asyncio.wait_for(stream.settling, 1)
+    assert stream.state == "ready" and stream.last_segment_at is not None
+    for low_latency in (False, True):
+        stream.low_latency = low_latency
+        args = stream_manager._hls_output_args(stream)
+        assert "temp_file" in args[args.index("-hls_flags") + 1]
+
+
+def test_abr_command_decodes_once_and_maps_every_rendition(monkeypatch):
+    monkeypatch.setenv("HLS_ABR_LADDER", "720p:1280x720:2800k,360p:640x360:800k")
+    stream = stream_manager.StreamProcess(
+        rtsp_url="rtsp://x", output_dir="/tmp/abr", renditions=abr.get_ladder(), has_audio=False
+    )
+    command = stream_manager._build_ffmpeg_command(stream)
+    assert command.count("-i") == 1
+    graph = command[command.index("-filter_complex") + 1]
+    assert "split=2[s0][s1]" in graph and "scale=640:360" in graph
+    assert command[command.index("-var_stream_map") + 1] == "v:0,name:720p v:1,name:360p"
+    assert command[-1] == "/tmp/abr/%v/index.m3u8"
+    assert stream.hls_url("cam") == "/streams/cam/master.m3u8"
+    assert abr.cpu_weights(stream.renditions)["720p"] == pytest.approx(0.8)
+
+
+def test_remux_selected_for_hls_compatible_source():
+    data = {
+        "streams": [
+            {"index": 0, "codec_type": "video", "codec_name": "h264", "profile": "Main",
+             "pix_fmt": "yuv420p", "avg_frame_rate": "25/1"},
+            {"index": 1, "codec_type": "audio", "codec_name": "aac"},
+        ],
+        "packets": [
+            {"stream_index": 0, "pts_time": str(t), "flags": "K__"} for t in (0.0, 2.0, 4.0)
+        ],
+    }
+    info = probe.parse_probe(data)
+    assert info.gop_seconds == 2.0 and info.fps == 25.0 and info.has_audio
+    assert probe.remux_blockers(info, 2) == []
+
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir="/tmp/remux", source=info, mode="remux")
+    command = stream_manager._build_ffmpeg_command(stream)
+    assert command[command.index("-c:v") + 1] == "copy"
+    assert command[command.index("-c:a") + 1] == "copy"
+
+    info.gop_seconds = 10.0
+    info.profile = "High 4:4:4 Predictive"
+    assert len(probe.remux_blockers(info, 2)) == 2
+
+
+@pytest.mark.asyncio
+async def test_fmp4_chunks_use_byte_range_playlists(tmp_path):
+    stream = stream_manager.StreamProcess(rtsp_url="rtsp://x", output_dir=str(tmp_path), segment_format="fmp4")
+    command = stream_manager._build_ffmpeg_command(stream)
+    assert command[command.index("-hls_segment_type") + 1] == "fmp4"
+    assert command[command.index("-hls_segment_size") + 1] == str(stream_manager.HLS_CHUNK_BYTES)
+    assert command[command.index("-hls_segment_filename") + 1] == f"{tmp_path}/chunk_%d.m4s"
+    assert "delete_segments" not in command[command.index("-hls_flags") + 1]
+
+    # Chunk files open rarely, so segments are counted by playlist rewrites
+    playlist = tmp_path / "index.m3u8"
+    stream_manager._on_ffmpeg_line("cam", stream, f"[hls @ 0x1] Opening '{playlist}.tmp' for writing")
+    playlist.write_text("#EXTM3U\n")
+    await asyncio.wait_for(stream.settling, 1)
+    assert stream.state == "ready" and stream.last_segment_at is not None
@@ -36,11 +36,23 @@ export default function HomePage() {
       }
 
       const data = await response.json();
-      // Use a timeout to give FFmpeg time to generate the first segments
-      setTimeout(() => {
-        setHlsUrl(API_BASE_URL + data.hls_url);
-        setIsLoading(false);
-      }, 3000);
+      // Long-poll the status endpoint until the first segment has landed
+      let state = data.state;
+      while (state === "starting" || state === "restarting") {
+        const statusResponse = await fetch(
+          `${API_BASE_URL}${data.status_url}?wait=30`
+        );
+        if (!statusResponse.ok) {
+          throw new Error("Failed to get stream status");
+        }
+        const status = await statusResponse.json();
+        state = status.state;
+        if (state === "failed") {
+          throw new Error(status.last_error || "Stream failed to start");
+        }
+      }
+      setHlsUrl(API_BASE_URL + data.hls_url);
+      setIsLoading(false);
     } catch (err) {
       setError(
         err instanceof Error ? err.message : "An unknown error occurred."
@@ -11,6 +11,7 @@ interface Overlay {
   opacity: number;
   width?: number;
   height?: number;
+  asset_id?: string | null;
 }
 
 interface OverlayManagerProps {
@@ -32,6 +33,14 @@ export default function OverlayManager({
   const [isLoading, setIsLoading] = useState(false);
   const nextId = useRef(1);
 
+  // Image assets are resized server-side to the overlay's box and served as immutable WebP
+  const assetUrl = (overlay: Overlay) => {
+    const params = new URLSearchParams({ format: "webp" });
+    if (overlay.width) params.set("w", String(overlay.width));
+    if (overlay.height) params.set("h", String(overlay.height));
+    return `${apiUrl}/api/assets/${overlay.asset_id}?${params}`;
+  };
+
   // Fetch existing overlays from the backend
   const fetchOverlays = async () => {
     setIsLoading(true);
@@ -84,16 +93,14 @@ export default function OverlayManager({
     const overlay = overlays.find((o) => o.id === id);
     if (!overlay) return;
 
-    const updatedOverlay = { ...overlay, x, y };
-
     // Update locally immediately for responsive UI
     setOverlays(overlays.map((o) => (o.id === id ? { ...o, x, y } : o)));
 
-    // Then update in backend
+    // Then update in backend, sending only the moved coordinates
     fetch(`${apiUrl}/api/overlays/${id}`, {
-      method: "PUT",
+      method: "PATCH",
       headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(updatedOverlay),
+      body: JSON.stringify({ x, y }),
     })
       .then((response) => {
         if (!response.ok) throw new Error("Failed to update overlay position");
@@ -209,7 +216,17 @@ export default function OverlayManager({
               zIndex: 100,
             }}
           >
-            {overlay.content}
+            {overlay.asset_id ? (
+              <img
+                src={assetUrl(overlay)}
+                width={overlay.width}
+                height={overlay.height}
+                alt=""
+                draggable={false}
+              />
+            ) : (
+              overlay.content
+            )}
           </div>
         </Draggable>
       ))}